@@ -0,0 +1,66 @@
+import os
+import sys
+import subprocess
+from argparse import ArgumentParser
+
+# Max time (ms) to import 'function_app', i.e. the part of the cold start we control.
+DEFAULT_IMPORT_BUDGET_MS = 400
+
+
+def measure_import_time(module="function_app", n_runs=3):
+    """
+    Measure the import time of a module in fresh interpreters, using '-X importtime'.
+
+    Args:
+        module (str): Module to import.
+        n_runs (int): Number of runs. The fastest one is kept, to skip disk cache misses.
+
+    Returns:
+        (float, list): Import time (ms) and the slowest imported packages [(cumulative ms, name)].
+    """
+    # Packages imported by the interpreter startup itself (e.g. 'site') are not counted.
+    startup_packages = {package for _, package in _run_importtime("pass")}
+    best_ms, best_packages = None, []
+    for _ in range(n_runs):
+        packages = [(package_ms, package) for package_ms, package in _run_importtime(f"import {module}")
+                    if package not in startup_packages]
+        total_ms = sum(package_ms for package_ms, _ in packages)
+        if best_ms is None or total_ms < best_ms:
+            best_ms, best_packages = total_ms, sorted(packages, reverse=True)
+    return best_ms, best_packages
+
+
+def _run_importtime(code):
+    app_dir = os.path.dirname(os.path.abspath(__file__))
+    process = subprocess.run([sys.executable, "-X", "importtime", "-c", code],
+                             cwd=app_dir, capture_output=True, text=True)
+    if process.returncode != 0:
+        raise RuntimeError(f"Failed to run '{code}':\n{process.stderr}")
+
+    # Lines: "import time: <self us> | <cumulative us> | <package>". Nested imports are indented.
+    packages = []
+    for line in process.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative_us, package = line[len("import time:"):].split("|")
+        if not package.startswith("  "):
+            packages.append((int(cumulative_us) / 1000, package.strip()))
+    return packages
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("-b", "--budget",
+                        dest="budget", default=DEFAULT_IMPORT_BUDGET_MS, type=float,
+                        help="Import time budget (ms)")
+    parser.add_argument("-m", "--module",
+                        dest="module", default="function_app",
+                        help="Module to import")
+    args = parser.parse_args()
+
+    import_ms, packages = measure_import_time(args.module)
+    print(f"Import time of '{args.module}': {import_ms:.1f} ms (budget: {args.budget:.0f} ms)")
+    for package_ms, package in packages[:10]:
+        print(f"  {package_ms:8.1f} ms  {package}")
+    # Fail when the budget is exceeded, e.g. because a heavy module is imported eagerly again.
+    sys.exit(0 if import_ms <= args.budget else 1)
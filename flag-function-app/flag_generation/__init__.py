@@ -1,8 +1,12 @@
 import json
+import time
 import azure.functions as func
 import logging
-from flag_generation.flag_creation import generate_and_store_flag  # Import from flag_creation.py
-from flag_generation.flag_creation import create_batch_flags
+from flag_generation.idempotency import (get_idempotency_key, get_payload_hash, run_once,
+                                        IdempotencyInProgress, IdempotencyKeyMismatch)
+from flag_generation.deadline import Deadline, DeadlineExceeded
+# NOTE: 'flag_generation.flag_creation' (cv2, numpy, openai, azure storage) is imported
+# on first use inside the handlers, so cold starts only pay for it when needed.
 
 #app = func.FunctionApp()
 #@app.route(route="generate_flag", auth_level=func.AuthLevel.ANONYMOUS)
@@ -15,6 +19,8 @@ def main(req: func.HttpRequest) -> func.HttpResponse:
     and returns the final URL.
     """
     logging.info("Processing a flag generation request inside flag_generation/__init__.py...")
+    # Time budget of the request, shared by all its stages.
+    deadline = Deadline()
     try:
         # Parse request body
         req_body = req.get_json()
@@ -22,6 +28,7 @@ def main(req: func.HttpRequest) -> func.HttpResponse:
         style = req_body.get("style", "").strip()
         color = req_body.get("color", "").strip()
         item = req_body.get("item", "").strip()
+        return_timings = req_body.get("return_timings", False)
 
         # Ensure all parameters are provided
         if not element or not style or not color or not item:
@@ -32,12 +39,46 @@ def main(req: func.HttpRequest) -> func.HttpResponse:
             )
 
         # Generate and store the image
-        image_url = generate_and_store_flag(element, style, color, item)
+        def generate():
+            from flag_generation.flag_creation import generate_and_store_flag  # Import from flag_creation.py
+            timings = {}
+            image_url = generate_and_store_flag(element, style, color, item, timings=timings, deadline=deadline)
+            response_body = {"image_url": image_url}
+            if return_timings:
+                response_body["timings"] = timings
+            return response_body
 
+        # Retries with the same idempotency key get the first result instead of a new image.
+        response_body, replayed = run_once("generate_flag", get_idempotency_key(req, req_body), generate,
+                                         payload_hash=get_payload_hash(req_body), deadline=deadline)
+
+        return func.HttpResponse(
+            json.dumps(response_body),
+            mimetype="application/json",
+            status_code=200,
+            headers={"Idempotent-Replayed": str(replayed).lower()}
+        )
+
+    except IdempotencyInProgress as e:
+        return func.HttpResponse(
+            json.dumps({"error": str(e)}),
+            mimetype="application/json",
+            status_code=409
+        )
+
+    except IdempotencyKeyMismatch as e:
         return func.HttpResponse(
-            json.dumps({"image_url": image_url}),
+            json.dumps({"error": str(e)}),
+            mimetype="application/json",
+            status_code=422
+        )
+
+    except DeadlineExceeded as e:
+        logging.error(f"Request deadline exceeded: {str(e)}")
+        return func.HttpResponse(
+            json.dumps({"error": str(e)}),
             mimetype="application/json",
-            status_code=200
+            status_code=504
         )
 
     except Exception as e:
@@ -56,6 +97,8 @@ def batch_flag_generation(req: func.HttpRequest) -> func.HttpResponse:
     image in Azure Blob Storage, and returns the final URL.
     """
     logging.info("Processing a batch flag generation request inside flag_generation/__init__.py...")
+    # Time budget of the request, shared by all its flags.
+    deadline = Deadline()
     try:
         # Parse request body
         req_body = req.get_json()
@@ -65,6 +108,11 @@ def batch_flag_generation(req: func.HttpRequest) -> func.HttpResponse:
         colors = req_body.get("colors", [])
         items = req_body.get("items", [])
         n_attempts = req_body.get("n_attempts", 1)
+        # Attempts run at once per flag (speculative). Defaults to 'SPECULATIVE_ATTEMPTS'.
+        n_parallel = req_body.get("n_parallel")
+        # Pick combinations & attempts by their border rate. Defaults to 'ADAPTIVE_SCHEDULING'.
+        adaptive = req_body.get("adaptive")
+        return_timings = req_body.get("return_timings", False)
         
         # Ensure all parameters are provided
         if not n_flags or not elements or not styles or not colors or not items or not n_attempts:
@@ -75,12 +123,47 @@ def batch_flag_generation(req: func.HttpRequest) -> func.HttpResponse:
             )
         
         # Generate and store the images
-        image_urls = create_batch_flags(n_flags, elements, styles, colors, items, n_attempts)
+        def generate():
+            from flag_generation.flag_creation import create_batch_flags
+            timings = []
+            image_urls = create_batch_flags(n_flags, elements, styles, colors, items, n_attempts, timings=timings,
+                                            deadline=deadline, n_parallel=n_parallel, adaptive=adaptive)
+            response_body = {"image_urls": image_urls}
+            if return_timings:
+                response_body["timings"] = timings
+            return response_body
+
+        # Retries with the same idempotency key get the first result instead of a new batch.
+        response_body, replayed = run_once("generate_batch_flags", get_idempotency_key(req, req_body), generate,
+                                         payload_hash=get_payload_hash(req_body), deadline=deadline)
         
         return func.HttpResponse(
-            json.dumps({"image_urls": image_urls}),
+            json.dumps(response_body),
+            mimetype="application/json",
+            status_code=200,
+            headers={"Idempotent-Replayed": str(replayed).lower()}
+        )
+
+    except IdempotencyInProgress as e:
+        return func.HttpResponse(
+            json.dumps({"error": str(e)}),
+            mimetype="application/json",
+            status_code=409
+        )
+
+    except IdempotencyKeyMismatch as e:
+        return func.HttpResponse(
+            json.dumps({"error": str(e)}),
+            mimetype="application/json",
+            status_code=422
+        )
+
+    except DeadlineExceeded as e:
+        logging.error(f"Request deadline exceeded: {str(e)}")
+        return func.HttpResponse(
+            json.dumps({"error": str(e)}),
             mimetype="application/json",
-            status_code=200
+            status_code=504
         )
 
     except Exception as e:
@@ -89,4 +172,23 @@ def batch_flag_generation(req: func.HttpRequest) -> func.HttpResponse:
             json.dumps({"error": str(e)}),
             mimetype="application/json",
             status_code=500
-        )
\ No newline at end of file
+        )
+
+
+def warm_up() -> dict:
+    """
+    Load the heavy modules, create the clients and run the border detectors once,
+    ahead of the first flag generation request of the instance.
+    """
+    start = time.perf_counter()
+    try:
+        from flag_generation import flag_creation
+        import_ms = round((time.perf_counter() - start) * 1000, 3)
+        timings = {"import": import_ms, **flag_creation.warm_up()}
+        timings["total"] = round((time.perf_counter() - start) * 1000, 3)
+        logging.info(f"Warm-up done: {json.dumps(timings)}")
+        return timings
+
+    except Exception as e:
+        logging.error(f"Error warming up: {str(e)}")
+        return {}
@@ -1,20 +1,67 @@
 import os
+import threading
 import cv2
 import numpy as np
+try:
+    from flag_generation.timing import time_stage
+except:
+    from timing import time_stage
 
 # Run without matplotlib when deployed in the cloud
 CLOUD_DEPLOYMENT = os.getenv("CLOUD_DEPLOYMENT")
 if not CLOUD_DEPLOYMENT:
     import matplotlib.pyplot as plt
 
+# Bump whenever the detection logic changes, so stored evaluation results are recomputed.
+DETECTOR_VERSION = "1.2"
+
+# Line sum thresholds of the border classification: a strong line on one axis (with
+# some line on the other one), or medium lines on both axes.
+BORDER_HIGH_SCORE = 5000
+BORDER_MIDDLE_SCORE = 1000
+BORDER_LOW_SCORE = 100
+
+# Canny Params of the full detector (the fast stage scales the thresholds to its image size).
+CANNY_LOW_THRESHOLD = 50
+CANNY_HIGH_THRESHOLD = 150
+CANNY_APERTURE = 7
+
+# Cascade Params: the fast stage works on a downscaled copy of the image.
+FAST_STAGE_WIDTH = 256
+# Min length of a line in the fast stage (as a fraction of the image side). Without any
+# line this long near the edges, there is no border.
+# The thresholds are not validated yet: compare with '-ab prod cascade' (see README).
+FAST_MIN_LINE_PERC = 0.05
+# Line coverage (fraction of the image side) above which all four sides are considered a frame.
+FAST_BORDER_COVERAGE = 0.9
+
+# Salvage Params: max crop per side (fraction of the image side), min line coverage
+# (fraction of the image side) of a border line, margin (px) kept off the line,
+# and min area kept (fraction of the image) after fixing the aspect ratio.
+SALVAGE_MAX_CROP_PERC = 0.15
+SALVAGE_MIN_COVERAGE = 0.5
+SALVAGE_MARGIN = 4
+SALVAGE_MIN_AREA_PERC = 0.6
+
+# Counters of which stage of the cascade took the decision (shared by the request threads).
+CASCADE_STATS = {"fast_no_border": 0, "fast_border": 0, "full": 0}
+_cascade_stats_lock = threading.Lock()
+
+
 def detect_borders(image, min_line_length=100, iterations=2, kernel_len=30, edge_perc=0.3,
-                           debug = False):
+                           high_score=BORDER_HIGH_SCORE, middle_score=BORDER_MIDDLE_SCORE, low_score=BORDER_LOW_SCORE,
+                           debug = False, timings=None, gray=None, lines=None):
     """
     Detect vertical and horizontal lines in an image, merging broken lines using morphological operations.
 
     Args:
         image_data (img): Input image in cv2 format.
         min_line_length (int): Minimum length of lines to be considered.
+        high_score, middle_score, low_score (int): Line sum thresholds of the border classification.
+        timings (dict): Optional dictionary where the time spent (ms) per step is accumulated.
+        gray (img): Optional grayscale version of the image, if already computed.
+        lines (dict): Optional dictionary where the masks of the detected lines are stored
+                      ("horizontal" & "vertical"), e.g. to crop them off ('salvage_bordered_image').
 
     Returns:
         None
@@ -27,46 +74,54 @@ def detect_borders(image, min_line_length=100, iterations=2, kernel_len=30, edge
     height, width, color_depth = image.shape
 
     # Step 2: Convert to grayscale
-    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    with time_stage(timings, "border_grayscale"):
+        if gray is None:
+            gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
 
     # Step 3: Apply Canny Edge Detection
-    edges = cv2.Canny(gray, 50, 150, apertureSize=7) #3) #5)
+    with time_stage(timings, "border_canny"):
+        edges = cv2.Canny(gray, CANNY_LOW_THRESHOLD, CANNY_HIGH_THRESHOLD, apertureSize=CANNY_APERTURE) #3) #5)
 
-    # Step 4: Define kernels for vertical and horizontal line detection
-    vertical_kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (1, kernel_len))  # Tall, narrow kernel
-    horizontal_kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (kernel_len, 1))  # Wide, short kernel
+    with time_stage(timings, "border_morphology"):
+        # Step 4: Define kernels for vertical and horizontal line detection
+        vertical_kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (1, kernel_len))  # Tall, narrow kernel
+        horizontal_kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (kernel_len, 1))  # Wide, short kernel
 
-    # Step 5: Detect vertical and horizontal lines
-    vertical_lines = cv2.morphologyEx(edges, cv2.MORPH_OPEN, vertical_kernel, iterations=iterations)
-    horizontal_lines = cv2.morphologyEx(edges, cv2.MORPH_OPEN, horizontal_kernel, iterations=iterations)
+        # Step 5: Detect vertical and horizontal lines
+        vertical_lines = cv2.morphologyEx(edges, cv2.MORPH_OPEN, vertical_kernel, iterations=iterations)
+        horizontal_lines = cv2.morphologyEx(edges, cv2.MORPH_OPEN, horizontal_kernel, iterations=iterations)
 
-    # Step 6: Merge broken lines using dilation and closing
-    merged_vertical = cv2.morphologyEx(vertical_lines, cv2.MORPH_CLOSE, vertical_kernel, iterations=4)
-    merged_horizontal = cv2.morphologyEx(horizontal_lines, cv2.MORPH_CLOSE, horizontal_kernel, iterations=4)
+        # Step 6: Merge broken lines using dilation and closing
+        merged_vertical = cv2.morphologyEx(vertical_lines, cv2.MORPH_CLOSE, vertical_kernel, iterations=4)
+        merged_horizontal = cv2.morphologyEx(horizontal_lines, cv2.MORPH_CLOSE, horizontal_kernel, iterations=4)
 
-    # Combine the vertical and horizontal lines
-    combined_lines = cv2.addWeighted(merged_vertical, 1.0, merged_horizontal, 1.0, 0.0)
+        # Combine the vertical and horizontal lines
+        combined_lines = cv2.addWeighted(merged_vertical, 1.0, merged_horizontal, 1.0, 0.0)
 
     # Step 7: Filter out small line segments (one image at a time)
-    filtered_lines_v = np.zeros_like(merged_vertical)
-    filtered_lines_h = np.zeros_like(merged_horizontal)
-    for img, filtered_lines in zip([merged_vertical, merged_horizontal], [filtered_lines_v, filtered_lines_h]):
-        contours, _ = cv2.findContours(img, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-        for contour in contours:
-            x, y, w, h = cv2.boundingRect(contour)
-            if max(w, h) >= min_line_length:
-                cv2.drawContours(filtered_lines, [contour], -1, 255, thickness=cv2.FILLED)
-
-    # Combine the vertical and horizontal lines
-    filtered_lines = cv2.addWeighted(filtered_lines_v, 1.0, filtered_lines_h, 1.0, 0.0)
+    with time_stage(timings, "border_contours"):
+        filtered_lines_v = np.zeros_like(merged_vertical)
+        filtered_lines_h = np.zeros_like(merged_horizontal)
+        for img, filtered_lines in zip([merged_vertical, merged_horizontal], [filtered_lines_v, filtered_lines_h]):
+            contours, _ = cv2.findContours(img, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+            for contour in contours:
+                x, y, w, h = cv2.boundingRect(contour)
+                if max(w, h) >= min_line_length:
+                    cv2.drawContours(filtered_lines, [contour], -1, 255, thickness=cv2.FILLED)
+
+        # Combine the vertical and horizontal lines
+        filtered_lines = cv2.addWeighted(filtered_lines_v, 1.0, filtered_lines_h, 1.0, 0.0)
+        if lines is not None:
+            lines["horizontal"], lines["vertical"] = filtered_lines_h, filtered_lines_v
 
     # Step 8: Add filtered lines to the original image
     # - Emphasize the lines with dilations, and add them in red
-    dilation_kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (3, 3))
-    filtered_enlarged = cv2.dilate(filtered_lines.copy(), dilation_kernel, iterations=2)
-    output_image = gray.copy()
-    output_image = cv2.cvtColor(output_image, cv2.COLOR_GRAY2RGB) #cv2.COLOR_GRAY2BGR)
-    output_image[filtered_enlarged == 255] = [255, 0, 0]  # Red color for lines
+    with time_stage(timings, "border_overlay"):
+        dilation_kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (3, 3))
+        filtered_enlarged = cv2.dilate(filtered_lines.copy(), dilation_kernel, iterations=2)
+        output_image = gray.copy()
+        output_image = cv2.cvtColor(output_image, cv2.COLOR_GRAY2RGB) #cv2.COLOR_GRAY2BGR)
+        output_image[filtered_enlarged == 255] = [255, 0, 0]  # Red color for lines
 
     if debug and not CLOUD_DEPLOYMENT:
         # Debug Step: Visualize the results using matplotlib
@@ -98,18 +153,19 @@ def detect_borders(image, min_line_length=100, iterations=2, kernel_len=30, edge
 
 
     # Step 9: Count pixels near the edges
-    horizontal_line_sum, _ = count_border_pixels(filtered_lines_h, edge_width=int(height*edge_perc))
-    _, vertical_line_sum = count_border_pixels(filtered_lines_v, edge_width=int(width*edge_perc))
+    with time_stage(timings, "border_count"):
+        horizontal_line_sum, _ = count_border_pixels(filtered_lines_h, edge_width=int(height*edge_perc))
+        _, vertical_line_sum = count_border_pixels(filtered_lines_v, edge_width=int(width*edge_perc))
 
     # Step 10: Create a classification based on the border sums
     image_has_border = False
-    if horizontal_line_sum > 5000:
-        if vertical_line_sum > 100:
+    if horizontal_line_sum > high_score:
+        if vertical_line_sum > low_score:
             image_has_border = True
-    elif vertical_line_sum > 5000:
-        if horizontal_line_sum > 100:
+    elif vertical_line_sum > high_score:
+        if horizontal_line_sum > low_score:
             image_has_border = True
-    elif horizontal_line_sum > 1000 and vertical_line_sum > 1000:
+    elif horizontal_line_sum > middle_score and vertical_line_sum > middle_score:
         image_has_border = True
 
     # Step 10: Return the line sums for borders
@@ -120,6 +176,196 @@ def detect_borders(image, min_line_length=100, iterations=2, kernel_len=30, edge
     return image_has_border, (horizontal_line_sum, vertical_line_sum), output_image
 
 
+def detect_borders_cascade(image, edge_perc=0.3, debug=False, timings=None, gray=None, **kwargs):
+    """
+    Two-stage border detection. A cheap first stage looks for long straight lines
+    near the edges of a downscaled image, and decides the clear cases at once:
+    no line near any edge means no border, and lines across all four sides mean a frame.
+    Only the ambiguous images go through the full 'detect_borders' pipeline.
+
+    Args:
+        image (img): Input image in cv2 format.
+        edge_perc (float): Fraction of the image side considered as edge region.
+        debug (bool): Flag to print debug info.
+        timings (dict): Optional dictionary where the time spent (ms) per step is accumulated.
+        gray (img): Optional grayscale version of the image, if already computed.
+        kwargs: Extra parameters for the full 'detect_borders' stage.
+
+    Returns:
+        (bool, tuple, img): Same output as 'detect_borders'. The line sums are None
+                            when the fast stage took the decision.
+    """
+    if image is None:
+        print("Error: Unable to read the image at the specified path.")
+        return
+
+    with time_stage(timings, "border_grayscale"):
+        if gray is None:
+            gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    with time_stage(timings, "border_fast_stage"):
+        image_has_border = _fast_border_check(gray, edge_perc=edge_perc, debug=debug)
+
+    if image_has_border is None:
+        with _cascade_stats_lock:
+            CASCADE_STATS["full"] += 1
+        return detect_borders(image, edge_perc=edge_perc, debug=debug, timings=timings, gray=gray, **kwargs)
+
+    with _cascade_stats_lock:
+        CASCADE_STATS["fast_border" if image_has_border else "fast_no_border"] += 1
+    output_image = cv2.cvtColor(gray, cv2.COLOR_GRAY2RGB)
+    return image_has_border, (None, None), output_image
+
+
+def _fast_border_check(gray, edge_perc=0.3, debug=False):
+    """
+    Look for long horizontal and vertical lines near the edges of a small copy of the image.
+
+    Args:
+        gray (img): Grayscale image.
+        edge_perc (float): Fraction of the image side considered as edge region.
+
+    Returns:
+        bool or None: True/False if the image clearly has/hasn't a border, None if unsure.
+    """
+    height, width = gray.shape
+    small_h = max(1, int(round(height * FAST_STAGE_WIDTH / width)))
+    small = cv2.resize(gray, (FAST_STAGE_WIDTH, small_h), interpolation=cv2.INTER_AREA)
+    # Same Canny parameters as the full detector, with the thresholds scaled to the small image:
+    # downscaling makes the intensity ramps (and so the gradients) steeper by the same factor.
+    scale = width / FAST_STAGE_WIDTH
+    edges = cv2.Canny(small, CANNY_LOW_THRESHOLD * scale, CANNY_HIGH_THRESHOLD * scale, apertureSize=CANNY_APERTURE)
+
+    # Keep only straight segments longer than the minimum line length.
+    h_len = max(3, int(FAST_STAGE_WIDTH * FAST_MIN_LINE_PERC))
+    v_len = max(3, int(small_h * FAST_MIN_LINE_PERC))
+    h_lines = cv2.morphologyEx(edges, cv2.MORPH_OPEN, cv2.getStructuringElement(cv2.MORPH_RECT, (h_len, 1)))
+    v_lines = cv2.morphologyEx(edges, cv2.MORPH_OPEN, cv2.getStructuringElement(cv2.MORPH_RECT, (1, v_len)))
+
+    # Longest line coverage per row (cols) within each edge region.
+    band_h = max(1, int(small_h * edge_perc))
+    band_w = max(1, int(FAST_STAGE_WIDTH * edge_perc))
+    row_coverage = (h_lines > 0).mean(axis=1)
+    col_coverage = (v_lines > 0).mean(axis=0)
+    top, bottom = row_coverage[:band_h].max(), row_coverage[-band_h:].max()
+    left, right = col_coverage[:band_w].max(), col_coverage[-band_w:].max()
+
+    if debug:
+        print(f"Fast stage coverage. Top: {top:.2f}, Bottom: {bottom:.2f}, Left: {left:.2f}, Right: {right:.2f}")
+
+    # No line of the min length near any edge.
+    if max(top, bottom) < h_len / FAST_STAGE_WIDTH and max(left, right) < v_len / small_h:
+        return False
+    if min(top, bottom, left, right) > FAST_BORDER_COVERAGE:
+        return True
+    return None
+
+
+def find_border_box(lines, max_crop_perc=SALVAGE_MAX_CROP_PERC, min_coverage=SALVAGE_MIN_COVERAGE,
+                    margin=SALVAGE_MARGIN):
+    """
+    Find the area inside the border lines found by 'detect_borders': the innermost long
+    horizontal (vertical) line within the top & bottom (left & right) edge regions.
+
+    Args:
+        lines (dict): Line masks filled by 'detect_borders' ("horizontal" & "vertical").
+        max_crop_perc (float): Fraction of the image side searched for lines on each side.
+        min_coverage (float): Min fraction of the image side a line must span.
+        margin (int): Pixels kept off the lines, inwards.
+
+    Returns:
+        tuple or None: (x0, y0, x1, y1) box inside the lines, or None if no border line was found.
+    """
+    horizontal_lines, vertical_lines = lines["horizontal"], lines["vertical"]
+    height, width = horizontal_lines.shape
+
+    # Rows (cols) spanned by a line over most of the image width (height).
+    line_rows = np.flatnonzero((horizontal_lines > 0).mean(axis=1) >= min_coverage)
+    line_cols = np.flatnonzero((vertical_lines > 0).mean(axis=0) >= min_coverage)
+    band_h = int(height * max_crop_perc)
+    band_w = int(width * max_crop_perc)
+    top, bottom = line_rows[line_rows < band_h], line_rows[line_rows >= height - band_h]
+    left, right = line_cols[line_cols < band_w], line_cols[line_cols >= width - band_w]
+
+    y0 = top.max() + 1 + margin if len(top) else 0
+    y1 = bottom.min() - margin if len(bottom) else height
+    x0 = left.max() + 1 + margin if len(left) else 0
+    x1 = right.min() - margin if len(right) else width
+    if (x0, y0, x1, y1) == (0, 0, width, height):
+        return None
+    return int(x0), int(y0), int(x1), int(y1)
+
+
+def salvage_bordered_image(image, lines=None, min_area_perc=SALVAGE_MIN_AREA_PERC, debug=False, **kwargs):
+    """
+    Crop the border lines off an image, then crop it to its original aspect ratio (centered),
+    resize it back to its original size, and check it with 'detect_borders' again.
+    The check does not go through the cascade, so 'CASCADE_STATS' only count generated images.
+
+    Args:
+        image (img): Input image in cv2 format, with borders.
+        lines (dict): Line masks filled by the detection of the image ('lines' of 'detect_borders').
+                      Computed if missing, e.g. when the fast stage of the cascade took the decision.
+        min_area_perc (float): Min fraction of the image kept. Salvage fails if more is cropped.
+        debug (bool): Flag to print debug info.
+        kwargs: Extra parameters for 'find_border_box'.
+
+    Returns:
+        img or None: Salvaged image (same size as the input), or None if it could not be salvaged.
+    """
+    height, width = image.shape[:2]
+    if not lines:
+        lines = {}
+        detect_borders(image, lines=lines)
+    box = find_border_box(lines, **kwargs)
+    if box is None:
+        if debug:
+            print("Salvage: no border lines found.")
+        return None
+    x0, y0, x1, y1 = box
+
+    # Crop to the original aspect ratio, centered within the box.
+    aspect = width / height
+    crop_w, crop_h = x1 - x0, y1 - y0
+    if crop_w / crop_h > aspect:
+        new_w = int(round(crop_h * aspect))
+        x0 += (crop_w - new_w) // 2
+        x1 = x0 + new_w
+    else:
+        new_h = int(round(crop_w / aspect))
+        y0 += (crop_h - new_h) // 2
+        y1 = y0 + new_h
+    area_perc = (x1 - x0) * (y1 - y0) / (width * height)
+    if area_perc < min_area_perc:
+        if debug:
+            print(f"Salvage: crop {(x0, y0, x1, y1)} keeps {area_perc:.0%} of the image only.")
+        return None
+
+    salvaged = cv2.resize(image[y0:y1, x0:x1], (width, height), interpolation=cv2.INTER_CUBIC)
+    img_has_borders, borders_sum, _ = detect_borders(salvaged)
+    if debug:
+        print(f"Salvage: crop {(x0, y0, x1, y1)}, has borders after crop: {img_has_borders}, sum: {borders_sum}")
+    return None if img_has_borders else salvaged
+
+
+def get_cascade_stats():
+    """
+    Get how many images each stage of 'detect_borders_cascade' decided, and the
+    share of images that needed the full detector.
+    """
+    with _cascade_stats_lock:
+        stats = dict(CASCADE_STATS)
+    total = sum(stats.values())
+    stats["total"] = total
+    stats["full_rate"] = stats["full"] / total if total > 0 else 0
+    return stats
+
+
+def reset_cascade_stats():
+    with _cascade_stats_lock:
+        for stage in CASCADE_STATS:
+            CASCADE_STATS[stage] = 0
+
+
 def count_border_pixels(img, edge_width=500):
     """
     Count white pixels in the border regions of an image.
@@ -0,0 +1,280 @@
+import os
+import re
+import atexit
+import json
+import math
+import time
+import random
+import logging
+import threading
+from argparse import ArgumentParser
+
+# Blob with the border counts, shared by all instances.
+BORDER_STATS_BLOB = os.getenv("BORDER_STATS_BLOB", "stats/border_stats.json")
+# Time (secs) between saves of the counts of an instance, made by a background thread.
+BORDER_STATS_SAVE_SECS = int(os.getenv("BORDER_STATS_SAVE_SECS", 60))
+# Beta prior of the border rate of a parameter value (e.g. the "Cubist" style) with no data.
+BORDER_PRIOR_ALPHA = float(os.getenv("BORDER_PRIOR_ALPHA", 1))
+BORDER_PRIOR_BETA = float(os.getenv("BORDER_PRIOR_BETA", 3))
+# Weight (in pseudo-observations) of the parameter values in the prior of a combination.
+BORDER_COMBINATION_PRIOR_WEIGHT = float(os.getenv("BORDER_COMBINATION_PRIOR_WEIGHT", 4))
+# Scheduling: max share of flags left with borders, border rate from which attempts run
+# speculatively, min sampling weight of a combination, and candidate combinations per flag.
+SCHEDULE_MAX_BORDER_PROB = float(os.getenv("SCHEDULE_MAX_BORDER_PROB", 0.1))
+SCHEDULE_SPECULATIVE_RATE = float(os.getenv("SCHEDULE_SPECULATIVE_RATE", 0.5))
+SCHEDULE_MIN_WEIGHT = float(os.getenv("SCHEDULE_MIN_WEIGHT", 0.05))
+SCHEDULE_N_CANDIDATES = int(os.getenv("SCHEDULE_N_CANDIDATES", 8))
+
+PARAM_NAMES = ("element", "style", "color", "item")
+# Flag blob names: "<timestamp>_e_<element>_s_<style>_c_<color>_i_<item>[_hasborder][_salvaged].png".
+FLAG_NAME_PATTERN = re.compile(r"_e_(?P<element>.+)_s_(?P<style>.+)_c_(?P<color>.+)_i_(?P<item>.+?)"
+                               r"(?P<has_borders>_hasborder)?(?P<salvaged>_salvaged)?\.png$")
+
+
+class BorderStats:
+    """
+    Border counts per parameter value and per combination of the flags, to estimate the
+    border rate of a combination: the Beta posterior of its own counts, with a prior
+    centered on the border rates of its values (so new combinations borrow from similar ones).
+
+    Layout of the saved counts (keys are lowercase alphanumeric):
+        {"values": {"style=cubist": [n_flags, n_borders], ...},
+         "combinations": {"element|style|color|item": [n_flags, n_borders], ...}}
+    """
+
+    def __init__(self, counts=None):
+        self.counts = counts or {"values": {}, "combinations": {}}
+        # Counts not saved yet, added to the shared blob on 'save'.
+        self._unsaved = {"values": {}, "combinations": {}}
+        self._last_save = time.time()
+        self._lock = threading.Lock()
+
+    def record(self, img_params, has_borders):
+        """
+        Count a border detection result of a flag.
+        """
+        with self._lock:
+            for counts in (self.counts, self._unsaved):
+                for key in _value_keys(img_params):
+                    _add(counts["values"], key, 1, int(has_borders))
+                _add(counts["combinations"], _combination_key(img_params), 1, int(has_borders))
+
+    def border_rate(self, img_params):
+        """
+        Posterior mean of the border rate of a combination.
+        """
+        with self._lock:
+            value_rates = []
+            for key in _value_keys(img_params):
+                n, n_borders = self.counts["values"].get(key, (0, 0))
+                value_rates.append((n_borders + BORDER_PRIOR_ALPHA) / (n + BORDER_PRIOR_ALPHA + BORDER_PRIOR_BETA))
+            n, n_borders = self.counts["combinations"].get(_combination_key(img_params), (0, 0))
+        prior_rate = sum(value_rates) / len(value_rates)
+        return (n_borders + BORDER_COMBINATION_PRIOR_WEIGHT * prior_rate) / (n + BORDER_COMBINATION_PRIOR_WEIGHT)
+
+    def has_unsaved(self):
+        """
+        Whether there are counts recorded since the last save.
+        """
+        with self._lock:
+            return bool(self._unsaved["combinations"])
+
+    def save(self, blob_client, force=False):
+        """
+        Add the unsaved counts to the shared blob, with a conditional write so the counts
+        of concurrent instances are not lost. Also reloads the counts of other instances.
+        """
+        from azure.core import MatchConditions
+        from azure.core.exceptions import ResourceNotFoundError, ResourceModifiedError, ResourceExistsError
+        if not force and time.time() - self._last_save < BORDER_STATS_SAVE_SECS:
+            return False
+        with self._lock:
+            unsaved, self._unsaved = self._unsaved, {"values": {}, "combinations": {}}
+        try:
+            for _ in range(5):
+                try:
+                    downloader = blob_client.download_blob()
+                    counts, etag = json.loads(downloader.readall()), downloader.properties.etag
+                except ResourceNotFoundError:
+                    counts, etag = {"values": {}, "combinations": {}}, None
+                _merge(counts, unsaved)
+                try:
+                    if etag is None:
+                        blob_client.upload_blob(json.dumps(counts), overwrite=False)
+                    else:
+                        blob_client.upload_blob(json.dumps(counts), overwrite=True, etag=etag,
+                                                match_condition=MatchConditions.IfNotModified)
+                    break
+                except (ResourceModifiedError, ResourceExistsError):
+                    # Written by another instance meanwhile: merge again into its counts.
+                    continue
+            else:
+                raise RuntimeError("Border stats blob kept changing while saving.")
+        except Exception:
+            # Keep the counts for the next save.
+            with self._lock:
+                _merge(self._unsaved, unsaved)
+            raise
+        with self._lock:
+            # Counts recorded meanwhile are not in the blob yet.
+            _merge(counts, self._unsaved)
+            self.counts = counts
+            self._last_save = time.time()
+        return True
+
+
+def _normalize(value):
+    # Same characters as the flag blob names, so counts seeded from them match.
+    return re.sub(r'[^a-z0-9-]', '', str(value).lower())
+
+
+def _value_keys(img_params):
+    return [f"{name}={_normalize(img_params[name])}" for name in PARAM_NAMES]
+
+
+def _combination_key(img_params):
+    return "|".join(_normalize(img_params[name]) for name in PARAM_NAMES)
+
+
+def _add(counts, key, n, n_borders):
+    current = counts.get(key, (0, 0))
+    counts[key] = [current[0] + n, current[1] + n_borders]
+
+
+def _merge(counts, other):
+    for section in ("values", "combinations"):
+        section_counts = counts.setdefault(section, {})
+        for key, (n, n_borders) in other[section].items():
+            _add(section_counts, key, n, n_borders)
+
+
+# Shared stats, loaded on first use, and saved by a background thread.
+_border_stats = None
+_border_stats_lock = threading.Lock()
+_border_stats_saver = None
+
+
+def get_border_stats_blob_client():
+    try:
+        from flag_generation.clients import get_blob_service_client
+    except:
+        from clients import get_blob_service_client
+    container_name = os.getenv("BORDER_STATS_CONTAINER", os.getenv("CONTAINER_NAME"))
+    return get_blob_service_client().get_blob_client(container=container_name, blob=BORDER_STATS_BLOB)
+
+
+def get_border_stats():
+    """
+    Get the shared border stats, loading the saved counts on first use.
+    """
+    global _border_stats, _border_stats_saver
+    with _border_stats_lock:
+        if _border_stats is None:
+            counts = None
+            try:
+                counts = json.loads(get_border_stats_blob_client().download_blob().readall())
+            except Exception as e:
+                logging.warning(f"Border stats not loaded, starting from the prior: {str(e)}")
+            _border_stats = BorderStats(counts)
+        # Counts are saved in the background, so the requests never wait for the blob.
+        if _border_stats_saver is None:
+            _border_stats_saver = threading.Thread(target=_save_border_stats_loop, daemon=True)
+            _border_stats_saver.start()
+            atexit.register(save_border_stats, force=True)
+    return _border_stats
+
+
+def _save_border_stats_loop():
+    while True:
+        time.sleep(BORDER_STATS_SAVE_SECS)
+        if _border_stats.has_unsaved():
+            save_border_stats(force=True)
+
+
+def save_border_stats(force=False):
+    """
+    Save the unsaved counts of this instance (at most every 'BORDER_STATS_SAVE_SECS' unless forced).
+    Failures are logged only: the counts are kept for the next save.
+    """
+    try:
+        if _border_stats is None or not _border_stats.has_unsaved():
+            return False
+        return _border_stats.save(get_border_stats_blob_client(), force=force)
+    except Exception as e:
+        logging.warning(f"Failed to save border stats: {str(e)}")
+        return False
+
+
+def schedule_flag(elements, styles, colors, items, max_attempts, border_stats=None):
+    """
+    Choose the combination and the attempt budget of the next flag of a batch.
+    Combinations are sampled among a few random candidates, weighted by their chance of
+    coming out without borders, so chronically bordered combinations are picked less often.
+
+    Args:
+        elements (list[str]): A list of natural elements.
+        styles (list[str]): A list of primary image styles.
+        colors (list[str]): A list of primary colors.
+        items (list[str]): A list of additional animals or objects.
+        max_attempts (int): Max number of attempts per flag.
+        border_stats (BorderStats): Border stats. Defaults to the shared ones.
+
+    Returns:
+        (dict, float, int, int): Combination, its border rate, number of attempts and of parallel attempts.
+    """
+    border_stats = border_stats or get_border_stats()
+    candidates = []
+    for _ in range(SCHEDULE_N_CANDIDATES):
+        img_params = {"element": random.choice(elements), "style": random.choice(styles),
+                      "color": random.choice(colors), "item": random.choice(items)}
+        candidates.append((img_params, border_stats.border_rate(img_params)))
+    weights = [max(SCHEDULE_MIN_WEIGHT, 1 - border_rate) for _, border_rate in candidates]
+    img_params, border_rate = random.choices(candidates, weights=weights)[0]
+
+    # Fewest attempts that leave the flag with borders with prob <= 'SCHEDULE_MAX_BORDER_PROB'.
+    if border_rate <= SCHEDULE_MAX_BORDER_PROB:
+        n_attempts = 1
+    else:
+        n_attempts = math.ceil(math.log(SCHEDULE_MAX_BORDER_PROB) / math.log(min(border_rate, 0.99)))
+    n_attempts = max(1, min(max_attempts, n_attempts))
+    # Start a second attempt at once where borders are likely.
+    n_parallel = 2 if n_attempts > 1 and border_rate >= SCHEDULE_SPECULATIVE_RATE else 1
+    return img_params, border_rate, n_attempts, n_parallel
+
+
+def count_flag_blobs(container_client, name_starts_with=None):
+    """
+    Border counts of the flags already stored, from their blob names.
+    """
+    border_stats = BorderStats()
+    for blob in container_client.list_blobs(name_starts_with=name_starts_with):
+        match = FLAG_NAME_PATTERN.search(os.path.basename(blob.name))
+        if match:
+            # Salvaged flags were generated with borders.
+            has_borders = match.group("has_borders") is not None or match.group("salvaged") is not None
+            border_stats.record(match.groupdict(), has_borders)
+    return border_stats
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("-p", "--prefix", dest="prefix", default=None,
+                        help="Only count the flags under this blob prefix")
+    parser.add_argument("--dry_run", dest="dry_run", action="store_true",
+                        help="Print the counts without saving them")
+    args = parser.parse_args()
+
+    # Seed the shared stats with the flags generated so far (e.g. the first time it is enabled).
+    try:
+        from flag_generation.clients import get_blob_service_client
+    except:
+        from clients import get_blob_service_client
+    container_client = get_blob_service_client().get_container_client(os.getenv("CONTAINER_NAME"))
+    border_stats = count_flag_blobs(container_client, args.prefix)
+    n_flags = sum(n for n, _ in border_stats.counts["combinations"].values())
+    n_borders = sum(n_borders for _, n_borders in border_stats.counts["combinations"].values())
+    print(f"Counted {n_flags} flags, {n_borders} with borders, in {len(border_stats.counts['combinations'])} combinations.")
+    for key, (n, n_borders) in sorted(border_stats.counts["values"].items(), key=lambda kv: -kv[1][1] / kv[1][0]):
+        print(f"  {key}: {n_borders}/{n} with borders")
+    if not args.dry_run:
+        border_stats.save(get_border_stats_blob_client(), force=True)
@@ -0,0 +1,41 @@
+import os
+import threading
+
+# Clients are created on first use and reused across invocations of the same instance.
+# Their packages are imported on first use too, so light modules (e.g. 'idempotency')
+# can get the blob client without importing cv2 or openai.
+_openai_client = None
+_blob_service_client = None
+_http_session = None
+_clients_lock = threading.Lock()
+
+
+def get_openai_client():
+    global _openai_client
+    with _clients_lock:
+        if _openai_client is None:
+            from openai import AzureOpenAI
+            _openai_client = AzureOpenAI(
+                azure_endpoint = os.getenv("AZURE_OPENAI_ENDPOINT"),
+                api_key=os.getenv("AZURE_OPENAI_API_KEY"),
+                api_version="2024-02-01"
+            )
+    return _openai_client
+
+
+def get_blob_service_client():
+    global _blob_service_client
+    with _clients_lock:
+        if _blob_service_client is None:
+            from azure.storage.blob import BlobServiceClient
+            _blob_service_client = BlobServiceClient.from_connection_string(os.getenv("AZURE_STORAGE_CONNECTION_STRING"))
+    return _blob_service_client
+
+
+def get_http_session():
+    global _http_session
+    with _clients_lock:
+        if _http_session is None:
+            import requests
+            _http_session = requests.Session()
+    return _http_session
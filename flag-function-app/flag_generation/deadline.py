@@ -0,0 +1,145 @@
+import os
+import time
+import threading
+from collections import deque
+from concurrent.futures import Future, wait, FIRST_COMPLETED
+
+# Time budget (secs) of a request. Below the 230s an HTTP trigger may take to answer in Azure
+# (regardless of the 'functionTimeout' of host.json), so partial results still get back to the client.
+REQUEST_DEADLINE_SECS = float(os.getenv("REQUEST_DEADLINE_SECS", 210))
+# Max time (secs) per stage, within the remaining budget.
+OPENAI_TIMEOUT_SECS = float(os.getenv("OPENAI_TIMEOUT_SECS", 120))
+DOWNLOAD_TIMEOUT_SECS = float(os.getenv("DOWNLOAD_TIMEOUT_SECS", 60))
+UPLOAD_TIMEOUT_SECS = float(os.getenv("UPLOAD_TIMEOUT_SECS", 60))
+# Hedged downloads: a second request is sent when the first one is slower than this
+# percentile of the recent download latencies (or HEDGE_AFTER_SECS until there are enough samples).
+HEDGE_PERCENTILE = float(os.getenv("HEDGE_PERCENTILE", 95))
+HEDGE_AFTER_SECS = float(os.getenv("HEDGE_AFTER_SECS", 3))
+HEDGE_MIN_SAMPLES = 20
+
+
+class DeadlineExceeded(Exception):
+    """
+    The request ran out of its time budget.
+    """
+
+
+class Deadline:
+    """
+    Time budget of a request, carried through its stages. Every stage takes its
+    timeout from the remaining budget, so no single call can consume all of it.
+    """
+
+    def __init__(self, budget_secs=None):
+        """
+        Args:
+            budget_secs (float): Time budget (secs). Defaults to 'REQUEST_DEADLINE_SECS'.
+        """
+        self.budget_secs = budget_secs or REQUEST_DEADLINE_SECS
+        self.expires = time.monotonic() + self.budget_secs
+
+    def remaining(self):
+        return max(0.0, self.expires - time.monotonic())
+
+    def check(self, stage=""):
+        """
+        Raise 'DeadlineExceeded' if there is no time left for the stage.
+        """
+        if self.remaining() <= 0:
+            raise DeadlineExceeded(f"Request deadline of {self.budget_secs:.0f}s exceeded before stage '{stage}'.")
+
+    def timeout(self, stage_max_secs=None, stage=""):
+        """
+        Timeout (secs) of a stage: the remaining budget, capped by the stage max.
+        """
+        self.check(stage)
+        remaining = self.remaining()
+        return min(remaining, stage_max_secs) if stage_max_secs else remaining
+
+
+class LatencyTracker:
+    """
+    Recent latencies of an operation, to compute a percentile.
+    """
+
+    def __init__(self, maxlen=200):
+        self._latencies = deque(maxlen=maxlen)
+        self._lock = threading.Lock()
+
+    def add(self, latency_secs):
+        with self._lock:
+            self._latencies.append(latency_secs)
+
+    def percentile(self, p, default=None):
+        with self._lock:
+            latencies = sorted(self._latencies)
+        if len(latencies) < HEDGE_MIN_SAMPLES:
+            return default
+        return latencies[min(len(latencies) - 1, int(len(latencies) * p / 100))]
+
+
+download_latencies = LatencyTracker()
+
+
+def hedged_get(session, url, timeout, hedge_after=None):
+    """
+    GET a URL, sending a second (hedged) request if the first one is slower than
+    'hedge_after'. The first successful response wins; the other one is left to finish.
+    Each request runs on its own thread, so no request waits behind others in a queue.
+
+    Args:
+        session (requests.Session): HTTP session.
+        url (str): URL to download.
+        timeout (float): Total time (secs) to wait for a response.
+        hedge_after (float): Time (secs) before hedging. Defaults to the 'HEDGE_PERCENTILE'
+                             of the recent downloads.
+
+    Returns:
+        bytes: Response content.
+
+    Raises:
+        requests.Timeout: No response within 'timeout'. The request deadline is left
+                          to 'Deadline.check', so the caller can still use the rest of it.
+    """
+    if hedge_after is None:
+        hedge_after = download_latencies.percentile(HEDGE_PERCENTILE, default=HEDGE_AFTER_SECS)
+    start = time.monotonic()
+
+    futures = {_start_get(session, url, timeout)}
+    done, _ = wait(futures, timeout=min(hedge_after, timeout))
+    if not done and time.monotonic() - start < timeout:
+        futures.add(_start_get(session, url, timeout))
+
+    last_error = None
+    while futures:
+        done, futures = wait(futures, timeout=max(0.0, timeout - (time.monotonic() - start)),
+                             return_when=FIRST_COMPLETED)
+        if not done:
+            break
+        for future in done:
+            if future.exception() is None:
+                content, latency_secs = future.result()
+                download_latencies.add(latency_secs)
+                return content
+            last_error = future.exception()
+    if last_error is not None and not futures:
+        raise last_error
+    from requests.exceptions import Timeout
+    raise Timeout(f"Download timed out after {timeout:.1f}s: {url}")
+
+
+def _start_get(session, url, timeout):
+    # Run a GET on a new thread. The result is the content and the latency of the request itself.
+    future = Future()
+
+    def get():
+        start = time.monotonic()
+        try:
+            response = session.get(url, timeout=timeout)
+            response.raise_for_status()
+            future.set_result((response.content, time.monotonic() - start))
+        except Exception as e:
+            future.set_exception(e)
+
+    threading.Thread(target=get, daemon=True).start()
+    return future
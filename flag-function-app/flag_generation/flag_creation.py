@@ -1,18 +1,77 @@
 import os
+import time
 import datetime
 import re
 import cv2
 import requests
 import random
+import threading
 import numpy as np
-from openai import AzureOpenAI
-from azure.storage.blob import BlobServiceClient
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 try:
-    from flag_generation.border_detection import detect_borders
+    from flag_generation.clients import get_openai_client, get_blob_service_client, get_http_session
+    from flag_generation.border_detection import (detect_borders, detect_borders_cascade, reset_cascade_stats,
+                                                  salvage_bordered_image)
+    from flag_generation.timing import time_stage, emit_timings
+    from flag_generation.upload_spool import UPLOAD_MODE, get_upload_spool
+    from flag_generation.deadline import (DeadlineExceeded, hedged_get, OPENAI_TIMEOUT_SECS,
+                                          DOWNLOAD_TIMEOUT_SECS, UPLOAD_TIMEOUT_SECS)
+    from flag_generation.border_stats import get_border_stats, schedule_flag
 except:
-    from border_detection import detect_borders
+    from clients import get_openai_client, get_blob_service_client, get_http_session
+    from border_detection import (detect_borders, detect_borders_cascade, reset_cascade_stats,
+                                  salvage_bordered_image)
+    from timing import time_stage, emit_timings
+    from upload_spool import UPLOAD_MODE, get_upload_spool
+    from deadline import (DeadlineExceeded, hedged_get, OPENAI_TIMEOUT_SECS,
+                          DOWNLOAD_TIMEOUT_SECS, UPLOAD_TIMEOUT_SECS)
+    from border_stats import get_border_stats, schedule_flag
+
+# Use the cascaded border detector (cheap first stage) when enabled.
+BORDER_DETECTION_CASCADE = os.getenv("BORDER_DETECTION_CASCADE")
+# Date partition of the flag blobs, as a strftime format (e.g. "flags/%Y/%m/%d/").
+# Flags are stored at the container root when unset.
+FLAG_BLOB_PREFIX_FORMAT = os.getenv("FLAG_BLOB_PREFIX_FORMAT", "")
+# Attempts run at once per flag (speculative attempts). The first flag without borders wins.
+SPECULATIVE_ATTEMPTS = int(os.getenv("SPECULATIVE_ATTEMPTS", 1))
+# Let the outstanding attempts finish and store their flags (inventory), instead of cancelling them.
+SPECULATIVE_KEEP_EXTRA = os.getenv("SPECULATIVE_KEEP_EXTRA")
+# Count the border rate per combination, and use it to schedule the combinations & attempts of a batch.
+ADAPTIVE_SCHEDULING = os.getenv("ADAPTIVE_SCHEDULING")
+# Crop the border lines off flags with borders (and keep them if no borders are detected
+# after the crop), instead of paying for a new generation.
+BORDER_SALVAGE = os.getenv("BORDER_SALVAGE")
+
+
+def warm_up() -> dict:
+    """
+    Create the clients and run the border detectors once on a synthetic image, so the
+    first request does not pay for the imports, client setup and OpenCV initialization.
 
-def create_batch_flags(n_flags: int, elements: list[str], styles: list[str], colors: list[str], items: list[str], n_attempts: bool = 1) -> list:
+    Returns:
+        dict: Time (ms) spent per warm-up stage.
+    """
+    timings = {}
+    with time_stage(timings, "clients"):
+        get_openai_client()
+        get_blob_service_client()
+        get_http_session()
+        # Recover the flags left in the upload journal by a previous instance.
+        if UPLOAD_MODE == "write_behind":
+            get_upload_spool()
+    with time_stage(timings, "detectors"):
+        image = np.zeros((1024, 1792, 3), dtype=np.uint8)
+        cv2.rectangle(image, (40, 40), (1752, 984), (255, 255, 255), 8)
+        image = cv2.imdecode(cv2.imencode(".png", image)[1], cv2.IMREAD_COLOR)
+        detect_borders(image)
+        detect_borders_cascade(image)
+        # Keep the cascade stats for real images only.
+        reset_cascade_stats()
+    return timings
+
+
+def create_batch_flags(n_flags: int, elements: list[str], styles: list[str], colors: list[str], items: list[str], n_attempts: bool = 1,
+                       timings: list = None, deadline=None, n_parallel: int = None, adaptive: bool = None) -> list:
     """
     Creates a batch of flags randomly using the given elements, styles, colors, and items.
 
@@ -24,29 +83,74 @@ def create_batch_flags(n_flags: int, elements: list[str], styles: list[str], col
         items (list[str]): A list of additional animals or objects to be included.
         n_attempts (int): The number of attempts to generate an image
                           if borders are detected.
+        timings (list): Optional list where the stage timings of each flag are appended.
+        deadline (Deadline): Optional request deadline. The flags created before it
+                             runs out are returned, even if fewer than 'n_flags'.
+        n_parallel (int): The number of attempts run at once per flag.
+                          Defaults to 'SPECULATIVE_ATTEMPTS'.
+        adaptive (bool): Whether combinations are picked by their border rate, with
+                         'n_attempts' as the max number of attempts of a flag (fewer for
+                         combinations that rarely have borders, and speculative attempts
+                         for the ones that often have). Defaults to 'ADAPTIVE_SCHEDULING'.
 
     Returns:
         list: A list of public URLs of the stored images in Azure Blob Storage.
     """
     try:
+        adaptive = bool(ADAPTIVE_SCHEDULING) if adaptive is None else adaptive
         batch_flags = []
+        flag_secs = 0
         for i in range(n_flags):
-            element = random.choice(elements)
-            style = random.choice(styles)
-            color = random.choice(colors)
-            item = random.choice(items)
-            flag_url = generate_flag_wout_borders(element, style, color, item, n_attempts)
+            # Stop when the remaining budget is not enough for another flag like the last one.
+            if deadline is not None and batch_flags and deadline.remaining() < flag_secs:
+                print(f"Request deadline close: returning {len(batch_flags)} of {n_flags} flags.")
+                break
+            flag_start = time.perf_counter()
+            flag_timings = {} if timings is not None else None
+            flag_n_attempts, flag_n_parallel = n_attempts, n_parallel
+            if adaptive:
+                img_params, border_rate, flag_n_attempts, scheduled_n_parallel = schedule_flag(
+                    elements, styles, colors, items, n_attempts)
+                element, style, color, item = (img_params[k] for k in ("element", "style", "color", "item"))
+                flag_n_parallel = n_parallel or scheduled_n_parallel
+                if flag_timings is not None:
+                    flag_timings["schedule"] = {"border_rate": round(border_rate, 3), "n_attempts": flag_n_attempts,
+                                                "n_parallel": flag_n_parallel}
+            else:
+                element = random.choice(elements)
+                style = random.choice(styles)
+                color = random.choice(colors)
+                item = random.choice(items)
+            try:
+                flag_url = generate_flag_wout_borders(element, style, color, item, flag_n_attempts, timings=flag_timings,
+                                                      deadline=deadline, n_parallel=flag_n_parallel,
+                                                      record_stats=adaptive)
+            except DeadlineExceeded:
+                if not batch_flags:
+                    raise
+                print(f"Request deadline exceeded: returning {len(batch_flags)} of {n_flags} flags.")
+                break
             batch_flags.append(flag_url)
+            flag_secs = time.perf_counter() - flag_start
+            if timings is not None:
+                timings.append(flag_timings)
         return batch_flags
 
+    except DeadlineExceeded:
+        raise
     except Exception as e:
         raise RuntimeError(f"Failed to generate batch of flags: {str(e)}")
 
 
-def generate_flag_wout_borders(element: str, style: str, color: str, item: str, n_attempts: bool = 3) -> str:
+def generate_flag_wout_borders(element: str, style: str, color: str, item: str, n_attempts: bool = 3,
+                               timings: dict = None, deadline=None, n_parallel: int = None,
+                               keep_extra: bool = None, record_stats: bool = None) -> str:
     """
     Generates an OpenAI image for a flag, recreates it until no borders are detected,
     and stores it in Azure Blob Storage.
+    With 'n_parallel' > 1, attempts run speculatively: up to 'n_parallel' at once, and the
+    first flag without borders is returned, so border-prone combinations take about one
+    generation time instead of several.
 
     Args:
         element (str): A natural element to include in the flag.
@@ -55,43 +159,186 @@ def generate_flag_wout_borders(element: str, style: str, color: str, item: str,
         item (str): An additional animal or object to be included.
         n_attempts (int): The number of attempts to generate an image
                           if borders are detected.
+        timings (dict): Optional dictionary where the total time and the
+                        stage timings of every attempt are recorded.
+        deadline (Deadline): Optional request deadline. No new attempt is started if the
+                             remaining budget is shorter than the last attempt.
+        n_parallel (int): The number of attempts run at once. Defaults to 'SPECULATIVE_ATTEMPTS'.
+        keep_extra (bool): Whether the attempts still running when a flag without borders is
+                           found are kept (stored as inventory) or cancelled.
+                           Defaults to 'SPECULATIVE_KEEP_EXTRA'.
+        record_stats (bool): Whether the border detection results are counted in the border
+                             stats of adaptive scheduling. Defaults to 'ADAPTIVE_SCHEDULING'.
 
     Returns:
         str: The public URL of the stored image in Azure Blob Storage.
     """
     try:
-        for _ in range(n_attempts):
-            stored_image_url, img_has_borders = generate_and_store_flag(element, style, color, item)
+        start = time.perf_counter()
+        attempt_timings = []
+        if timings is not None:
+            timings["attempts"] = attempt_timings
+        n_parallel = min(n_parallel or SPECULATIVE_ATTEMPTS, n_attempts)
+        if n_parallel > 1:
+            keep_extra = bool(SPECULATIVE_KEEP_EXTRA) if keep_extra is None else keep_extra
+            stored_image_url = generate_flag_speculative(element, style, color, item, n_attempts, n_parallel,
+                                                         keep_extra, attempt_timings, deadline=deadline,
+                                                         record_stats=record_stats)
+            if timings is not None:
+                timings["total"] = round((time.perf_counter() - start) * 1000, 3)
+            return stored_image_url
+
+        for attempt_i in range(n_attempts):
+            attempt_start = time.perf_counter()
+            stage_timings = {} if timings is not None else None
+            stored_image_url, img_has_borders = generate_and_store_flag(element, style, color, item, timings=stage_timings,
+                                                                        deadline=deadline, record_stats=record_stats)
+            if timings is not None:
+                attempt_timings.append(dict(stage_timings, has_borders=img_has_borders))
             if not img_has_borders:
-                return stored_image_url
+                break
+            # Keep the flag with borders rather than timing out on the next attempt.
+            if deadline is not None and deadline.remaining() < time.perf_counter() - attempt_start:
+                print(f"Request deadline close: keeping flag with borders after {attempt_i + 1} attempts.")
+                break
+        if timings is not None:
+            timings["total"] = round((time.perf_counter() - start) * 1000, 3)
         return stored_image_url
 
+    except DeadlineExceeded:
+        raise
     except Exception as e:
         raise RuntimeError(f"Failed to batch img generation & storage: {str(e)}")
 
 
-def generate_and_store_flag(element: str, style: str, color: str, item: str) -> str:
+def generate_flag_speculative(element: str, style: str, color: str, item: str, n_attempts: int, n_parallel: int,
+                              keep_extra: bool = False, attempt_timings: list = None, deadline=None,
+                              record_stats: bool = None) -> str:
     """
-    Generates an OpenAI image for a flag and stores it in Azure Blob Storage.
+    Runs up to 'n_parallel' attempts at once (and 'n_attempts' in total), and returns the
+    first flag without borders. The last flag with borders is returned if all of them have borders.
 
     Args:
         element (str): A natural element to include in the flag.
         style (str): The primary image style.
         color (str): The primary color of the flag.
         item (str): An additional animal or object to be included.
+        n_attempts (int): The total number of attempts.
+        n_parallel (int): The number of attempts run at once.
+        keep_extra (bool): Whether the outstanding attempts finish and store their flags
+                           once a winner is found. Otherwise they are cancelled before
+                           the download (the image generation itself cannot be cancelled).
+        attempt_timings (list): Optional list where the stage timings of every finished attempt are appended.
+        deadline (Deadline): Optional request deadline.
+        record_stats (bool): Whether the results are counted in the border stats. Defaults to 'ADAPTIVE_SCHEDULING'.
 
     Returns:
         str: The public URL of the stored image in Azure Blob Storage.
     """
+    cancel = None if keep_extra else threading.Event()
+    # Not used as a context manager: returning must not wait for the outstanding attempts.
+    executor = ThreadPoolExecutor(max_workers=n_parallel)
+    in_flight = {}
+    n_started = 0
+    stored_image_url, last_error = None, None
+    attempt_secs = 0
+
+    def start_attempt():
+        nonlocal n_started
+        n_started += 1
+        stage_timings = {}
+        future = executor.submit(generate_and_store_flag, element, style, color, item,
+                                 timings=stage_timings, deadline=deadline, cancel=cancel,
+                                 record_stats=record_stats)
+        in_flight[future] = (stage_timings, time.perf_counter())
+
     try:
+        for _ in range(n_parallel):
+            start_attempt()
+        while in_flight:
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                stage_timings, attempt_start = in_flight.pop(future)
+                try:
+                    image_url, img_has_borders = future.result()
+                except Exception as e:
+                    # A failed attempt does not fail the flag while other attempts may succeed.
+                    print(f"Speculative attempt failed: {str(e)}")
+                    last_error = e
+                    continue
+                attempt_secs = time.perf_counter() - attempt_start
+                if attempt_timings is not None:
+                    attempt_timings.append(dict(stage_timings, has_borders=img_has_borders))
+                if not img_has_borders:
+                    if cancel is not None:
+                        cancel.set()
+                    return image_url
+                stored_image_url = image_url
+            # Replace the finished attempts, while the budget allows it.
+            while n_started < n_attempts and len(in_flight) < n_parallel:
+                if deadline is not None and deadline.remaining() < attempt_secs:
+                    print(f"Request deadline close: no more attempts after {n_started}.")
+                    break
+                start_attempt()
+        if stored_image_url is None and last_error is not None:
+            raise last_error
+        return stored_image_url
+
+    finally:
+        executor.shutdown(wait=False)
+
+
+def generate_and_store_flag(element: str, style: str, color: str, item: str, timings: dict = None,
+                            deadline=None, cancel: threading.Event = None, record_stats: bool = None) -> str:
+    """
+    Generates an OpenAI image for a flag and stores it in Azure Blob Storage.
+
+    Args:
+        element (str): A natural element to include in the flag.
+        style (str): The primary image style.
+        color (str): The primary color of the flag.
+        item (str): An additional animal or object to be included.
+        timings (dict): Optional dictionary where the time spent (ms) per stage is
+                        recorded. Timings are always emitted as metrics in the logs.
+        deadline (Deadline): Optional request deadline. Each stage gets a timeout from
+                             the remaining budget, and the image download is hedged.
+        cancel (threading.Event): Optional event that stops the attempt (e.g. a speculative
+                                  attempt that lost) before the download and the upload.
+        record_stats (bool): Whether the border detection result is counted in the border
+                             stats of adaptive scheduling. Defaults to 'ADAPTIVE_SCHEDULING'.
+
+    Returns:
+        str: The public URL of the stored image in Azure Blob Storage,
+             or None if the attempt was cancelled.
+    """
+    if timings is None:
+        timings = {}
+    try:
+        start = time.perf_counter()
         # Create image.
-        image_url = create_flag(element, style, color, item)
+        with time_stage(timings, "openai_generation"):
+            image_url = create_flag(element, style, color, item, deadline=deadline)
+        if cancel is not None and cancel.is_set():
+            return None, None
         # Download the image.
-        image_data = requests.get(image_url).content
-        image = np.asarray(bytearray(image_data), dtype="uint8")
-        image = cv2.imdecode(image, cv2.IMREAD_COLOR)
+        with time_stage(timings, "download"):
+            if deadline is not None:
+                # Stalled downloads get a second request after a latency percentile.
+                image_data = hedged_get(get_http_session(), image_url,
+                                        deadline.timeout(DOWNLOAD_TIMEOUT_SECS, "download"))
+            else:
+                image_data = get_http_session().get(image_url).content
+        if deadline is not None:
+            deadline.check("detect_borders")
+        with time_stage(timings, "decode"):
+            image = np.asarray(bytearray(image_data), dtype="uint8")
+            image = cv2.imdecode(image, cv2.IMREAD_COLOR)
         # Detect borders.
-        img_has_borders, borders_sum, out_img = detect_borders(image)
+        with time_stage(timings, "detect_borders"):
+            detect_borders_algo = detect_borders_cascade if BORDER_DETECTION_CASCADE else detect_borders
+            # The line masks are kept, to crop the lines off if the flag is salvaged.
+            lines = {}
+            img_has_borders, borders_sum, out_img = detect_borders_algo(image, timings=timings, lines=lines)
         # Store img in azure.
         img_params = {
             "element": element,
@@ -99,14 +346,35 @@ def generate_and_store_flag(element: str, style: str, color: str, item: str) ->
             "color": color,
             "item": item
         }
-        stored_image_url = store_flag_image(image_data, img_params, img_has_borders)
+        record_stats = bool(ADAPTIVE_SCHEDULING) if record_stats is None else record_stats
+        if record_stats:
+            # Border rate per combination, saved to the shared stats in the background.
+            get_border_stats().record(img_params, img_has_borders)
+        # Salvage flags with borders by cropping them off.
+        img_salvaged = False
+        if img_has_borders and BORDER_SALVAGE:
+            with time_stage(timings, "salvage"):
+                salvaged_image = salvage_bordered_image(image, lines)
+            if salvaged_image is not None:
+                image_data = cv2.imencode(".png", salvaged_image)[1].tobytes()
+                img_has_borders, img_salvaged = False, True
+        if cancel is not None and cancel.is_set():
+            return None, None
+        with time_stage(timings, "upload"):
+            stored_image_url = store_flag_image(image_data, img_params, img_has_borders, deadline=deadline,
+                                                img_salvaged=img_salvaged)
+        timings["total"] = round((time.perf_counter() - start) * 1000, 3)
+        emit_timings("generate_and_store_flag", timings, has_borders=img_has_borders, salvaged=img_salvaged,
+                     **img_params)
         return stored_image_url, img_has_borders
 
+    except DeadlineExceeded:
+        raise
     except Exception as e:
         raise RuntimeError(f"Failed to generate and store image: {str(e)}")
 
 
-def create_flag(element: str, style: str, color: str, item: str) -> str:
+def create_flag(element: str, style: str, color: str, item: str, deadline=None) -> str:
     """
     Calls OpenAI's DALL·E to generate an image and returns the image data (bytes).
     
@@ -116,6 +384,7 @@ def create_flag(element: str, style: str, color: str, item: str) -> str:
         style (str): The primary image style.
         color (str): The primary color of the flag.
         item (str): An additional animal or object to be included.
+        deadline (Deadline): Optional request deadline, bounding the OpenAI call.
 
     Returns:
         bytes: The raw image data.
@@ -141,52 +410,67 @@ def create_flag(element: str, style: str, color: str, item: str) -> str:
         prompt = base_prompt + prompt
         # WHAT's NEW WITH DALL-E-3: https://cookbook.openai.com/articles/what_is_new_with_dalle_3
         
-        image_url = call_openai_img_endpoint(prompt)
+        image_url = call_openai_img_endpoint(prompt, deadline=deadline)
         return image_url
     
+    except DeadlineExceeded:
+        raise
     except Exception as e:
         raise RuntimeError(f"Failed to generate image: {str(e)}")
 
 
-def store_flag_image(image_data, img_params, img_has_borders=False) -> str:
+def store_flag_image(image_data, img_params, img_has_borders=False, deadline=None, img_salvaged=False) -> str:
     """
     Downloads an image from OpenAI and uploads it to Azure Blob Storage.
+    With 'UPLOAD_MODE=write_behind', the image is journaled to disk and uploaded
+    in the background, and the URL is returned at once.
 
     Args:
         image_data (img_data): The generated image in raw bytes format, ready
                                for Azure Storage.
+        deadline (Deadline): Optional request deadline, bounding the upload.
+        img_salvaged (bool): Whether the borders of the image were cropped off (see 'BORDER_SALVAGE').
 
     Returns:
         str: The public URL of the stored image in Azure Blob Storage.
     """
 
     try:
-        blob_url = os.getenv("AZURE_STORAGE_CONNECTION_STRING")
         storage_account = os.getenv("AZURE_STORAGE_ACCOUNT")
         container_name = os.getenv("CONTAINER_NAME")
 
         ## Download the image.
         #image_data = requests.get(image_url).content
         #image_name = "futuristic_city.png"
-        image_name = create_img_name(img_params, img_has_borders)
-
-        # Create a blob service client
-        blob_service_client = BlobServiceClient.from_connection_string(blob_url)
-        # Create a blob client using the local file name as the name for the blob
-        blob_client = blob_service_client.get_blob_client(container=container_name, blob=image_name)
-        # Upload the created file
-        blob_client.upload_blob(image_data, overwrite=True)
+        image_name = create_img_name(img_params, img_has_borders, img_salvaged)
+
+        if UPLOAD_MODE == "write_behind":
+            # Journal the image to disk, and upload it in the background.
+            get_upload_spool().put(container_name, image_name, image_data)
+        else:
+            # Get the shared blob service client
+            blob_service_client = get_blob_service_client()
+            # Create a blob client using the local file name as the name for the blob
+            blob_client = blob_service_client.get_blob_client(container=container_name, blob=image_name)
+            # Upload the created file
+            if deadline is not None:
+                blob_client.upload_blob(image_data, overwrite=True,
+                                        timeout=int(max(1, deadline.timeout(UPLOAD_TIMEOUT_SECS, "upload"))))
+            else:
+                blob_client.upload_blob(image_data, overwrite=True)
 
         # Construct the correct public URL
         blob_url = f"https://{storage_account}.blob.core.windows.net/{container_name}/{image_name}"
 
         return blob_url
     
+    except DeadlineExceeded:
+        raise
     except Exception as e:
         raise RuntimeError(f"Failed to store image: {str(e)}")
 
 
-def create_img_name(img_params, img_has_borders=False) -> str:
+def create_img_name(img_params, img_has_borders=False, img_salvaged=False) -> str:
     name = ""
     try:
         # Extract params.
@@ -195,25 +479,31 @@ def create_img_name(img_params, img_has_borders=False) -> str:
         color = img_params["color"]
         item = img_params["item"]
         # Create preliminary ID.
-        timestamp = datetime.datetime.now().strftime("%Y%m%d-%H%M%S-%f")
+        now = datetime.datetime.now()
+        timestamp = now.strftime("%Y%m%d-%H%M%S-%f")
         name = f"{timestamp}_E_{element}_S_{style}_C_{color}_I_{item}".lower()
         # Add border flag.
         if img_has_borders:
             name += "_hasborder".lower()
         # Remove spaces and special characters, keep alphanumeric, underscores, and hyphens.
             name = re.sub(r'[^a-z0-9_-]', '', name)
-        return f"{name}.png"
+        # Add salvage flag (borders cropped off).
+        if img_salvaged:
+            name += "_salvaged"
+        # Store the flag under its date partition, if any.
+        return f"{now.strftime(FLAG_BLOB_PREFIX_FORMAT)}{name}.png"
     except Exception as e:
         raise RuntimeError(f"Failed to create image name ({name}): {str(e)}")
 
 
-def call_openai_img_endpoint(prompt):
+def call_openai_img_endpoint(prompt, deadline=None):
     # Set Up OpenAI Endpoint
-    client = AzureOpenAI(
-        azure_endpoint = os.getenv("AZURE_OPENAI_ENDPOINT"), 
-        api_key=os.getenv("AZURE_OPENAI_API_KEY"),  
-        api_version="2024-02-01"
-    )
+    client = get_openai_client()
+    if deadline is not None:
+        # Bound the call by the remaining budget, with only the retries that fit in it.
+        timeout = deadline.timeout(OPENAI_TIMEOUT_SECS, "openai_generation")
+        max_retries = min(client.max_retries, max(0, int(deadline.remaining() // timeout) - 1))
+        client = client.with_options(timeout=timeout, max_retries=max_retries)
 
     response = client.images.generate(
         model="dall-e-3",
@@ -0,0 +1,170 @@
+import os
+import json
+import time
+import hashlib
+import logging
+import threading
+
+# Results of requests with an idempotency key are kept for this long (secs).
+IDEMPOTENCY_TTL_SECS = int(os.getenv("IDEMPOTENCY_TTL_SECS", 24 * 3600))
+# In-progress markers older than this (secs) belong to a dead invocation (see 'functionTimeout').
+IDEMPOTENCY_STALE_SECS = int(os.getenv("IDEMPOTENCY_STALE_SECS", 10 * 60))
+# Max time (secs) a duplicate request waits for the in-flight one, within its own request deadline.
+IDEMPOTENCY_WAIT_SECS = int(os.getenv("IDEMPOTENCY_WAIT_SECS", 3 * 60))
+# Blob prefix of the markers, shared by all instances.
+IDEMPOTENCY_PREFIX = "idempotency/"
+
+# In-process entries: key -> {"event", "result", "expires", "payload_hash"}. Duplicates on the same instance wait on the event.
+_entries = {}
+_entries_lock = threading.Lock()
+
+
+class IdempotencyInProgress(Exception):
+    """
+    A request with the same idempotency key is still running.
+    """
+
+
+class IdempotencyKeyMismatch(Exception):
+    """
+    The idempotency key was used before with different request params.
+    """
+
+
+def get_idempotency_key(req, req_body):
+    """
+    Idempotency key of a request, from the 'Idempotency-Key' header or the 'idempotency_key' body field.
+    """
+    key = req.headers.get("Idempotency-Key") or req_body.get("idempotency_key")
+    return (str(key).strip() or None) if key else None
+
+
+def get_payload_hash(req_body):
+    """
+    Hash of the request params (without the idempotency key), to detect keys reused with other params.
+    """
+    payload = {k: v for k, v in req_body.items() if k != "idempotency_key"}
+    return hashlib.sha256(json.dumps(payload, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def run_once(scope, key, work_f, payload_hash=None, deadline=None):
+    """
+    Run 'work_f' once per idempotency key. Duplicates get the stored result, or wait for
+    the in-flight request (on this instance, or on another one through blob markers).
+    Failed requests are not stored, so they can be retried.
+
+    Args:
+        scope (str): Endpoint name, so keys of different endpoints do not collide.
+        key (str): Idempotency key. 'work_f' is always run if None.
+        work_f (function): Work to run. Returns a json-serializable result.
+        payload_hash (str): Hash of the request params (see 'get_payload_hash'). A duplicate
+                            with another hash raises 'IdempotencyKeyMismatch'.
+        deadline (Deadline): Optional request deadline, bounding the wait for the in-flight request.
+
+    Returns:
+        (any, bool): Result & whether it was replayed from a previous request.
+    """
+    if not key:
+        return work_f(), False
+    full_key = f"{scope}:{key}"
+    wait_secs = IDEMPOTENCY_WAIT_SECS if deadline is None else min(IDEMPOTENCY_WAIT_SECS, deadline.remaining())
+
+    # Same instance: reuse or wait for the in-process entry.
+    with _entries_lock:
+        _evict_expired()
+        entry = _entries.get(full_key)
+        is_owner = entry is None
+        if is_owner:
+            entry = {"event": threading.Event(), "result": None, "expires": None, "payload_hash": payload_hash}
+            _entries[full_key] = entry
+    if not is_owner:
+        _check_payload_hash(key, entry["payload_hash"], payload_hash)
+        if not entry["event"].wait(wait_secs):
+            raise IdempotencyInProgress(f"Request with idempotency key '{key}' still in progress.")
+        if entry["expires"] is None:
+            raise IdempotencyInProgress(f"Request with idempotency key '{key}' failed. Retry it.")
+        return entry["result"], True
+
+    try:
+        # Other instances: claim the key with a blob marker.
+        result, replayed = _run_once_blob(full_key, work_f, payload_hash, wait_secs)
+        entry["result"], entry["expires"] = result, time.time() + IDEMPOTENCY_TTL_SECS
+        return result, replayed
+    except Exception:
+        # Failed: drop the entry, so a retry runs again.
+        with _entries_lock:
+            _entries.pop(full_key, None)
+        raise
+    finally:
+        entry["event"].set()
+
+
+def _check_payload_hash(key, stored_hash, payload_hash):
+    if stored_hash and payload_hash and stored_hash != payload_hash:
+        raise IdempotencyKeyMismatch(f"Idempotency key '{key}' was already used with different params.")
+
+
+def _run_once_blob(full_key, work_f, payload_hash=None, wait_secs=IDEMPOTENCY_WAIT_SECS):
+    from azure.core import MatchConditions
+    from azure.core.exceptions import ResourceExistsError, ResourceNotFoundError, ResourceModifiedError
+    try:
+        from flag_generation.clients import get_blob_service_client
+    except:
+        from clients import get_blob_service_client
+
+    container_name = os.getenv("IDEMPOTENCY_CONTAINER", os.getenv("CONTAINER_NAME"))
+    blob_name = f"{IDEMPOTENCY_PREFIX}{hashlib.sha256(full_key.encode()).hexdigest()}.json"
+    blob_client = get_blob_service_client().get_blob_client(container=container_name, blob=blob_name)
+    marker = json.dumps({"status": "in_progress", "created": time.time(), "payload_hash": payload_hash})
+
+    wait_until = time.time() + wait_secs
+    while True:
+        try:
+            blob_client.upload_blob(marker, overwrite=False)
+            break
+        except ResourceExistsError:
+            pass
+        # The key exists: replay the stored result, wait for it, or take over a stale marker.
+        try:
+            downloader = blob_client.download_blob()
+            record = json.loads(downloader.readall())
+        except ResourceNotFoundError:
+            continue
+        age = time.time() - record["created"]
+        if record["status"] == "done" and age < IDEMPOTENCY_TTL_SECS:
+            _check_payload_hash(full_key, record.get("payload_hash"), payload_hash)
+            return record["result"], True
+        if record["status"] == "done" or age > IDEMPOTENCY_STALE_SECS:
+            try:
+                blob_client.upload_blob(marker, overwrite=True, etag=downloader.properties.etag,
+                                        match_condition=MatchConditions.IfNotModified)
+                break
+            except ResourceModifiedError:
+                continue
+        _check_payload_hash(full_key, record.get("payload_hash"), payload_hash)
+        if time.time() + 2 > wait_until:
+            raise IdempotencyInProgress(f"Request with idempotency key '{full_key}' still in progress.")
+        time.sleep(2)
+
+    try:
+        result = work_f()
+    except Exception:
+        # Release the key, so a retry runs again.
+        try:
+            blob_client.delete_blob()
+        except Exception as e:
+            logging.warning(f"Failed to release idempotency key '{full_key}': {str(e)}")
+        raise
+    try:
+        blob_client.upload_blob(json.dumps({"status": "done", "created": time.time(), "result": result,
+                                            "payload_hash": payload_hash}), overwrite=True)
+    except Exception as e:
+        # The work is done: return it anyway. Other instances take over the key once the marker is stale.
+        logging.warning(f"Failed to store idempotency result '{full_key}': {str(e)}")
+    return result, False
+
+
+def _evict_expired():
+    now = time.time()
+    for full_key in [k for k, entry in _entries.items() if entry["expires"] is not None and entry["expires"] < now]:
+        del _entries[full_key]
@@ -0,0 +1,39 @@
+import json
+import time
+import logging
+from contextlib import contextmanager
+
+
+@contextmanager
+def time_stage(timings, stage):
+    """
+    Time a block of code and accumulate the elapsed milliseconds under 'stage'.
+
+    Args:
+        timings (dict): Dictionary where the stage timings are accumulated.
+                        If None, the block runs without being timed.
+        stage (str): Name of the stage being timed.
+    """
+    if timings is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        timings[stage] = round(timings.get(stage, 0.0) + elapsed_ms, 3)
+
+
+def emit_timings(event, timings, **dimensions):
+    """
+    Emit stage timings as a single structured log line, so they can be
+    queried as custom metrics in Application Insights.
+
+    Args:
+        event (str): Name of the measured operation (e.g. "generate_flag").
+        timings (dict): Stage timings in milliseconds.
+        dimensions: Extra key/value pairs attached to the metric (e.g. style).
+    """
+    metric = {"event": event, "timings_ms": timings, **dimensions}
+    logging.info(f"FLAG_TIMINGS {json.dumps(metric, default=str)}")
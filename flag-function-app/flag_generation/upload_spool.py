@@ -0,0 +1,270 @@
+import os
+import json
+import time
+import uuid
+import queue
+import socket
+import logging
+import tempfile
+import threading
+
+# Upload mode of the flags: "sync" (upload before answering) or "write_behind" (spool & upload in background).
+UPLOAD_MODE = os.getenv("UPLOAD_MODE", "sync")
+# Journal folder, shared by the instances (each one journals to its own subfolder).
+# Use a persistent path (e.g. under $HOME in Azure) to recover items after a restart.
+UPLOAD_SPOOL_DIR = os.getenv("UPLOAD_SPOOL_DIR", os.path.join(tempfile.gettempdir(), "flag_upload_spool"))
+# Number of concurrent background uploads.
+UPLOAD_SPOOL_WORKERS = int(os.getenv("UPLOAD_SPOOL_WORKERS", 4))
+# Attempts per item before leaving it in the journal until the next restart.
+UPLOAD_SPOOL_MAX_ATTEMPTS = int(os.getenv("UPLOAD_SPOOL_MAX_ATTEMPTS", 5))
+# Time (secs) without heartbeat after which the journal of an instance is recovered by another one.
+UPLOAD_SPOOL_STALE_SECS = int(os.getenv("UPLOAD_SPOOL_STALE_SECS", 300))
+# Name of the instance, in its journal subfolder.
+UPLOAD_SPOOL_INSTANCE = os.getenv("WEBSITE_INSTANCE_ID", socket.gethostname())[:16]
+HEARTBEAT_FN = ".alive"
+
+# Shared spool, started on first use.
+_upload_spool = None
+_upload_spool_lock = threading.Lock()
+
+
+class UploadSpool:
+    """
+    Write-behind blob uploads. Items are journaled to local disk before 'put' returns,
+    and background workers upload them with retries, then remove them from the journal.
+    Each spool journals to its own subfolder, with a heartbeat file touched while it runs.
+    The items of subfolders without heartbeat for 'UPLOAD_SPOOL_STALE_SECS' (e.g. after a
+    crash or restart) are recovered by the next spool started.
+
+    Layout:
+        <spool id>/.alive: Heartbeat of the spool.
+        <spool id>/<item id>.bin: Blob content.
+        <spool id>/<item id>.json: Container & blob name. Written last, so it marks a complete item.
+    """
+
+    def __init__(self, spool_dir=UPLOAD_SPOOL_DIR, n_workers=UPLOAD_SPOOL_WORKERS,
+                 max_attempts=UPLOAD_SPOOL_MAX_ATTEMPTS, upload_f=None):
+        """
+        Args:
+            spool_dir (str): Journal folder, shared by the spools.
+            n_workers (int): Number of concurrent uploads.
+            max_attempts (int): Attempts per item (with exponential backoff).
+            upload_f (function): Upload function (container, blob name, data). Defaults to Azure Blob Storage.
+        """
+        self.root_dir = spool_dir
+        self.spool_dir = os.path.join(spool_dir, f"{UPLOAD_SPOOL_INSTANCE}_{os.getpid()}_{uuid.uuid4().hex[:8]}")
+        self.n_workers = n_workers
+        self.max_attempts = max_attempts
+        self.upload_f = upload_f or _upload_blob
+        self.stats = {"spooled": 0, "uploaded": 0, "retries": 0, "failed": 0}
+        self._queue = queue.Queue()
+        self._stats_lock = threading.Lock()
+        self._n_waiting = 0
+        os.makedirs(self.spool_dir, exist_ok=True)
+        _touch(os.path.join(self.spool_dir, HEARTBEAT_FN))
+
+    def start(self):
+        """
+        Start the heartbeat & the background uploaders, and recover the stale journals.
+        """
+        threading.Thread(target=self._heartbeat, daemon=True).start()
+        for _ in range(self.n_workers):
+            threading.Thread(target=self._worker, daemon=True).start()
+        n_recovered = self.recover()
+        if n_recovered:
+            logging.info(f"Upload spool recovered {n_recovered} items into '{self.spool_dir}'.")
+        return self
+
+    def put(self, container_name, blob_name, data):
+        """
+        Journal a blob upload. It is durable once this returns.
+        """
+        item_id = uuid.uuid4().hex
+        _atomic_write(self._path(item_id, "bin"), data)
+        _atomic_write(self._path(item_id, "json"), json.dumps({"container": container_name, "blob": blob_name}).encode())
+        self._count("spooled")
+        self._queue.put((item_id, 1))
+        return item_id
+
+    def recover(self):
+        """
+        Move the complete items of the stale journals (and of the journal folder itself, from
+        older versions) into this spool, and enqueue them. Each item is claimed by renaming its
+        metadata file, so concurrent spools never recover the same item.
+        """
+        n_recovered = 0
+        stale_dirs = [self.root_dir]
+        for entry in os.scandir(self.root_dir):
+            if entry.is_dir() and entry.path != self.spool_dir and _is_stale(entry.path):
+                stale_dirs.append(entry.path)
+        for stale_dir in stale_dirs:
+            for fn in sorted(os.listdir(stale_dir)):
+                item_id, ext = os.path.splitext(fn)
+                if ext == ".json" and self._claim(stale_dir, item_id):
+                    self._queue.put((item_id, 1))
+                    n_recovered += 1
+            self._drop_stale_files(stale_dir)
+            if stale_dir != self.root_dir:
+                _remove(os.path.join(stale_dir, HEARTBEAT_FN))
+                try:
+                    os.rmdir(stale_dir)
+                except OSError:
+                    # Not empty: recent files are left for a later recovery.
+                    pass
+        return n_recovered
+
+    def _claim(self, stale_dir, item_id):
+        try:
+            os.rename(os.path.join(stale_dir, f"{item_id}.json"), self._path(item_id, "json"))
+        except FileNotFoundError:
+            # Claimed by another spool.
+            return False
+        try:
+            os.rename(os.path.join(stale_dir, f"{item_id}.bin"), self._path(item_id, "bin"))
+        except FileNotFoundError:
+            # Kept with its metadata: '_worker' reports it.
+            pass
+        return True
+
+    def _drop_stale_files(self, stale_dir):
+        # Temporary files & contents without metadata were never acknowledged, but may still
+        # be written by a live spool (e.g. a spool of an older version in the journal folder).
+        for entry in os.scandir(stale_dir):
+            item_id, ext = os.path.splitext(entry.name)
+            if ext not in (".tmp", ".bin") or not entry.is_file():
+                continue
+            if ext == ".bin" and os.path.exists(os.path.join(stale_dir, f"{item_id}.json")):
+                continue
+            try:
+                if time.time() - entry.stat().st_mtime > UPLOAD_SPOOL_STALE_SECS:
+                    _remove(entry.path)
+            except FileNotFoundError:
+                pass
+
+    def flush(self, timeout=None):
+        """
+        Wait until the queued items are uploaded (or gave up). Returns False on timeout.
+        """
+        deadline = time.time() + timeout if timeout is not None else None
+        while self.pending():
+            if deadline is not None and time.time() > deadline:
+                return False
+            time.sleep(0.05)
+        return True
+
+    def pending(self):
+        """
+        Number of items not uploaded yet (queued, uploading or waiting for a retry).
+        """
+        return self._queue.unfinished_tasks + self._n_waiting
+
+    def _worker(self):
+        while True:
+            item_id, attempt = self._queue.get()
+            try:
+                self._upload_item(item_id)
+                self._count("uploaded")
+            except FileNotFoundError as e:
+                if os.path.exists(self._path(item_id, "json")):
+                    # The metadata marks a complete item, so its content must not be missing.
+                    self._count("failed")
+                    logging.error(f"Spooled item {item_id} has no content, kept in the journal: {str(e)}")
+                # Otherwise already uploaded (e.g. queued twice).
+            except Exception as e:
+                if attempt < self.max_attempts:
+                    self._count("retries")
+                    delay = min(60, 2 ** attempt)
+                    logging.warning(f"Upload of spooled item {item_id} failed (attempt {attempt}), retrying in {delay}s: {str(e)}")
+                    self._retry_later(item_id, attempt + 1, delay)
+                else:
+                    self._count("failed")
+                    logging.error(f"Upload of spooled item {item_id} failed {attempt} times, kept in the journal: {str(e)}")
+            finally:
+                self._queue.task_done()
+
+    def _upload_item(self, item_id):
+        with open(self._path(item_id, "json"), "rb") as f:
+            meta = json.loads(f.read())
+        with open(self._path(item_id, "bin"), "rb") as f:
+            data = f.read()
+        self.upload_f(meta["container"], meta["blob"], data)
+        # Remove the metadata first: a content file alone is dropped on recovery.
+        _remove(self._path(item_id, "json"))
+        _remove(self._path(item_id, "bin"))
+
+    def _heartbeat(self):
+        while True:
+            time.sleep(UPLOAD_SPOOL_STALE_SECS / 4)
+            _touch(os.path.join(self.spool_dir, HEARTBEAT_FN))
+
+    def _retry_later(self, item_id, attempt, delay):
+        # Count the item as waiting until it is queued again, so 'flush' waits for it too.
+        with self._stats_lock:
+            self._n_waiting += 1
+        timer = threading.Timer(delay, self._requeue, args=(item_id, attempt))
+        timer.daemon = True
+        timer.start()
+
+    def _requeue(self, item_id, attempt):
+        self._queue.put((item_id, attempt))
+        with self._stats_lock:
+            self._n_waiting -= 1
+
+    def _path(self, item_id, ext):
+        return os.path.join(self.spool_dir, f"{item_id}.{ext}")
+
+    def _count(self, stat):
+        with self._stats_lock:
+            self.stats[stat] += 1
+
+
+def get_upload_spool():
+    """
+    Get the shared upload spool, recovering its journal and starting it on first use.
+    """
+    global _upload_spool
+    with _upload_spool_lock:
+        if _upload_spool is None:
+            _upload_spool = UploadSpool().start()
+    return _upload_spool
+
+
+def _upload_blob(container_name, blob_name, data):
+    try:
+        from flag_generation.clients import get_blob_service_client
+    except:
+        from clients import get_blob_service_client
+    blob_client = get_blob_service_client().get_blob_client(container=container_name, blob=blob_name)
+    blob_client.upload_blob(data, overwrite=True)
+
+
+def _atomic_write(path, data):
+    # Write & sync a temporary file first, so the journal never holds partial files.
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def _is_stale(spool_dir):
+    # Journal of a spool without heartbeat for 'UPLOAD_SPOOL_STALE_SECS'.
+    heartbeat_path = os.path.join(spool_dir, HEARTBEAT_FN)
+    try:
+        last_beat = os.path.getmtime(heartbeat_path if os.path.exists(heartbeat_path) else spool_dir)
+    except FileNotFoundError:
+        return False
+    return time.time() - last_beat > UPLOAD_SPOOL_STALE_SECS
+
+
+def _touch(path):
+    with open(path, "a"):
+        os.utime(path)
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
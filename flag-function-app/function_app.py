@@ -1,27 +1,47 @@
-import azure.functions as func
-import logging
-# Import the function from __init__.py
-from flag_generation import main as flag_generation_main
-from flag_generation import batch_flag_generation as flag_generation_batch
-
-app = func.FunctionApp()
-
-
-@app.function_name(name="generate_flag")
-@app.route(route="generate_flag", auth_level=func.AuthLevel.ANONYMOUS)
-def generate_flag(req: func.HttpRequest) -> func.HttpResponse:
-    """
-    Azure Function HTTP trigger that calls the correct function inside flag_generation/__init__.py.
-    """
-    logging.info("Processing request via function_app.py...")
-    return flag_generation_main(req)
-
-
-@app.function_name(name="generate_batch_flags")
-@app.route(route="generate_batch_flags", auth_level=func.AuthLevel.ANONYMOUS)
-def generate_batch_flags(req: func.HttpRequest) -> func.HttpResponse:
-    """
-    Azure Function HTTP trigger that calls the correct function inside flag_generation/__init__.py.
-    """
-    logging.info("Processing request via function_app.py...")
-    return flag_generation_batch(req)
+import os
+import threading
+import azure.functions as func
+import logging
+# Import the function from __init__.py
+from flag_generation import main as flag_generation_main
+from flag_generation import batch_flag_generation as flag_generation_batch
+from flag_generation import warm_up as flag_generation_warm_up
+
+app = func.FunctionApp()
+
+# Warm up every new instance in the background as soon as it loads (e.g. on scale-out).
+if os.getenv("WARMUP_ON_START"):
+    threading.Thread(target=flag_generation_warm_up, daemon=True).start()
+
+
+@app.function_name(name="generate_flag")
+@app.route(route="generate_flag", auth_level=func.AuthLevel.ANONYMOUS)
+def generate_flag(req: func.HttpRequest) -> func.HttpResponse:
+    """
+    Azure Function HTTP trigger that calls the correct function inside flag_generation/__init__.py.
+    """
+    logging.info("Processing request via function_app.py...")
+    return flag_generation_main(req)
+
+
+@app.function_name(name="generate_batch_flags")
+@app.route(route="generate_batch_flags", auth_level=func.AuthLevel.ANONYMOUS)
+def generate_batch_flags(req: func.HttpRequest) -> func.HttpResponse:
+    """
+    Azure Function HTTP trigger that calls the correct function inside flag_generation/__init__.py.
+    """
+    logging.info("Processing request via function_app.py...")
+    return flag_generation_batch(req)
+
+
+# Optional warm-up timer, e.g. WARMUP_SCHEDULE="0 */5 * * * *". Timers run on a single
+# instance, so use WARMUP_ON_START to warm up every scaled-out instance.
+if os.getenv("WARMUP_SCHEDULE"):
+    @app.function_name(name="warm_up")
+    @app.timer_trigger(schedule="%WARMUP_SCHEDULE%", arg_name="timer", run_on_startup=True)
+    def warm_up(timer: func.TimerRequest) -> None:
+        """
+        Azure Function timer trigger that preloads the modules, clients & border detectors.
+        """
+        logging.info("Warming up via function_app.py...")
+        flag_generation_warm_up()
@@ -0,0 +1,306 @@
+import os
+import json
+import math
+import time
+import random
+import threading
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Local run: no plotting, and no live Azure OpenAI / Blob Storage.
+os.environ.setdefault("CLOUD_DEPLOYMENT", "1")
+os.environ.setdefault("AZURE_OPENAI_API_KEY", "load-test")
+os.environ.setdefault("AZURE_STORAGE_ACCOUNT", "loadtest")
+os.environ.setdefault("CONTAINER_NAME", "flags")
+
+import cv2
+import numpy as np
+import azure.functions as func
+from azure.core.exceptions import ResourceExistsError, ResourceNotFoundError, ResourceModifiedError
+import flag_generation
+from flag_generation import clients
+
+
+class FakeImagesServer:
+    """
+    Local stand-in for the Azure OpenAI images endpoint and the image downloads.
+    Generations and downloads sleep a log-normal latency and fail with a given error rate.
+    Images are real PNGs (some of them with borders), so decoding & detection costs are real.
+    """
+
+    def __init__(self, generation_ms=8000, download_ms=300, sigma=0.3, error_rate=0.0,
+                 border_rate=0.3, n_images=8, port=0):
+        """
+        Args:
+            generation_ms (float): Median latency (ms) of an image generation.
+            download_ms (float): Median latency (ms) of an image download.
+            sigma (float): Sigma of the log-normal latencies (0 for constant latencies).
+            error_rate (float): Probability that a generation fails with a 500.
+            border_rate (float): Share of the served images that have borders.
+            n_images (int): Number of distinct images served.
+            port (int): Port of the server. A free one is picked if 0.
+        """
+        self.generation_ms = generation_ms
+        self.download_ms = download_ms
+        self.sigma = sigma
+        self.error_rate = error_rate
+        self.images = [_make_flag_png(has_borders=i < round(n_images * border_rate)) for i in range(n_images)]
+        self.stats = {"generations": 0, "downloads": 0, "errors": 0, "retries": 0}
+        self._lock = threading.Lock()
+
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                # e.g. /openai/deployments/dall-e-3/images/generations?api-version=...
+                self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                # Retries of the OpenAI SDK are flagged by this header.
+                if int(self.headers.get("x-stainless-retry-count", 0) or 0) > 0:
+                    server._count("retries")
+                server._sleep(server.generation_ms)
+                if random.random() < server.error_rate:
+                    server._count("errors")
+                    return self._send(500, b'{"error": {"message": "Fake generation error"}}', "application/json")
+                server._count("generations")
+                image_url = f"{server.url}/images/{random.randrange(len(server.images))}.png"
+                body = {"created": int(time.time()), "data": [{"url": image_url, "revised_prompt": ""}]}
+                self._send(200, json.dumps(body).encode(), "application/json")
+
+            def do_GET(self):
+                server._sleep(server.download_ms)
+                server._count("downloads")
+                image_i = int(self.path.split("/")[-1].split(".")[0])
+                self._send(200, server.images[image_i], "image/png")
+
+            def _send(self, status, body, content_type):
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", port), Handler)
+        self.httpd.daemon_threads = True
+        self.url = f"http://127.0.0.1:{self.httpd.server_address[1]}"
+
+    def start(self):
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+
+    def _sleep(self, median_ms):
+        if median_ms > 0:
+            time.sleep(random.lognormvariate(math.log(median_ms / 1000), self.sigma) if self.sigma else median_ms / 1000)
+
+    def _count(self, stat):
+        with self._lock:
+            self.stats[stat] += 1
+
+
+class FilesystemBlobServiceClient:
+    """
+    Local stand-in for 'BlobServiceClient': blobs are files under 'root_dir/<container>/<blob>'.
+    It covers the calls of the function app (uploads, downloads, conditional overwrites).
+    """
+
+    def __init__(self, root_dir):
+        self.root_dir = root_dir
+        self._lock = threading.Lock()
+
+    def get_blob_client(self, container, blob):
+        return FilesystemBlobClient(self, os.path.join(self.root_dir, container, blob))
+
+    def get_container_client(self, container):
+        return FilesystemContainerClient(self, container)
+
+
+class FilesystemContainerClient:
+
+    def __init__(self, service_client, container):
+        self.service_client = service_client
+        self.container = container
+
+    def get_blob_client(self, blob):
+        return self.service_client.get_blob_client(self.container, blob)
+
+
+class FilesystemBlobClient:
+
+    def __init__(self, service_client, path):
+        self.service_client = service_client
+        self.path = path
+
+    def upload_blob(self, data, overwrite=False, etag=None, match_condition=None, **kwargs):
+        if hasattr(data, "read"):
+            data = data.read()
+        if isinstance(data, str):
+            data = data.encode()
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        # The lock makes the existence & etag checks atomic with the write.
+        with self.service_client._lock:
+            if os.path.exists(self.path):
+                if not overwrite:
+                    raise ResourceExistsError(f"Blob already exists: {self.path}")
+                if etag is not None and etag != self._etag():
+                    raise ResourceModifiedError(f"Blob modified: {self.path}")
+            tmp_path = f"{self.path}.{threading.get_ident()}.tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, self.path)
+
+    def download_blob(self):
+        with self.service_client._lock:
+            try:
+                with open(self.path, "rb") as f:
+                    return FilesystemDownloader(f.read(), self._etag())
+            except FileNotFoundError:
+                raise ResourceNotFoundError(f"Blob not found: {self.path}")
+
+    def delete_blob(self):
+        with self.service_client._lock:
+            try:
+                os.remove(self.path)
+            except FileNotFoundError:
+                raise ResourceNotFoundError(f"Blob not found: {self.path}")
+
+    def _etag(self):
+        return str(os.stat(self.path).st_mtime_ns)
+
+
+class FilesystemDownloader:
+
+    def __init__(self, data, etag):
+        self.data = data
+        self.properties = type("BlobProperties", (), {"etag": etag})()
+
+    def readall(self):
+        return self.data
+
+
+def run_load_test(n_requests=50, concurrency=8, batch_size=0, n_attempts=1, idempotency_rate=0.0):
+    """
+    Call the function handlers concurrently and measure them.
+
+    Args:
+        n_requests (int): Total number of requests.
+        concurrency (int): Number of requests in flight.
+        batch_size (int): Flags per 'generate_batch_flags' request. 'generate_flag' is used if 0.
+        n_attempts (int): Attempts per flag of the batch endpoint.
+        idempotency_rate (float): Share of requests that repeat a previous idempotency key.
+
+    Returns:
+        dict: Report with throughput, latency percentiles and errors.
+    """
+    flag_params = {"element": "river", "style": "tribal", "color": "yellow", "item": "snake"}
+    if batch_size:
+        handler = flag_generation.batch_flag_generation
+        body = {"n_flags": batch_size, "n_attempts": n_attempts, **{f"{k}s": [v] for k, v in flag_params.items()}}
+    else:
+        handler = flag_generation.main
+        body = flag_params
+
+    def call(i):
+        headers = {}
+        if idempotency_rate:
+            # Repeated keys simulate client retries.
+            key_i = random.randrange(i) if i and random.random() < idempotency_rate else i
+            headers["Idempotency-Key"] = f"load-test-{key_i}"
+        req = func.HttpRequest(method="POST", url="/api/load_test", headers=headers,
+                               body=json.dumps(body).encode())
+        start = time.perf_counter()
+        try:
+            status_code = handler(req).status_code
+        except Exception:
+            status_code = "exception"
+        return status_code, (time.perf_counter() - start) * 1000
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(call, range(n_requests)))
+    elapsed = time.perf_counter() - start
+
+    latencies = np.array([latency_ms for status_code, latency_ms in results if status_code == 200])
+    errors = {}
+    for status_code, _ in results:
+        if status_code != 200:
+            errors[str(status_code)] = errors.get(str(status_code), 0) + 1
+    return {
+        "n_requests": n_requests,
+        "concurrency": concurrency,
+        "elapsed_s": round(elapsed, 3),
+        "throughput_rps": round(n_requests / elapsed, 3),
+        "flags_per_s": round(n_requests * max(batch_size, 1) / elapsed, 3),
+        "latency_ms": {
+            f"p{p}": round(float(np.percentile(latencies, p)), 1) for p in (50, 90, 99)
+        } if len(latencies) else {},
+        "errors": errors,
+    }
+
+
+def _make_flag_png(has_borders=False, width=1792, height=1024):
+    # Smooth random shapes on a plain background, like a simple flag.
+    image = np.full((height, width, 3), random.choice([(40, 90, 200), (30, 160, 60), (200, 200, 40)]), dtype=np.uint8)
+    for _ in range(6):
+        center = (random.randrange(width), random.randrange(height))
+        cv2.circle(image, center, random.randrange(60, 300), tuple(random.randrange(256) for _ in range(3)), -1)
+    if has_borders:
+        margin = int(height * 0.05)
+        cv2.rectangle(image, (margin, margin), (width - margin, height - margin), (255, 255, 255), 12)
+    return cv2.imencode(".png", image)[1].tobytes()
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("-n", "--requests", dest="n_requests", default=50, type=int,
+                        help="Total number of requests")
+    parser.add_argument("-c", "--concurrency", dest="concurrency", default=8, type=int,
+                        help="Number of requests in flight")
+    parser.add_argument("-b", "--batch_size", dest="batch_size", default=0, type=int,
+                        help="Flags per 'generate_batch_flags' request ('generate_flag' if 0)")
+    parser.add_argument("-a", "--attempts", dest="n_attempts", default=1, type=int,
+                        help="Attempts per flag of the batch endpoint")
+    parser.add_argument("--generation_ms", dest="generation_ms", default=8000, type=float,
+                        help="Median latency (ms) of a fake image generation")
+    parser.add_argument("--download_ms", dest="download_ms", default=300, type=float,
+                        help="Median latency (ms) of a fake image download")
+    parser.add_argument("--sigma", dest="sigma", default=0.3, type=float,
+                        help="Sigma of the log-normal latencies")
+    parser.add_argument("--error_rate", dest="error_rate", default=0.0, type=float,
+                        help="Probability of a failed fake generation")
+    parser.add_argument("--openai_retries", dest="openai_retries", default=0, type=int,
+                        help="Retries of the OpenAI client. With 0, the errors of the fake server reach the handlers as-is")
+    parser.add_argument("--border_rate", dest="border_rate", default=0.3, type=float,
+                        help="Share of fake images with borders")
+    parser.add_argument("--idempotency_rate", dest="idempotency_rate", default=0.0, type=float,
+                        help="Share of requests repeating a previous idempotency key")
+    parser.add_argument("--blob_dir", dest="blob_dir", default=".load_test_blobs",
+                        help="Folder of the filesystem blob backend")
+    parser.add_argument("-o", "--output", dest="output", default=None,
+                        help="File to write the JSON report")
+    args = parser.parse_args()
+
+    # Local stand-ins: fake images server for OpenAI & downloads, filesystem blob backend.
+    server = FakeImagesServer(args.generation_ms, args.download_ms, args.sigma, args.error_rate,
+                              args.border_rate).start()
+    os.environ["AZURE_OPENAI_ENDPOINT"] = server.url
+    # Built here (instead of by 'get_openai_client'), so SDK retries do not hide the injected errors.
+    from openai import AzureOpenAI
+    clients._openai_client = AzureOpenAI(azure_endpoint=server.url, api_key=os.getenv("AZURE_OPENAI_API_KEY"),
+                                         api_version="2024-02-01", max_retries=args.openai_retries)
+    clients._blob_service_client = FilesystemBlobServiceClient(args.blob_dir)
+
+    report = run_load_test(args.n_requests, args.concurrency, args.batch_size, args.n_attempts, args.idempotency_rate)
+    report["openai_retries"] = args.openai_retries
+    report["server"] = server.stats
+    server.stop()
+
+    print(json.dumps(report, indent=4))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=4)
@@ -1,20 +1,30 @@
 import os
 import cv2
 import numpy as np
+try:
+    from flag_generation.timing import time_stage
+except ImportError:
+    from contextlib import nullcontext
+    time_stage = lambda timings, stage: nullcontext()
 
 # Run without matplotlib when deployed in the cloud
 CLOUD_DEPLOYMENT = os.getenv("CLOUD_DEPLOYMENT")
 if not CLOUD_DEPLOYMENT:
     import matplotlib.pyplot as plt
 
+# Bump whenever the detection logic changes, so stored evaluation results are recomputed.
+DETECTOR_VERSION = "dev-1.0"
+
 def detect_borders(image, min_line_length=100, iterations=2, kernel_len=30, edge_perc=0.3,
-                           debug = False):
+                           debug = False, timings=None, gray=None):
     """
     Detect vertical and horizontal lines in an image, merging broken lines using morphological operations.
 
     Args:
         image_data (img): Input image in cv2 format.
         min_line_length (int): Minimum length of lines to be considered.
+        timings (dict): Optional dictionary where the time spent (ms) per step is accumulated.
+        gray (img): Optional grayscale version of the image, if already computed.
 
     Returns:
         None
@@ -27,46 +37,52 @@ def detect_borders(image, min_line_length=100, iterations=2, kernel_len=30, edge
     height, width, color_depth = image.shape
 
     # Step 2: Convert to grayscale
-    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    with time_stage(timings, "border_grayscale"):
+        if gray is None:
+            gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
 
     # Step 3: Apply Canny Edge Detection
-    edges = cv2.Canny(gray, 50, 150, apertureSize=7) #3) #5)
+    with time_stage(timings, "border_canny"):
+        edges = cv2.Canny(gray, 50, 150, apertureSize=7) #3) #5)
 
-    # Step 4: Define kernels for vertical and horizontal line detection
-    vertical_kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (1, kernel_len))  # Tall, narrow kernel
-    horizontal_kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (kernel_len, 1))  # Wide, short kernel
+    with time_stage(timings, "border_morphology"):
+        # Step 4: Define kernels for vertical and horizontal line detection
+        vertical_kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (1, kernel_len))  # Tall, narrow kernel
+        horizontal_kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (kernel_len, 1))  # Wide, short kernel
 
-    # Step 5: Detect vertical and horizontal lines
-    vertical_lines = cv2.morphologyEx(edges, cv2.MORPH_OPEN, vertical_kernel, iterations=iterations)
-    horizontal_lines = cv2.morphologyEx(edges, cv2.MORPH_OPEN, horizontal_kernel, iterations=iterations)
+        # Step 5: Detect vertical and horizontal lines
+        vertical_lines = cv2.morphologyEx(edges, cv2.MORPH_OPEN, vertical_kernel, iterations=iterations)
+        horizontal_lines = cv2.morphologyEx(edges, cv2.MORPH_OPEN, horizontal_kernel, iterations=iterations)
 
-    # Step 6: Merge broken lines using dilation and closing
-    merged_vertical = cv2.morphologyEx(vertical_lines, cv2.MORPH_CLOSE, vertical_kernel, iterations=4)
-    merged_horizontal = cv2.morphologyEx(horizontal_lines, cv2.MORPH_CLOSE, horizontal_kernel, iterations=4)
+        # Step 6: Merge broken lines using dilation and closing
+        merged_vertical = cv2.morphologyEx(vertical_lines, cv2.MORPH_CLOSE, vertical_kernel, iterations=4)
+        merged_horizontal = cv2.morphologyEx(horizontal_lines, cv2.MORPH_CLOSE, horizontal_kernel, iterations=4)
 
-    # Combine the vertical and horizontal lines
-    combined_lines = cv2.addWeighted(merged_vertical, 1.0, merged_horizontal, 1.0, 0.0)
+        # Combine the vertical and horizontal lines
+        combined_lines = cv2.addWeighted(merged_vertical, 1.0, merged_horizontal, 1.0, 0.0)
 
     # Step 7: Filter out small line segments (one image at a time)
-    filtered_lines_v = np.zeros_like(merged_vertical)
-    filtered_lines_h = np.zeros_like(merged_horizontal)
-    for img, filtered_lines in zip([merged_vertical, merged_horizontal], [filtered_lines_v, filtered_lines_h]):
-        contours, _ = cv2.findContours(img, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-        for contour in contours:
-            x, y, w, h = cv2.boundingRect(contour)
-            if max(w, h) >= min_line_length:
-                cv2.drawContours(filtered_lines, [contour], -1, 255, thickness=cv2.FILLED)
-
-    # Combine the vertical and horizontal lines
-    filtered_lines = cv2.addWeighted(filtered_lines_v, 1.0, filtered_lines_h, 1.0, 0.0)
+    with time_stage(timings, "border_contours"):
+        filtered_lines_v = np.zeros_like(merged_vertical)
+        filtered_lines_h = np.zeros_like(merged_horizontal)
+        for img, filtered_lines in zip([merged_vertical, merged_horizontal], [filtered_lines_v, filtered_lines_h]):
+            contours, _ = cv2.findContours(img, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+            for contour in contours:
+                x, y, w, h = cv2.boundingRect(contour)
+                if max(w, h) >= min_line_length:
+                    cv2.drawContours(filtered_lines, [contour], -1, 255, thickness=cv2.FILLED)
+
+        # Combine the vertical and horizontal lines
+        filtered_lines = cv2.addWeighted(filtered_lines_v, 1.0, filtered_lines_h, 1.0, 0.0)
 
     # Step 8: Add filtered lines to the original image
     # - Emphasize the lines with dilations, and add them in red
-    dilation_kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (3, 3))
-    filtered_enlarged = cv2.dilate(filtered_lines.copy(), dilation_kernel, iterations=2)
-    output_image = gray.copy()
-    output_image = cv2.cvtColor(output_image, cv2.COLOR_GRAY2RGB) #cv2.COLOR_GRAY2BGR)
-    output_image[filtered_enlarged == 255] = [255, 0, 0]  # Red color for lines
+    with time_stage(timings, "border_overlay"):
+        dilation_kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (3, 3))
+        filtered_enlarged = cv2.dilate(filtered_lines.copy(), dilation_kernel, iterations=2)
+        output_image = gray.copy()
+        output_image = cv2.cvtColor(output_image, cv2.COLOR_GRAY2RGB) #cv2.COLOR_GRAY2BGR)
+        output_image[filtered_enlarged == 255] = [255, 0, 0]  # Red color for lines
 
     if debug and not CLOUD_DEPLOYMENT:
         # Debug Step: Visualize the results using matplotlib
@@ -98,10 +114,11 @@ def detect_borders(image, min_line_length=100, iterations=2, kernel_len=30, edge
 
 
     # Step 9: Count pixels near the edges
-    _, _, top_sum, bottom_sum = _count_border_pixels(filtered_lines_h, edge_width=int(height*edge_perc))
-    horizontal_line_sum = top_sum + bottom_sum
-    left_sum, right_sum, _, _ = _count_border_pixels(filtered_lines_v, edge_width=int(width*edge_perc))
-    vertical_line_sum = left_sum + right_sum
+    with time_stage(timings, "border_count"):
+        _, _, top_sum, bottom_sum = _count_border_pixels(filtered_lines_h, edge_width=int(height*edge_perc))
+        horizontal_line_sum = top_sum + bottom_sum
+        left_sum, right_sum, _, _ = _count_border_pixels(filtered_lines_v, edge_width=int(width*edge_perc))
+        vertical_line_sum = left_sum + right_sum
 
     # Step 9.1: Create a classification based on the border sums
     # Algo Params: Border Detection.
@@ -116,20 +133,20 @@ def detect_borders(image, min_line_length=100, iterations=2, kernel_len=30, edge
     if horizontal_line_sum > high_score:
         if vertical_line_sum > low_score:
             #image_has_border = True
-            _, _, top_dev, bottom_dev = _get_px_dev_per_edge(image, edge_perc=narrow_edge_perc)
+            _, _, top_dev, bottom_dev = _get_px_dev_per_edge(image, edge_perc=narrow_edge_perc, gray=gray, timings=timings)
             print(f"Top Dev: {top_dev}, Bottom Dev: {bottom_dev}")
             if top_dev < threshold and bottom_dev < threshold:
                 image_has_border = True
     if vertical_line_sum > high_score:
         if horizontal_line_sum > low_score:
             #image_has_border = True
-            left_dev, right_dev, _, _ = _get_px_dev_per_edge(image, edge_perc=narrow_edge_perc)
+            left_dev, right_dev, _, _ = _get_px_dev_per_edge(image, edge_perc=narrow_edge_perc, gray=gray, timings=timings)
             print(f"Left Dev: {left_dev}, Right Dev: {right_dev}")
             if left_dev < threshold and right_dev < threshold:
                 image_has_border = True
     if horizontal_line_sum > middle_score and vertical_line_sum > middle_score:
         #image_has_border = True
-        left_dev, right_dev, top_dev, bottom_dev = _get_px_dev_per_edge(image, edge_perc=narrow_edge_perc)
+        left_dev, right_dev, top_dev, bottom_dev = _get_px_dev_per_edge(image, edge_perc=narrow_edge_perc, gray=gray, timings=timings)
         print(f"Left Dev: {left_dev}, Right Dev: {right_dev}, Top Dev: {top_dev}, Bottom Dev: {bottom_dev}")
         if (left_dev < threshold and right_dev < threshold) or (top_dev < threshold and bottom_dev < threshold):
             image_has_border = True
@@ -168,13 +185,20 @@ def _count_border_pixels(img, edge_width=500):
     )
 
 
-def _get_px_dev_per_edge(image, edge_perc=0.07, debug=False):
+def _get_px_dev_per_edge(image, edge_perc=0.07, debug=False, gray=None, timings=None):
+    with time_stage(timings, "border_edge_deviation"):
+        return _compute_px_dev_per_edge(image, edge_perc=edge_perc, gray=gray)
+
+
+def _compute_px_dev_per_edge(image, edge_perc=0.07, gray=None):
 
     # Read the image size
     height, width, color_depth = image.shape
 
     # Convert to grayscale if necessary
-    if color_depth == 3:
+    if gray is not None:
+        pass
+    elif color_depth == 3:
         gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
     elif color_depth == 1:
         gray = image
@@ -0,0 +1,162 @@
+import os
+import json
+import datetime
+import numpy as np
+from multiprocessing import Pool
+
+# Snapshot files: raw decoded images & label/index table.
+SNAPSHOT_IMAGES_FN = "images.u8"
+SNAPSHOT_INDEX_FN = "index.json"
+
+# Per-process snapshot opened by the pool initializer, shared through the page cache.
+_worker_snapshot = None
+
+
+def build_snapshot(img_stream, snapshot_dir, source=None, debug=False):
+    """
+    Freeze a stream of labeled images into a single file of decoded images that can be
+    memory-mapped, plus an index table with the image names, labels, shapes and offsets.
+    Images are stored at their own size (never resampled, as the detectors use absolute
+    pixel thresholds), and written one at a time, so memory stays bounded by one image.
+
+    Args:
+        img_stream (iterable): (img_name, image, annotation) tuples, e.g. from 'iter_imgs_from_azure'.
+        snapshot_dir (str): Folder where the snapshot is written.
+        source (str): Optional name of the export the labels come from (e.g. the export blob name).
+        debug (bool): Flag to print debug info.
+
+    Returns:
+        dict: The snapshot index.
+    """
+    try:
+        os.makedirs(snapshot_dir, exist_ok=True)
+        images_path = os.path.join(snapshot_dir, SNAPSHOT_IMAGES_FN)
+        index = {
+            "source": source,
+            "created": datetime.datetime.now().strftime("%Y%m%d_%H%M%S"),
+            "dtype": "uint8",
+            "n_bytes": 0,
+            "images": [],
+        }
+
+        with open(f"{images_path}.tmp", "wb") as f:
+            for img_name, image, img_annotation in img_stream:
+                image_bytes = np.ascontiguousarray(image, dtype=np.uint8).tobytes()
+                f.write(image_bytes)
+                index["images"].append({"name": img_name, "annotation": img_annotation,
+                                        "shape": list(image.shape), "offset": index["n_bytes"]})
+                index["n_bytes"] += len(image_bytes)
+                if debug:
+                    print(f"Snapshot image {len(index['images']):4}: '{img_name}' {tuple(image.shape)}.")
+        os.replace(f"{images_path}.tmp", images_path)
+
+        with open(os.path.join(snapshot_dir, SNAPSHOT_INDEX_FN), "w") as f:
+            json.dump(index, f, indent=4)
+
+        if debug:
+            print(f"Successfully created snapshot '{snapshot_dir}' with {len(index['images'])} images ({index['n_bytes']} bytes).")
+
+        return index
+
+    except Exception as e:
+        raise RuntimeError(f"Failed happen while building the dataset snapshot: {str(e)}")
+
+
+def load_snapshot(snapshot_dir):
+    """
+    Open a snapshot. Images are memory-mapped read-only, so nothing is decoded nor
+    copied into the process heap, and processes share the same page cache.
+
+    Args:
+        snapshot_dir (str): Folder of the snapshot.
+
+    Returns:
+        (np.memmap, dict): Flat array of the image bytes (see 'get_snapshot_image'), and the snapshot index.
+    """
+    with open(os.path.join(snapshot_dir, SNAPSHOT_INDEX_FN), "r") as f:
+        index = json.load(f)
+    if "n_bytes" not in index:
+        # Older snapshots: all images with the same shape, one after the other.
+        img_shape = index["shape"][1:]
+        img_n_bytes = int(np.prod(img_shape))
+        for i, img_info in enumerate(index["images"]):
+            img_info.update(shape=img_shape, offset=i * img_n_bytes)
+        index["n_bytes"] = len(index["images"]) * img_n_bytes
+    if index["n_bytes"] == 0:
+        return np.zeros(0, dtype=index["dtype"]), index
+    images = np.memmap(os.path.join(snapshot_dir, SNAPSHOT_IMAGES_FN), dtype=index["dtype"],
+                       mode="r", shape=(index["n_bytes"],))
+    return images, index
+
+
+def get_snapshot_image(images, img_info):
+    """
+    Image of a snapshot, as a read-only view of its memory-mapped bytes.
+
+    Args:
+        images (np.memmap): Flat array of the image bytes, from 'load_snapshot'.
+        img_info (dict): Index entry of the image.
+
+    Returns:
+        img: Image with its original shape.
+    """
+    n_bytes = int(np.prod(img_info["shape"]))
+    return images[img_info["offset"]:img_info["offset"] + n_bytes].reshape(img_info["shape"])
+
+
+def iter_snapshot(snapshot_dir):
+    """
+    Iterate over a snapshot, with the same output as 'iter_imgs_from_azure'.
+
+    Yields:
+        (str, img, bool): Image name, image and border annotation.
+    """
+    images, index = load_snapshot(snapshot_dir)
+    for img_info in index["images"]:
+        yield img_info["name"], get_snapshot_image(images, img_info), img_info["annotation"]
+
+
+def evaluate_snapshot_parallel(snapshot_dir, detect_borders_algo, n_workers=None, debug=False):
+    """
+    Score a border detection algorithm on a snapshot with several worker processes.
+    Every worker maps the same snapshot file instead of receiving copies of the images.
+
+    Args:
+        snapshot_dir (str): Folder of the snapshot.
+        detect_borders_algo (function): Algorithm to detect borders. Must be a module-level function.
+        n_workers (int): Number of worker processes. Defaults to the number of CPUs.
+        debug (bool): Flag to print debug info.
+
+    Returns:
+        (list, float): Mismatched image names and accuracy.
+    """
+    _, index = load_snapshot(snapshot_dir)
+    n_images = len(index["images"])
+    with Pool(processes=n_workers, initializer=_init_worker, initargs=(snapshot_dir,)) as pool:
+        predictions = pool.map(_predict_snapshot_image, [(i, detect_borders_algo) for i in range(n_images)],
+                               chunksize=max(1, n_images // (4 * (n_workers or os.cpu_count() or 1))))
+
+    mismatched_tasks = []
+    for img_info, prediction in zip(index["images"], predictions):
+        if img_info["annotation"] != prediction:
+            mismatched_tasks.append(img_info["name"])
+            if debug:
+                print(f"Mismatch for image {img_info['name']}: Annotation={img_info['annotation']}, Prediction={prediction}")
+
+    accuracy = (n_images - len(mismatched_tasks)) / n_images if n_images > 0 else 0
+    if debug:
+        print(f"Accuracy: {(accuracy*100):.1f}% ({n_images - len(mismatched_tasks)}/{n_images})")
+
+    return mismatched_tasks, accuracy
+
+
+def _init_worker(snapshot_dir):
+    global _worker_snapshot
+    _worker_snapshot = load_snapshot(snapshot_dir)
+
+
+def _predict_snapshot_image(args):
+    i, detect_borders_algo = args
+    images, index = _worker_snapshot
+    img_has_borders, _, _ = detect_borders_algo(np.asarray(get_snapshot_image(images, index["images"][i])))
+    return img_has_borders
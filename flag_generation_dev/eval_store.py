@@ -0,0 +1,95 @@
+import os
+import sys
+import json
+import hashlib
+import inspect
+
+# Default location of the evaluation results store.
+DEFAULT_EVAL_STORE_FN = "eval_store.jsonl"
+
+
+def hash_image_data(image_data):
+    """
+    Content hash of the raw (encoded) image bytes.
+    """
+    return hashlib.sha256(image_data).hexdigest()
+
+
+def get_detector_key(detect_borders_algo, params=None):
+    """
+    Identify a detector configuration: algorithm name, detector version and a hash of
+    its parameters (function defaults overwritten by 'params').
+
+    Args:
+        detect_borders_algo (function): Algorithm to detect borders.
+        params (dict): Parameters passed to the algorithm, if any.
+
+    Returns:
+        (str, str, str): Detector name, version and parameters hash.
+    """
+    detector_name = f"{detect_borders_algo.__module__}.{detect_borders_algo.__name__}"
+    module = sys.modules.get(detect_borders_algo.__module__)
+    detector_version = str(getattr(module, "DETECTOR_VERSION", "0"))
+
+    all_params = {
+        name: param.default
+        for name, param in inspect.signature(detect_borders_algo).parameters.items()
+        if param.default is not inspect.Parameter.empty and name not in ("debug", "timings", "gray")
+    }
+    all_params.update(params or {})
+    params_hash = hashlib.sha256(json.dumps(all_params, sort_keys=True, default=str).encode()).hexdigest()[:16]
+
+    return detector_name, detector_version, params_hash
+
+
+class EvalStore:
+    """
+    Append-only store of border detection results, keyed by
+    (image content hash, detector name, detector version, parameters hash).
+    It also remembers the content hash of every image name already seen.
+    """
+
+    def __init__(self, store_fn=DEFAULT_EVAL_STORE_FN):
+        self.store_fn = store_fn
+        self.results = {}
+        self.name_hashes = {}
+        if os.path.exists(store_fn):
+            with open(store_fn, "r") as f:
+                for line in f:
+                    if not line.strip():
+                        continue
+                    record = json.loads(line)
+                    if "image_name" in record:
+                        self.name_hashes[record["image_name"]] = record["image_hash"]
+                    else:
+                        self.results[self._key(record["image_hash"], record["detector"])] = record
+
+    def get(self, image_hash, detector_key):
+        """
+        Get the stored result for an image & detector, or None if not computed yet.
+        """
+        return self.results.get(self._key(image_hash, detector_key))
+
+    def put(self, image_hash, detector_key, has_borders, borders_sum=None):
+        record = {
+            "image_hash": image_hash,
+            "detector": list(detector_key),
+            "has_borders": bool(has_borders),
+            "borders_sum": [None if v is None else int(v) for v in borders_sum] if borders_sum else None,
+        }
+        self.results[self._key(image_hash, detector_key)] = record
+        self._append(record)
+
+    def put_name(self, image_name, image_hash):
+        if self.name_hashes.get(image_name) == image_hash:
+            return
+        self.name_hashes[image_name] = image_hash
+        self._append({"image_name": image_name, "image_hash": image_hash})
+
+    def _append(self, record):
+        with open(self.store_fn, "a") as f:
+            f.write(json.dumps(record) + "\n")
+
+    @staticmethod
+    def _key(image_hash, detector_key):
+        return (image_hash, *detector_key)
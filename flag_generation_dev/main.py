@@ -1,6 +1,7 @@
 import os
 import sys
 import json
+import time
 import datetime
 import cv2
 import numpy as np
@@ -13,12 +14,25 @@ flag_review_dir = os.path.abspath(os.path.join(parent_dir, 'flag_review'))
 if flag_review_dir not in sys.path:
     #sys.path.insert(0, flag_review_dir)
     sys.path.insert(1, flag_review_dir)
-from LS_export_data_manually import get_tasks_export_from_azure, TASK_NAME_F
+from LS_export_data_manually import iter_tasks_export_from_azure
+from blob_cache import BlobCache, iter_blobs, DEFAULT_CACHE_DIR
+from blob_layout import get_blob_name
+from dataset_snapshot import build_snapshot, iter_snapshot, evaluate_snapshot_parallel
+from eval_store import EvalStore, get_detector_key, hash_image_data
 # LOAD MODULES FROM FLAG FUNCTION APP "../flag-function-app/flag_generation/border_detection.py".
 flag_function_app_dir = os.path.abspath(os.path.join(parent_dir, 'flag-function-app'))
 if flag_function_app_dir not in sys.path:
     sys.path.insert(1, flag_function_app_dir)
-from flag_generation.border_detection import detect_borders
+from flag_generation.border_detection import detect_borders, detect_borders_cascade, get_cascade_stats, salvage_bordered_image
+# After the function app path, so the dev detector gets 'flag_generation.timing' (per-step timings).
+from border_detection_dev import detect_borders as detect_borders_dev
+
+# Detectors available for evaluation & A/B comparisons.
+DETECTORS = {
+    "prod": detect_borders,
+    "cascade": detect_borders_cascade,
+    "dev": detect_borders_dev,
+}
 
 ## DOES NOT WORK:
 ## from ..flag_review.LS_export_data_manually import get_tasks_export_from_azure, TASK_NAME_F
@@ -26,80 +40,105 @@ from flag_generation.border_detection import detect_borders
 # Load module from "../flag-function-app/flag_generation/border_detection.py".
 
 
-def load_imgs_from_azure(export_tasks_data, debug=False):
+def iter_labeled_tasks(export_tasks_data, debug=False):
     """
-    Load imgs from Azure and manual annotations.
+    Iterate over the labeled tasks, skipping tasks without annotations or
+    labeled as 'Unappealing flag'.
 
     Args:
-        export_tasks_data (list): List of tasks data from labelstudio.
+        export_tasks_data (iterable): Tasks data from labelstudio.
         debug (bool): Flag to print debug info.
 
-    Returns:
-        (dict, dict): Tuple of two dictionaries with loaded images and annotations, separately.
-        -- img_dict (dict): Dictionary of cv2 loaded images.
-        -- annotations_dict (dict): Dictionary of annotations.
+    Yields:
+        (int, dict, str, bool): Task position, task data, image name and border annotation.
+    """
+    for i,task_data in enumerate(export_tasks_data):
+        # Load img data.
+        img_url = task_data["data"]["image"]
+        img_name = get_blob_name(img_url, os.getenv("CONTAINER_NAME", ""))
+        # Skip if no annotations.
+        if len(task_data["annotations"]) == 0:
+            print(f"NOTE: Task {task_data['id']} has no annotations. We skip adding the image and the annotation.")
+            continue
+        img_annotation = task_data["annotations"][0]["result"][0]["value"]["choices"][0]
+        # Skip if unnappealing flag.
+        if img_annotation == "Unappealing flag":
+            print(f"NOTE: Task {task_data['id']} was considered 'Unappealing flag'. We skip adding the image and the annotation.")
+            continue
+        # Record the annotation as a True/False statement as in border detection algorithm.
+        img_annotation = img_annotation == "Has borders" #"Good flag"
+        yield i, task_data, img_name, img_annotation
+
+
+def iter_imgs_from_azure(export_tasks_data, debug=False, blob_cache=None, max_workers=8):
+    """
+    Stream the labeled imgs from Azure, one at a time, with their manual annotations.
+    Downloads run concurrently a few images ahead, and only those are kept in memory.
+
+    Args:
+        export_tasks_data (iterable): Tasks data from labelstudio.
+        debug (bool): Flag to print debug info.
+        blob_cache (BlobCache): Optional local cache, to avoid downloading the images again.
+        max_workers (int): Number of concurrent downloads.
+
+    Yields:
+        (str, img, bool): Image name, cv2 loaded image and border annotation.
     """
 
     try:
         blob_url = os.getenv("AZURE_STORAGE_CONNECTION_STRING")
-        storage_account = os.getenv("AZURE_STORAGE_ACCOUNT")
         container_name = os.getenv("CONTAINER_NAME")
-        labelstudio_folder = os.getenv("LABELSTUDIO_SUBFOLDER")
-
-        # Construct the correct container and label subfolder URLs
-        container_blob_url = f"https://{storage_account}.blob.core.windows.net/{container_name}"
-        label_blob_url = f"https://{storage_account}.blob.core.windows.net/{container_name}/{labelstudio_folder}"
 
         # Create a blob service client
         blob_service_client = BlobServiceClient.from_connection_string(blob_url)
         # Create a blob client for the flag container.
         flag_container_client = blob_service_client.get_container_client(container_name)
-        
-        # Load the images from Azure.
-        img_dict = {}
-        annotations_dict = {}
-        n_imgs = len(export_tasks_data)
-        for i,task_data in enumerate(export_tasks_data):
-            # Load img data.
-            img_url = task_data["data"]["image"]
-            img_name = img_url.split("/")[-1]
-            # Skip if no annotations.
-            if len(task_data["annotations"]) == 0:
-                print(f"NOTE: Task {task_data['id']} has no annotations. We skip adding the image and the annotation.")
-                continue
-            img_annotation = task_data["annotations"][0]["result"][0]["value"]["choices"][0]
-            # Skip if unnappealing flag.
-            if img_annotation == "Unappealing flag":
-                print(f"NOTE: Task {task_data['id']} was considered 'Unappealing flag'. We skip adding the image and the annotation.")
-                continue
-            # Record the annotation as a True/False statement as in border detection algorithm.
-            img_annotation = img_annotation == "Has borders" #"Good flag"
-            # Get the blob client for the image.
-            img_blob_client = flag_container_client.get_blob_client(blob=img_name)
-
-            # Download the image.
-            #image_data = requests.get(image_url).content
-            image_data = img_blob_client.download_blob().readall()
-            #image = np.asarray(bytearray(image_data.read()), dtype="uint8")
+
+        n_imgs = len(export_tasks_data) if isinstance(export_tasks_data, list) else "?"
+        labeled_tasks = ((img_name, (i, img_annotation))
+                         for i, task_data, img_name, img_annotation in iter_labeled_tasks(export_tasks_data, debug=debug))
+        # Download the images.
+        for img_name, (i, img_annotation), image_data in iter_blobs(flag_container_client, labeled_tasks,
+                                                                   max_workers=max_workers, blob_cache=blob_cache):
             image = np.asarray(bytearray(image_data), dtype="uint8")
-            #image = np.frombuffer(image_data, dtype="uint8")
             image = cv2.imdecode(image, cv2.IMREAD_COLOR)
 
-            # Store the image in the dictionary.
-            img_dict[img_name] = image
-            annotations_dict[img_name] = img_annotation
-
             if debug:
                 print(f"Loaded image {(i+1):4}/{n_imgs:4}: '{img_name}' with border annotation: '{img_annotation}'.")
-        
-        if debug:
-            print(f"Successfully loaded {len(img_dict)} images and {len(annotations_dict)} annotations.")
 
-        return img_dict, annotations_dict
-    
+            yield img_name, image, img_annotation
+
     except Exception as e:
         raise RuntimeError(f"Failed happen while loading Azure images: {str(e)}")
-    
+
+
+def load_imgs_from_azure(export_tasks_data, debug=False, blob_cache=None):
+    """
+    Load imgs from Azure and manual annotations.
+    Note, all images are kept in memory. Use 'iter_imgs_from_azure' for large label sets.
+
+    Args:
+        export_tasks_data (list): List of tasks data from labelstudio.
+        debug (bool): Flag to print debug info.
+        blob_cache (BlobCache): Optional local cache, to avoid downloading the images again.
+
+    Returns:
+        (dict, dict): Tuple of two dictionaries with loaded images and annotations, separately.
+        -- img_dict (dict): Dictionary of cv2 loaded images.
+        -- annotations_dict (dict): Dictionary of annotations.
+    """
+    img_dict = {}
+    annotations_dict = {}
+    for img_name, image, img_annotation in iter_imgs_from_azure(export_tasks_data, debug=debug, blob_cache=blob_cache):
+        # Store the image in the dictionary.
+        img_dict[img_name] = image
+        annotations_dict[img_name] = img_annotation
+
+    if debug:
+        print(f"Successfully loaded {len(img_dict)} images and {len(annotations_dict)} annotations.")
+
+    return img_dict, annotations_dict
+
 
 def get_border_detection_predictions(img_dict, detect_borders_algo=detect_borders, debug=False):
     """
@@ -136,7 +175,247 @@ def get_border_detection_predictions(img_dict, detect_borders_algo=detect_border
     return predictions_dict, img_w_borders_dict
 
 
-def compare_predictions_against_labels(annotations_dict, predictions_dict, debug=False):
+def iter_border_detection_predictions(img_stream, detect_borders_algo=detect_borders, debug=False):
+    """
+    Run the border detection algorithm on a stream of images.
+
+    Args:
+        img_stream (iterable): (img_name, image, annotation) tuples, e.g. from 'iter_imgs_from_azure'.
+        detect_borders_algo (function): Algorithm to detect borders.
+        debug (bool): Flag to print debug info.
+
+    Yields:
+        (str, bool, bool, img): Image name, annotation, prediction and image with flagged borders.
+    """
+    for img_name, image, img_annotation in img_stream:
+        # Detect borders.
+        img_has_borders, borders_sum, out_img = detect_borders_algo(image)
+        if debug:
+            print(f"Image: {img_name} has borders: {img_has_borders}, sum: {borders_sum}")
+        yield img_name, img_annotation, img_has_borders, out_img
+
+
+def evaluate_border_detection_stream(export_tasks_data, detect_borders_algo=detect_borders,
+                                     overlay_dir=None, debug=False, blob_cache=None):
+    """
+    Score the border detection algorithm streaming every task through
+    download -> decode -> detect -> score, so memory stays bounded by one image.
+
+    Args:
+        export_tasks_data (iterable): Tasks data from labelstudio.
+        detect_borders_algo (function): Algorithm to detect borders.
+        overlay_dir (str): If given, the images with flagged borders are written to
+                           this folder, only for mismatched predictions.
+        debug (bool): Flag to print debug info.
+        blob_cache (BlobCache): Optional local cache, to avoid downloading the images again.
+
+    Returns:
+        (list, float): Mismatched image names and accuracy, as in 'compare_predictions_against_labels'.
+    """
+    img_stream = iter_imgs_from_azure(export_tasks_data, debug=debug, blob_cache=blob_cache)
+    prediction_stream = iter_border_detection_predictions(img_stream, detect_borders_algo, debug=debug)
+    return score_prediction_stream(prediction_stream, overlay_dir=overlay_dir, debug=debug)
+
+
+def score_prediction_stream(prediction_stream, overlay_dir=None, debug=False):
+    """
+    Score a stream of predictions against their labels.
+
+    Args:
+        prediction_stream (iterable): (img_name, annotation, prediction, out_img) tuples,
+                                      e.g. from 'iter_border_detection_predictions'.
+        overlay_dir (str): If given, the images with flagged borders are written to
+                           this folder, only for mismatched predictions.
+        debug (bool): Flag to print debug info.
+
+    Returns:
+        (list, float): Mismatched image names and accuracy.
+    """
+    if overlay_dir:
+        os.makedirs(overlay_dir, exist_ok=True)
+
+    mismatched_tasks = []
+    total_images = 0
+    correct_predictions = 0
+    for img_name, annotation, prediction, out_img in prediction_stream:
+        total_images += 1
+        if annotation == prediction:
+            correct_predictions += 1
+            continue
+
+        mismatched_tasks.append(img_name)
+        if debug:
+            print(f"Mismatch for image {img_name}: Annotation={annotation}, Prediction={prediction}")
+        if overlay_dir:
+            # The output image is RGB, and cv2 writes BGR.
+            cv2.imwrite(os.path.join(overlay_dir, os.path.basename(img_name)), cv2.cvtColor(out_img, cv2.COLOR_RGB2BGR))
+
+    accuracy = correct_predictions / total_images if total_images > 0 else 0
+    if debug:
+        print(f"Accuracy: {(accuracy*100):.1f}% ({correct_predictions}/{total_images})")
+
+    return mismatched_tasks, accuracy
+
+
+def evaluate_salvage_stream(img_stream, detect_borders_algo=detect_borders, salvage_dir=None, debug=False):
+    """
+    Try to salvage the images with detected borders by cropping the borders off,
+    and count how many would be kept, per manual annotation.
+
+    Args:
+        img_stream (iterable): (img_name, image, annotation) tuples, e.g. from 'iter_imgs_from_azure'.
+        detect_borders_algo (function): Algorithm to detect borders.
+        salvage_dir (str): If given, the original & salvaged images are written side by
+                           side to this folder, for review.
+        debug (bool): Flag to print debug info.
+
+    Returns:
+        dict: Number of images, with detected borders, and salvaged (per annotation).
+    """
+    if salvage_dir:
+        os.makedirs(salvage_dir, exist_ok=True)
+
+    report = {"n_images": 0, "n_borders": 0, "n_salvaged": 0, "salvaged": {"Has borders": 0, "Good flag": 0}}
+    for img_name, image, img_annotation in img_stream:
+        report["n_images"] += 1
+        lines = {}
+        img_has_borders, _, _ = detect_borders_algo(image, lines=lines)
+        if not img_has_borders:
+            continue
+        report["n_borders"] += 1
+        salvaged_image = salvage_bordered_image(image, lines, debug=debug)
+        if salvaged_image is None:
+            continue
+        report["n_salvaged"] += 1
+        report["salvaged"]["Has borders" if img_annotation else "Good flag"] += 1
+        if debug:
+            print(f"Image: {img_name} salvaged (annotation: {'Has borders' if img_annotation else 'Good flag'})")
+        if salvage_dir:
+            cv2.imwrite(os.path.join(salvage_dir, os.path.basename(img_name)), np.hstack([image, salvaged_image]))
+
+    return report
+
+
+def compare_detectors_stream(img_stream, detectors, debug=False):
+    """
+    Run several border detection algorithms on each image in a single pass. The decoded
+    image and its grayscale version are shared by all the detectors.
+
+    Args:
+        img_stream (iterable): (img_name, image, annotation) tuples, e.g. from 'iter_imgs_from_azure'.
+        detectors (dict): Border detection algorithms by name.
+        debug (bool): Flag to print debug info.
+
+    Returns:
+        dict: Report with the accuracy, time and time per step of each detector,
+              and the images where the detectors disagree.
+    """
+    report = {
+        "n_images": 0,
+        "shared_grayscale_ms": 0.0,
+        "detectors": {name: {"correct": 0, "total_ms": 0.0, "timings_ms": {}} for name in detectors},
+        "disagreements": [],
+    }
+    for img_name, image, img_annotation in img_stream:
+        report["n_images"] += 1
+        start = time.perf_counter()
+        gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+        report["shared_grayscale_ms"] += (time.perf_counter() - start) * 1000
+
+        predictions = {}
+        for name, detect_borders_algo in detectors.items():
+            detector_report = report["detectors"][name]
+            start = time.perf_counter()
+            img_has_borders, _, _ = detect_borders_algo(image, gray=gray, timings=detector_report["timings_ms"])
+            detector_report["total_ms"] += (time.perf_counter() - start) * 1000
+            detector_report["correct"] += int(img_has_borders == img_annotation)
+            predictions[name] = bool(img_has_borders)
+
+        if len(set(predictions.values())) > 1:
+            report["disagreements"].append({"image": img_name, "annotation": img_annotation, "predictions": predictions})
+            if debug:
+                print(f"Disagreement for image {img_name}: Annotation={img_annotation}, Predictions={predictions}")
+
+    n_images = report["n_images"]
+    for name, detector_report in report["detectors"].items():
+        detector_report["accuracy"] = detector_report["correct"] / n_images if n_images > 0 else 0
+        detector_report["mean_ms"] = detector_report["total_ms"] / n_images if n_images > 0 else 0
+        if debug:
+            print(f"Detector '{name}': accuracy {(detector_report['accuracy']*100):.1f}%, "
+                  f"mean time {detector_report['mean_ms']:.1f} ms, time per step {detector_report['timings_ms']}")
+
+    return report
+
+
+def update_eval_store(export_tasks_data, eval_store, detect_borders_algo=detect_borders, params=None,
+                      blob_cache=None, trust_names=True, debug=False):
+    """
+    Run the border detection algorithm only on the images without a stored result
+    for the current detector version & parameters (new images or changed detector).
+
+    Args:
+        export_tasks_data (iterable): Tasks data from labelstudio.
+        eval_store (EvalStore): Store of the evaluation results.
+        detect_borders_algo (function): Algorithm to detect borders.
+        params (dict): Parameters passed to the algorithm, if any.
+        blob_cache (BlobCache): Optional local cache, to avoid downloading the images again.
+        trust_names (bool): Reuse the content hash already known for an image name, so
+                            unchanged images are not even downloaded. Image names are unique
+                            per generated flag, so this is safe unless blobs are overwritten.
+        debug (bool): Flag to print debug info.
+
+    Returns:
+        (dict, dict, tuple): Annotations per image name, image hashes per image name and detector key.
+    """
+    try:
+        blob_url = os.getenv("AZURE_STORAGE_CONNECTION_STRING")
+        container_name = os.getenv("CONTAINER_NAME")
+
+        # Create a blob client for the flag container.
+        blob_service_client = BlobServiceClient.from_connection_string(blob_url)
+        flag_container_client = blob_service_client.get_container_client(container_name)
+
+        detector_key = get_detector_key(detect_borders_algo, params)
+        annotations_dict = {}
+        image_hashes = {}
+
+        def iter_pending_tasks():
+            # Labels are always read fresh, so relabeled tasks are scored with their new label.
+            for i, task_data, img_name, img_annotation in iter_labeled_tasks(export_tasks_data, debug=debug):
+                annotations_dict[img_name] = img_annotation
+                image_hash = eval_store.name_hashes.get(img_name) if trust_names else None
+                if image_hash and eval_store.get(image_hash, detector_key) is not None:
+                    image_hashes[img_name] = image_hash
+                    continue
+                yield img_name, img_annotation
+
+        n_computed = 0
+        for img_name, img_annotation, image_data in iter_blobs(flag_container_client, iter_pending_tasks(), blob_cache=blob_cache):
+            image_hash = hash_image_data(image_data)
+            image_hashes[img_name] = image_hash
+            eval_store.put_name(img_name, image_hash)
+            if eval_store.get(image_hash, detector_key) is not None:
+                continue
+
+            image = np.asarray(bytearray(image_data), dtype="uint8")
+            image = cv2.imdecode(image, cv2.IMREAD_COLOR)
+            img_has_borders, borders_sum, _ = detect_borders_algo(image, **(params or {}))
+            eval_store.put(image_hash, detector_key, img_has_borders, borders_sum)
+            n_computed += 1
+            if debug:
+                print(f"Image: {img_name} has borders: {img_has_borders}, sum: {borders_sum}")
+
+        if debug:
+            print(f"Computed {n_computed} new results. Reused {len(annotations_dict) - n_computed} stored results for detector {detector_key}.")
+
+        return annotations_dict, image_hashes, detector_key
+
+    except Exception as e:
+        raise RuntimeError(f"Failed happen while updating the evaluation store: {str(e)}")
+
+
+def compare_predictions_against_labels(annotations_dict, predictions_dict=None, debug=False,
+                                       eval_store=None, image_hashes=None, detector_key=None):
     """
     Score the performance of the algorithm.
 
@@ -144,11 +423,22 @@ def compare_predictions_against_labels(annotations_dict, predictions_dict, debug
         annotations_dict
         predictions_dict
         debug (bool): Flag to print debug info.
+        eval_store (EvalStore): If given, predictions are read from the store instead of 'predictions_dict'.
+        image_hashes (dict): Image hash per image name, to look up the store.
+        detector_key (tuple): Detector whose results are read from the store.
 
     Returns:
         List(str): List of found task id(s).
     """
 
+    # Read the predictions from the evaluation store.
+    if eval_store is not None:
+        predictions_dict = {}
+        for img_name, image_hash in image_hashes.items():
+            result = eval_store.get(image_hash, detector_key)
+            if result is not None:
+                predictions_dict[img_name] = result["has_borders"]
+
     # Compare the predictions against the labels.
     mismatched_tasks = []
     total_images = len(annotations_dict)
@@ -178,28 +468,136 @@ def compare_predictions_against_labels(annotations_dict, predictions_dict, debug
 if __name__ == "__main__":
     parser = ArgumentParser()
     parser.add_argument("-efn", "--export_fn",
-                        dest="export_fn", default="export_tasks_and_annotations.json",
+                        dest="export_fn", default="export_tasks_and_annotations_20250318_122733.json",
                         help="Filename of the export tasks and annotations in Azure.")
     parser.add_argument("-d", "--debug",
                         dest="debug", default=False,
                         help="Debug flag")
+    parser.add_argument("-o", "--overlay_dir",
+                        dest="overlay_dir", default=None,
+                        help="Folder to write the images with flagged borders of mismatched predictions.")
+    parser.add_argument("--cache_dir",
+                        dest="cache_dir", default=DEFAULT_CACHE_DIR,
+                        help="Local cache folder for blobs downloaded from Azure.")
+    parser.add_argument("--no_cache",
+                        dest="no_cache", action="store_true",
+                        help="Always download the blobs from Azure.")
+    parser.add_argument("--offline",
+                        dest="offline", action="store_true",
+                        help="Use cached blobs without checking their ETag in Azure.")
+    parser.add_argument("--build_snapshot",
+                        dest="build_snapshot", default=None,
+                        help="Folder to freeze the labeled images into a memory-mapped snapshot.")
+    parser.add_argument("-s", "--snapshot",
+                        dest="snapshot", default=None,
+                        help="Evaluate on a memory-mapped snapshot instead of downloading from Azure.")
+    parser.add_argument("-w", "--workers",
+                        dest="workers", default=1, type=int,
+                        help="Number of worker processes to evaluate a snapshot.")
+    parser.add_argument("-es", "--eval_store",
+                        dest="eval_store", default=None,
+                        help="Evaluation results store. Only new images or detector changes are recomputed.")
+    parser.add_argument("--rehash",
+                        dest="rehash", action="store_true",
+                        help="Download & hash every image again instead of trusting known image names.")
+    parser.add_argument("-ab", "--ab_detectors",
+                        dest="ab_detectors", nargs="+", default=None, choices=list(DETECTORS),
+                        help="Compare several detectors in a single pass (e.g. '-ab prod dev').")
+    parser.add_argument("--ab_report",
+                        dest="ab_report", default="ab_report.json",
+                        help="File to write the A/B comparison report.")
+    parser.add_argument("-c", "--cascade",
+                        dest="cascade", action="store_true",
+                        help="Evaluate the cascaded border detector (fast first stage).")
+    parser.add_argument("--salvage",
+                        dest="salvage", action="store_true",
+                        help="Evaluate the salvage of images with borders (cropping the borders off).")
+    parser.add_argument("--salvage_dir",
+                        dest="salvage_dir", default=None,
+                        help="Folder to write the original & salvaged images side by side.")
 
     args = parser.parse_args()
     export_fn = args.export_fn
     debug = args.debug
+    detect_borders_algo = detect_borders_cascade if args.cascade else detect_borders
+
+    def run_ab_comparison(img_stream):
+        detectors = {name: DETECTORS[name] for name in args.ab_detectors}
+        report = compare_detectors_stream(img_stream, detectors, debug=debug)
+        with open(args.ab_report, "w") as f:
+            json.dump(report, f, indent=4)
+        for name, detector_report in report["detectors"].items():
+            print(f"{name}: accuracy {(detector_report['accuracy']*100):.1f}%, mean time {detector_report['mean_ms']:.1f} ms")
+        print(f"Disagreements: {len(report['disagreements'])}/{report['n_images']}. Report written to '{args.ab_report}'.")
+
+    def run_salvage_evaluation(img_stream):
+        report = evaluate_salvage_stream(img_stream, detect_borders_algo, salvage_dir=args.salvage_dir, debug=debug)
+        print(f"Salvaged {report['n_salvaged']}/{report['n_borders']} images with detected borders "
+              f"({report['n_images']} images). Per annotation: {report['salvaged']}")
+
+    if args.snapshot:
+        # Evaluate on the snapshot. No downloads nor decoding needed.
+        if args.ab_detectors:
+            run_ab_comparison(iter_snapshot(args.snapshot))
+            sys.exit(0)
+        if args.salvage:
+            run_salvage_evaluation(iter_snapshot(args.snapshot))
+            sys.exit(0)
+        if args.workers > 1:
+            mismatched_tasks, accuracy = evaluate_snapshot_parallel(args.snapshot, detect_borders_algo,
+                                                                    n_workers=args.workers, debug=debug)
+        else:
+            prediction_stream = iter_border_detection_predictions(iter_snapshot(args.snapshot), detect_borders_algo, debug=debug)
+            mismatched_tasks, accuracy = score_prediction_stream(prediction_stream, overlay_dir=args.overlay_dir, debug=debug)
+        print(f"Accuracy: {(accuracy*100):.1f}%. Mismatched images: {len(mismatched_tasks)}")
+        if args.cascade and args.workers <= 1:
+            print(f"Cascade stats: {get_cascade_stats()}")
+        sys.exit(0)
 
     from config import load_env_vars
     load_env_vars()
 
-    # Get the tasks export from Azure.
-    export_fn = "export_tasks_and_annotations_20250318_122733.json"
-    export_tasks_data = get_tasks_export_from_azure(azure_export_fn=export_fn, debug=debug)
-
-    # Load the images from Azure.
-    img_dict, annotations_dict = load_imgs_from_azure(export_tasks_data, debug=True) #debug)
-
-    # Run the border detection algorithm on the images.
-    predictions_dict, img_w_borders_dict = get_border_detection_predictions(img_dict, debug=debug)
-
-    # Compare the predictions against the labels.
-    mismatched_tasks, accuracy = compare_predictions_against_labels(annotations_dict, predictions_dict, debug=debug)
+    # Local cache of the blobs, so repeated runs do not download them again.
+    blob_cache = None
+    if not args.no_cache:
+        blob_cache = BlobCache(args.cache_dir, validate=not args.offline, debug=debug)
+
+    # Get the tasks export from Azure ('.json' or gzip-compressed '.ndjson.gz' snapshot).
+    # Tasks are streamed, so the evaluation starts before the whole export is parsed.
+    export_tasks_data = iter_tasks_export_from_azure(azure_export_fn=export_fn, debug=debug, blob_cache=blob_cache)
+
+    if args.build_snapshot:
+        # Freeze the labeled images for later experiments.
+        img_stream = iter_imgs_from_azure(export_tasks_data, debug=debug, blob_cache=blob_cache)
+        build_snapshot(img_stream, args.build_snapshot, source=export_fn, debug=debug)
+        sys.exit(0)
+
+    if args.ab_detectors:
+        run_ab_comparison(iter_imgs_from_azure(export_tasks_data, debug=debug, blob_cache=blob_cache))
+        sys.exit(0)
+
+    if args.salvage:
+        run_salvage_evaluation(iter_imgs_from_azure(export_tasks_data, debug=debug, blob_cache=blob_cache))
+        sys.exit(0)
+
+    if args.eval_store:
+        # Incremental evaluation: only compute results missing in the store.
+        eval_store = EvalStore(args.eval_store)
+        annotations_dict, image_hashes, detector_key = update_eval_store(export_tasks_data, eval_store, detect_borders_algo,
+                                                                         blob_cache=blob_cache, trust_names=not args.rehash,
+                                                                         debug=debug)
+        mismatched_tasks, accuracy = compare_predictions_against_labels(annotations_dict, debug=debug, eval_store=eval_store,
+                                                                        image_hashes=image_hashes, detector_key=detector_key)
+        print(f"Accuracy: {(accuracy*100):.1f}%. Mismatched images: {len(mismatched_tasks)}")
+        sys.exit(0)
+
+    # Stream the images from Azure through the border detection algorithm, and score it.
+    mismatched_tasks, accuracy = evaluate_border_detection_stream(export_tasks_data, detect_borders_algo,
+                                                                  overlay_dir=args.overlay_dir, debug=debug,
+                                                                  blob_cache=blob_cache)
+    print(f"Accuracy: {(accuracy*100):.1f}%. Mismatched images: {len(mismatched_tasks)}")
+    if blob_cache is not None:
+        print(f"Blob cache hits: {blob_cache.hits}, misses: {blob_cache.misses}")
+
+    if args.cascade:
+        print(f"Cascade stats: {get_cascade_stats()}")
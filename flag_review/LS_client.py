@@ -0,0 +1,293 @@
+import os
+import time
+import requests
+from itertools import islice
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from config import iter_json_array
+
+# Label Studio base URL. The app runs in the same container by default.
+LABELSTUDIO_URL = os.getenv("LABELSTUDIO_URL", "http://localhost:8080")
+
+# Shared client, so every script reuses the same keep-alive connections.
+_labelstudio_client = None
+
+
+class LabelStudioClient:
+    """
+    Label Studio API client with a pooled keep-alive session, retries and error checking.
+    Responses are parsed in memory, and large exports are streamed.
+    """
+
+    def __init__(self, base_url=None, token=None, max_retries=3, pool_size=16, timeout=120):
+        """
+        Args:
+            base_url (str): Label Studio URL. Defaults to 'LABELSTUDIO_URL'.
+            token (str): User token. Defaults to the 'LABELSTUDIO_TOKEN' env var.
+            max_retries (int): Retries on connection errors and 502/503/504 responses.
+            pool_size (int): Max number of pooled connections (i.e., concurrent requests).
+            timeout (int): Timeout (secs) of each request.
+        """
+        self.base_url = (base_url or LABELSTUDIO_URL).rstrip("/")
+        self.timeout = timeout
+        self.session = requests.Session()
+        self.session.headers.update({
+            "Authorization": f"Token {token or os.getenv('LABELSTUDIO_TOKEN')}",
+            "Accept": "application/json",
+        })
+        # POST requests are not retried on bad responses, as they may not be idempotent.
+        retry = Retry(total=max_retries, backoff_factor=0.5, status_forcelist=(502, 503, 504),
+                      allowed_methods=frozenset({"GET", "PUT", "PATCH", "DELETE", "HEAD"}))
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def request(self, method, path, json=None, params=None, stream=False, allow_404=False):
+        """
+        Send a request to the Label Studio API.
+
+        Args:
+            method (str): HTTP method.
+            path (str): API path, e.g. '/api/projects'.
+            json (dict|list): Optional json body.
+            params (dict): Optional query params.
+            stream (bool): Return the raw streamed response instead of the parsed json.
+            allow_404 (bool): Return None instead of raising when the resource is not found.
+
+        Returns:
+            dict|list|None: The parsed json response (or the response itself if 'stream').
+        """
+        response = self.session.request(method, f"{self.base_url}{path}", json=json, params=params,
+                                        stream=stream, timeout=self.timeout)
+        if allow_404 and response.status_code == 404:
+            response.close()
+            return None
+        if response.status_code >= 400:
+            error_text = response.text[:500]
+            response.close()
+            raise RuntimeError(f"Label Studio request {method} {path} failed ({response.status_code}): {error_text}")
+        if stream:
+            return response
+        if not response.content:
+            return None
+        return response.json()
+
+    def get(self, path, **kwargs):
+        return self.request("GET", path, **kwargs)
+
+    def post(self, path, json=None, **kwargs):
+        return self.request("POST", path, json=json, **kwargs)
+
+    def patch(self, path, json=None, **kwargs):
+        return self.request("PATCH", path, json=json, **kwargs)
+
+    def delete(self, path, **kwargs):
+        return self.request("DELETE", path, **kwargs)
+
+    def iter_project_export(self, project_id=1, save_to=None, chunk_size=64 * 1024, params=None):
+        """
+        Stream the tasks of a full project export, with projects and annotations.
+
+        Args:
+            project_id (int): Label Studio project id.
+            save_to (str): Optional file where the raw export is also written while streaming.
+            chunk_size (int): Size of the downloaded chunks.
+            params (dict): Extra query params of the export.
+
+        Yields:
+            dict: Task data from labelstudio.
+        """
+        export_params = {"exportType": "JSON", "download_all_tasks": "true"}
+        export_params.update(params or {})
+        with self.get(f"/api/projects/{project_id}/export", params=export_params, stream=True) as response:
+            chunks = response.iter_content(chunk_size=chunk_size)
+            if save_to is None:
+                yield from iter_json_array(chunks)
+                return
+            with open(save_to, "wb") as f:
+                yield from iter_json_array(_tee_chunks(chunks, f))
+
+    def iter_tasks(self, project_id=1, page_size=100, max_workers=4, fields="all", params=None):
+        """
+        Stream all the tasks of a project using the paginated task listing, with several
+        pages in flight. Tasks are yielded as their page arrives (not in id order), and gaps
+        left by deleted task ids do not matter.
+
+        Args:
+            project_id (int): Label Studio project id.
+            page_size (int): Number of tasks per page.
+            max_workers (int): Number of pages requested concurrently.
+            fields (str): 'all' to include annotations & predictions, 'task_only' otherwise.
+            params (dict): Extra query params (e.g. a 'query' with filters).
+
+        Yields:
+            dict: Task data from labelstudio.
+        """
+        tasks, total = self._get_tasks_page(project_id, 1, page_size, fields, params)
+        yield from tasks
+        n_pages = -(-total // page_size)
+        if n_pages <= 1:
+            return
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            pages = iter(range(2, n_pages + 1))
+            in_flight = set()
+            # Keep a bounded number of pages in flight, refilling as they arrive.
+            for page in pages:
+                in_flight.add(executor.submit(self._get_tasks_page, project_id, page, page_size, fields, params))
+                if len(in_flight) >= 2 * max_workers:
+                    break
+            while in_flight:
+                done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield from future.result()[0]
+                    next_page = next(pages, None)
+                    if next_page is not None:
+                        in_flight.add(executor.submit(self._get_tasks_page, project_id, next_page, page_size, fields, params))
+
+    def _get_tasks_page(self, project_id, page, page_size, fields="all", params=None):
+        page_params = {"project": project_id, "page": page, "page_size": page_size, "fields": fields}
+        page_params.update(params or {})
+        response = self.get("/api/tasks", params=page_params, allow_404=True)
+        # Pages past the last task return 404.
+        if response is None:
+            return [], 0
+        # Older Label Studio versions return a plain list of tasks.
+        if isinstance(response, list):
+            return response, len(response)
+        return response.get("tasks", []), response.get("total", 0)
+
+    def wait_until_ready(self, timeout=300, interval=1, process=None):
+        """
+        Poll the health endpoint until Label Studio answers.
+
+        Args:
+            timeout (int): Max time (secs) to wait.
+            interval (float): Time (secs) between polls.
+            process (Popen): Optional Label Studio process, to fail fast if it exits.
+
+        Returns:
+            float: Time (secs) until Label Studio was ready.
+        """
+        start_time = time.monotonic()
+        while True:
+            try:
+                response = self.session.get(f"{self.base_url}/health", timeout=interval * 5)
+                if response.status_code == 200:
+                    return time.monotonic() - start_time
+            except requests.exceptions.RequestException:
+                pass
+            if process is not None and process.poll() is not None:
+                raise RuntimeError(f"Label Studio exited with code {process.returncode} before being ready.")
+            if time.monotonic() - start_time > timeout:
+                raise RuntimeError(f"Label Studio not ready after {timeout} secs.")
+            time.sleep(interval)
+
+    def list_projects(self):
+        projects = self.get("/api/projects", params={"page_size": 1000})
+        # Newer Label Studio versions paginate the projects.
+        return projects.get("results", []) if isinstance(projects, dict) else projects
+
+    def list_import_storages(self, project_id):
+        return self.get("/api/storages/azure", params={"project": project_id})
+
+    def list_export_storages(self, project_id):
+        return self.get("/api/storages/export/azure", params={"project": project_id})
+
+    def get_task(self, task_id):
+        return self.get(f"/api/tasks/{task_id}/", allow_404=True)
+
+    def delete_task(self, task_id):
+        return self.delete(f"/api/tasks/{task_id}/")
+
+    def delete_tasks(self, project_id, task_ids, chunk_size=1000):
+        """
+        Delete tasks in bulk with the data manager 'delete_tasks' action, 'chunk_size' tasks per request.
+        """
+        task_ids = list(task_ids)
+        for i in range(0, len(task_ids), chunk_size):
+            selected_items = {"all": False, "included": task_ids[i:i + chunk_size]}
+            self.post("/api/dm/actions", json={"selectedItems": selected_items},
+                      params={"id": "delete_tasks", "project": project_id})
+
+    def import_tasks(self, project_id, tasks):
+        return self.post(f"/api/projects/{project_id}/import", json=tasks)
+
+    def import_tasks_chunked(self, project_id, tasks, chunk_size=500, max_workers=1, debug=False):
+        """
+        Import tasks in chunks, with at most 'max_workers' chunks in flight.
+        Tasks are consumed lazily, so 'tasks' can be a generator.
+        With a single worker, task ids are assigned in the order of 'tasks'. Concurrent chunks
+        may get interleaved ids (and hit lock errors on SQLite-backed Label Studio).
+
+        Args:
+            project_id (int): Label Studio project id.
+            tasks (iterable): Tasks to import.
+            chunk_size (int): Number of tasks per import request.
+            max_workers (int): Number of concurrent import requests. Keep 1 where the task ids must follow the order of 'tasks'.
+            debug (bool): Flag to print the import progress.
+
+        Returns:
+            int: Number of imported tasks.
+        """
+        tasks = iter(tasks)
+        n_imported = 0
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            in_flight = deque()
+            while True:
+                chunk = list(islice(tasks, chunk_size))
+                if chunk:
+                    in_flight.append((len(chunk), executor.submit(self.import_tasks, project_id, chunk)))
+                # Wait for the oldest chunk when the window is full, or at the end.
+                while in_flight and (len(in_flight) >= max_workers or not chunk):
+                    n_chunk, future = in_flight.popleft()
+                    future.result()
+                    n_imported += n_chunk
+                    if debug:
+                        print(f">>> DEBUG <<< Imported {n_imported} tasks.")
+                if not chunk:
+                    break
+        return n_imported
+
+    def import_predictions(self, project_id, predictions):
+        return self.post(f"/api/projects/{project_id}/import/predictions", json=predictions)
+
+    def create_annotation(self, task_id, result):
+        return self.post(f"/api/tasks/{task_id}/annotations", json={"result": result})
+
+    def create_project(self, project_dict):
+        return self.post("/api/projects", json=project_dict)
+
+    def create_import_storage(self, storage_dict):
+        return self.post("/api/storages/azure", json=storage_dict)
+
+    def update_import_storage(self, storage_id, storage_dict):
+        return self.patch(f"/api/storages/azure/{storage_id}", json=storage_dict)
+
+    def sync_import_storage(self, storage_id):
+        return self.post(f"/api/storages/azure/{storage_id}/sync")
+
+    def create_export_storage(self, storage_dict):
+        return self.post("/api/storages/export/azure", json=storage_dict)
+
+    def sync_export_storage(self, storage_id):
+        return self.post(f"/api/storages/export/azure/{storage_id}/sync")
+
+
+def get_labelstudio_client(base_url=None):
+    """
+    Get the shared Label Studio client. With 'base_url' (e.g. the port Label Studio was
+    just started on), the shared client is pointed to it, so later calls reuse it.
+    """
+    global _labelstudio_client
+    if _labelstudio_client is None or (base_url and _labelstudio_client.base_url != base_url.rstrip("/")):
+        _labelstudio_client = LabelStudioClient(base_url)
+    return _labelstudio_client
+
+
+def _tee_chunks(chunks, f):
+    for chunk in chunks:
+        f.write(chunk)
+        yield chunk
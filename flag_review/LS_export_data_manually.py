@@ -1,62 +1,110 @@
 from argparse import ArgumentParser
 import os
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
 import json
-import subprocess
-from azure.storage.blob import BlobServiceClient
-from config import load_json_file, load_env_vars
+import gzip
+import hashlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from azure.storage.blob import BlobServiceClient, ContentSettings
+from config import load_env_vars, iter_tasks_chunks
+from LS_client import get_labelstudio_client
 
 # Name tasks using Task ID and setting 4 leading zeroes.
 TASK_NAME_F = lambda task_id: f"task_data_v2_{task_id:05}.json"
+TASK_NAME_PREFIX = "task_data_v2_"
+# Incremental exports: merged project snapshot & watermark state blobs.
+EXPORT_SNAPSHOT_NAME = "export_tasks_and_annotations_latest"
+EXPORT_STATE_FN = "export_state.json"
+# Margin (secs) subtracted from the query start time saved as watermark, for clock skew
+# between this machine and Label Studio. Tasks in the margin are exported again next time.
+EXPORT_WATERMARK_MARGIN_SECS = int(os.getenv("EXPORT_WATERMARK_MARGIN_SECS", 60))
+# Max task ids per export request, to keep the URL short.
+EXPORT_IDS_CHUNK = 200
+# Snapshot formats: JSON array, or gzip-compressed NDJSON (one task per line).
+SNAPSHOT_FORMATS = ("json", "ndjson.gz")
 
 
-def get_tasks_export(export_tasks_json_name = "export_tasks_and_annotations.json", debug=True):
+def get_project_id(project_id=None, debug=True):
+    """
+    Id of the Label Studio project: 'project_id' if set, otherwise found by title.
+    """
+    if project_id is not None:
+        return project_id
+    # Imported here: 'LS_load_project' imports this module (through 'LS_load_json_files').
+    from LS_load_project import find_labelstudio_project
+    project_id = find_labelstudio_project(debug)["project"]
+    if project_id is None:
+        raise RuntimeError("Label Studio project not found. Run 'main.py' first.")
+    return project_id
+
+
+def get_tasks_export(export_tasks_json_name = "export_tasks_and_annotations.json", debug=True, project_id=None):
     """
     Get a full project export with projects and annotations.
     Tasks need to be later split into individual json files.
     """
-    # Prepare the ls token & export file name.
-    labelstudio_token = os.getenv("LABELSTUDIO_TOKEN")
-    
-    # Remove previous export file if it exists.
-    if export_tasks_json_name in os.listdir():
-        os.remove(export_tasks_json_name)
-    
-    # Run the curl command to get the export.
-    sp = subprocess.run(f"curl -H 'Authorization: Token {labelstudio_token}' -H 'Accept: application/json'  -X GET 'http://localhost:8080/api/projects/{1}/export?exportType=JSON&download_all_tasks=true' -o '{export_tasks_json_name}'", shell=True)
-    export_tasks_dict = load_json_file(export_tasks_json_name)
+    return list(iter_tasks_export(export_tasks_json_name, debug=debug, project_id=project_id))
 
-    return export_tasks_dict
+
+def iter_tasks_export(export_tasks_json_name = "export_tasks_and_annotations.json", debug=True, project_id=None):
+    """
+    Get a full project export with projects and annotations, and stream its tasks
+    one at a time while they are downloaded. The raw export is also saved to
+    'export_tasks_json_name' (skipped if None). The project is found by title if 'project_id' is None.
+    """
+    labelstudio_client = get_labelstudio_client()
+    yield from labelstudio_client.iter_project_export(get_project_id(project_id, debug), save_to=export_tasks_json_name)
 
 
-def get_individual_tasks(debug=True):
+def get_individual_tasks(project_id, page_size=100, max_workers=4, debug=True):
     """
     (unused) Import format is different. Use 'get_tasks_export' instead.
-    Export all tasks from Label Studio.
+    Export all tasks from Label Studio, using the paginated task listing.
     """
     task_data_dict = {}
-    labelstudio_token = os.getenv("LABELSTUDIO_TOKEN")
-    for task_id in range(1,10000):
-        task_json_name = f"task_data_{task_id}.json"
-        if task_json_name in os.listdir():
-            os.remove(task_json_name)
-        sp = subprocess.run(f"curl -H 'Authorization: Token {labelstudio_token}' -H 'Accept: application/json'  -X GET 'http://localhost:8080/api/tasks/{task_id}/' -o {task_json_name}", shell=True)
-
-        # Load the task data
-        task_data = load_json_file(task_json_name)
-
-        # Stop whenever we reach the last task.
-        # > the json will have a "status_code" key and a value of 404.
-        if "status_code" in task_data and task_data["status_code"] == 404:
-            break
-
-        # If we have a task, add the task to the dict.
+    labelstudio_client = get_labelstudio_client()
+    for task_data in labelstudio_client.iter_tasks(project_id, page_size=page_size, max_workers=max_workers):
+        task_json_name = f"task_data_{task_data['id']}.json"
+        # Add the task to the dict.
         task_data_dict[task_json_name] = task_data
     
     return task_data_dict
 
 
-def get_tasks_export_from_azure(azure_export_fn="export_tasks_and_annotations.json", debug=True):
+def get_tasks_export_from_azure(azure_export_fn="export_tasks_and_annotations.json", debug=True, blob_cache=None):
+    """
+    Get a stored project export from Azure.
+
+    Args:
+        azure_export_fn (str): Blob name of the export.
+        debug (bool): Flag to print debug info.
+        blob_cache (BlobCache): Optional local cache, to avoid downloading the export again.
+
+    Returns:
+        list: List of tasks data from labelstudio.
+    """
+    export_tasks_data = list(iter_tasks_export_from_azure(azure_export_fn, debug=debug, blob_cache=blob_cache))
+
+    if debug:
+        print(f"EXPORTED TASKS:\n{len(export_tasks_data)}")
+
+    return export_tasks_data
+
+
+def iter_tasks_export_from_azure(azure_export_fn="export_tasks_and_annotations.json", debug=True, blob_cache=None):
+    """
+    Stream the tasks of a stored project export from Azure, parsing them while
+    the blob is being downloaded.
+
+    Args:
+        azure_export_fn (str): Blob name of the export.
+        debug (bool): Flag to print debug info.
+        blob_cache (BlobCache): Optional local cache, to avoid downloading the export again.
+
+    Yields:
+        dict: Task data from labelstudio.
+    """
 
     try:
         blob_url = os.getenv("AZURE_STORAGE_CONNECTION_STRING")
@@ -79,25 +127,119 @@ def get_tasks_export_from_azure(azure_export_fn="export_tasks_and_annotations.js
         labelstudio_prefix = f"{labelstudio_folder}/"  # Ensure it ends with '/'
 
         # Get the export from azure. Load the exported file.
-        export_tasks_blob_client = flag_container_client.get_blob_client(blob=azure_export_fn)
-        ls_label_data = export_tasks_blob_client.download_blob().readall()
-        export_tasks_data = json.loads(ls_label_data)
-
-        if debug:
-            print(f"EXPORTED TASKS:\n{len(export_tasks_data)}")
-        
-        return export_tasks_data
+        if blob_cache is not None:
+            ls_label_chunks = [blob_cache.get(flag_container_client, azure_export_fn)]
+        else:
+            export_tasks_blob_client = flag_container_client.get_blob_client(blob=azure_export_fn)
+            ls_label_chunks = export_tasks_blob_client.download_blob().chunks()
+        # The parser depends on the snapshot format ('.json' or '.ndjson.gz').
+        yield from iter_tasks_chunks(ls_label_chunks, azure_export_fn)
 
     except Exception as e:
         raise RuntimeError(f"Failed happen during loading labels step: {str(e)}")
 
 
-def export_tasks_and_annotations(debug=True):
+def get_stored_task_md5s(container_client, prefix=TASK_NAME_PREFIX):
+    """
+    Get the content MD5 of every stored task json, with a single blob listing.
+
+    Returns:
+        dict: Task json name -> content MD5 (bytes), for blobs that have one.
+    """
+    stored_md5s = {}
+    for blob in container_client.list_blobs(name_starts_with=prefix):
+        content_md5 = blob.content_settings.content_md5 if blob.content_settings else None
+        if content_md5:
+            stored_md5s[blob.name] = bytes(content_md5)
+    return stored_md5s
+
+
+def upload_changed_tasks(container_client, task_items, stored_md5s, max_workers=8, debug=True):
+    """
+    Upload task jsons concurrently as compact json, skipping those whose content
+    MD5 matches the stored blob. At most 2*max_workers uploads are in flight.
+
+    Args:
+        container_client (ContainerClient): Azure container of the tasks.
+        task_items (iterable): (task json name, task data) tuples.
+        stored_md5s (dict): Task json name -> content MD5, from 'get_stored_task_md5s'.
+        max_workers (int): Number of concurrent uploads.
+        debug (bool): Flag to print debug info.
+
+    Returns:
+        int: Number of uploaded tasks.
+    """
+    def upload_task(task_json_name, task_json_bytes, task_md5):
+        task_blob_client = container_client.get_blob_client(blob=task_json_name)
+        task_blob_client.upload_blob(task_json_bytes, overwrite=True,
+                                     content_settings=ContentSettings(content_type="application/json",
+                                                                      content_md5=task_md5))
+
+    n_uploaded = 0
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        in_flight = deque()
+        for task_json_name, task_data in task_items:
+            # Prepare the task data.
+            task_json_bytes = json.dumps(task_data, separators=(",", ":")).encode()
+            task_md5 = hashlib.md5(task_json_bytes).digest()
+            if stored_md5s.get(task_json_name) == task_md5:
+                continue
+            if debug:
+                print(f"Uploading: {task_json_name}.")
+            in_flight.append(executor.submit(upload_task, task_json_name, task_json_bytes, task_md5))
+            n_uploaded += 1
+            if len(in_flight) >= 2 * max_workers:
+                in_flight.popleft().result()
+        while in_flight:
+            in_flight.popleft().result()
+
+    return n_uploaded
+
+
+class TasksSnapshotWriter:
+    """
+    Write tasks one at a time to a snapshot file, as a JSON array or as gzip-compressed
+    NDJSON if the file name ends with '.ndjson.gz'.
+    """
+
+    def __init__(self, snapshot_fn):
+        self.snapshot_fn = snapshot_fn
+        self.ndjson = snapshot_fn.endswith(".ndjson.gz")
+        self.n_tasks = 0
+        self._f = None
+
+    def __enter__(self):
+        if self.ndjson:
+            self._f = gzip.open(self.snapshot_fn, "wt", encoding="utf-8")
+        else:
+            self._f = open(self.snapshot_fn, "w")
+            self._f.write("[")
+        return self
+
+    def write(self, task_data):
+        task_json_str = json.dumps(task_data, separators=(",", ":"))
+        if self.ndjson:
+            self._f.write(task_json_str + "\n")
+        else:
+            self._f.write(("," if self.n_tasks else "") + task_json_str)
+        self.n_tasks += 1
+
+    def __exit__(self, *exc_info):
+        if not self.ndjson:
+            self._f.write("]")
+        self._f.close()
+
+
+def export_tasks_and_annotations(max_workers=8, snapshot_format="json", project_id=None, debug=True):
     """
     Export tasks & annotations from Label Studio.
     This step is required so tasks are loaded correctly into Label Studio.
 
     Args:
+        max_workers (int): Number of concurrent task uploads.
+        snapshot_format (str): Format of the full export blob: 'json' (the Label Studio
+                               export as-is) or 'ndjson.gz' (gzip-compressed, one task per line).
+        project_id (int): Label Studio project id. Found by title if None.
         debug (bool): Flag to print debug info.
 
     Returns:
@@ -161,21 +303,35 @@ def export_tasks_and_annotations(debug=True):
         #    task_blob_client = flag_container_client.get_blob_client(blob=task_json_name)
         #    task_blob_client.upload_blob(task_json_str, overwrite=True)
 
-        # Export all tasks.
+        # Export all tasks. Only new or changed tasks are uploaded.
+        project_id = get_project_id(project_id, debug)
         current_time = datetime.now().strftime("%Y%m%d_%H%M%S")
         export_tasks_json_name = f"export_tasks_and_annotations_{current_time}.json"
-        export_tasks_data = get_tasks_export(export_tasks_json_name, debug=debug)
-        for task_data in export_tasks_data:
-            task_json_name = TASK_NAME_F(task_data['id'])
-            # Prepare the task data.
-            task_json_str = json.dumps(task_data, indent=4)
-            # Store the task data in the blob.
-            task_blob_client = flag_container_client.get_blob_client(blob=task_json_name)
-            task_blob_client.upload_blob(task_json_str, overwrite=True)
-        # Store the export tasks in a single blob too.
-        export_tasks_str = json.dumps(export_tasks_data, indent=4)
-        export_tasks_blob_client = flag_container_client.get_blob_client(blob=export_tasks_json_name)
-        export_tasks_blob_client.upload_blob(export_tasks_str, overwrite=True)
+        export_snapshot_name = f"export_tasks_and_annotations_{current_time}.{snapshot_format}"
+        task_ids = []
+        stored_md5s = get_stored_task_md5s(flag_container_client)
+
+        def iter_task_blobs(snapshot_writer=None):
+            for task_data in iter_tasks_export(export_tasks_json_name, debug=debug, project_id=project_id):
+                task_ids.append(task_data['id'])
+                if snapshot_writer is not None:
+                    snapshot_writer.write(task_data)
+                yield TASK_NAME_F(task_data['id']), task_data
+
+        if snapshot_format == "json":
+            n_uploaded = upload_changed_tasks(flag_container_client, iter_task_blobs(), stored_md5s,
+                                              max_workers=max_workers, debug=debug)
+        else:
+            # Write the compressed snapshot while the export is streamed.
+            with TasksSnapshotWriter(export_snapshot_name) as snapshot_writer:
+                n_uploaded = upload_changed_tasks(flag_container_client, iter_task_blobs(snapshot_writer), stored_md5s,
+                                                  max_workers=max_workers, debug=debug)
+        if debug:
+            print(f"Uploaded {n_uploaded} new or changed tasks (out of {len(task_ids)}).")
+        # Store the export tasks in a single blob too. The json export file is uploaded as-is.
+        export_tasks_blob_client = flag_container_client.get_blob_client(blob=export_snapshot_name)
+        with open(export_tasks_json_name if snapshot_format == "json" else export_snapshot_name, "rb") as f:
+            export_tasks_blob_client.upload_blob(f, overwrite=True)
 
         # TODO: AUX TEST. Save project.json with main labels
         #from config import load_json_file
@@ -185,20 +341,171 @@ def export_tasks_and_annotations(debug=True):
         #ls_label_blob_client_2 = flag_container_client.get_blob_client(blob=label_name_aggregated)
         #ls_label_blob_client_2.upload_blob(project_json, overwrite=True)
 
-        return [task_data['id'] for task_data in export_tasks_data]
+        return task_ids
     
     except Exception as e:
         raise RuntimeError(f"Failed happen during loading labels step: {str(e)}")
 
 
+def iter_changed_task_ids(watermark, project_id):
+    """
+    Ids of the tasks updated or annotated after the watermark, using the data manager filters.
+    """
+    labelstudio_client = get_labelstudio_client()
+    filters = {"conjunction": "or", "items": [
+        {"filter": f"filter:tasks:{field}", "operator": "greater", "type": "Datetime", "value": watermark}
+        for field in ("updated_at", "completed_at")
+    ]}
+    params = {"query": json.dumps({"filters": filters})}
+    for task_data in labelstudio_client.iter_tasks(project_id, fields="task_only", params=params):
+        yield task_data["id"]
+
+
+def export_tasks_incremental(max_workers=8, prune_deleted=False, snapshot_format="json", project_id=None, debug=True):
+    """
+    Export only the tasks changed since the last export, and merge them into the stored
+    project snapshot ('EXPORT_SNAPSHOT_NAME'). The watermark (start time of the last export's
+    queries, minus 'EXPORT_WATERMARK_MARGIN_SECS') is kept in 'EXPORT_STATE_FN', so tasks
+    updated while an export runs are picked up by the next one. A full export is run when
+    there is no state yet.
+
+    Args:
+        max_workers (int): Number of concurrent task uploads.
+        prune_deleted (bool): Also drop tasks deleted in Label Studio. It lists all task ids.
+        snapshot_format (str): Format of the merged snapshot: 'json' or 'ndjson.gz'.
+                               The previous snapshot is read in its own format.
+        project_id (int): Label Studio project id. Found by title if None.
+        debug (bool): Flag to print debug info.
+
+    Returns:
+        List(int): List of exported (changed) task id(s).
+    """
+
+    try:
+        blob_url = os.getenv("AZURE_STORAGE_CONNECTION_STRING")
+        container_name = os.getenv("CONTAINER_NAME")
+
+        # Create a blob service client
+        blob_service_client = BlobServiceClient.from_connection_string(blob_url)
+        # Create a blob client for the flag container.
+        flag_container_client = blob_service_client.get_container_client(container_name)
+        state_blob_client = flag_container_client.get_blob_client(blob=EXPORT_STATE_FN)
+
+        # Load the last export state.
+        export_state = None
+        if state_blob_client.exists():
+            export_state = json.loads(state_blob_client.download_blob().readall())
+
+        labelstudio_client = get_labelstudio_client()
+        project_id = get_project_id(project_id, debug)
+        # Tasks updated from now on are exported next time, even if this export also gets them.
+        watermark = (datetime.now(timezone.utc) - timedelta(seconds=EXPORT_WATERMARK_MARGIN_SECS)).isoformat()
+        if export_state is None:
+            # First run: full export, used as the base snapshot.
+            if debug:
+                print("No export state found. Running a full export.")
+            changed_tasks = labelstudio_client.iter_project_export(project_id)
+            base_snapshot_fn = None
+        else:
+            changed_task_ids = list(iter_changed_task_ids(export_state["watermark"], project_id))
+            if debug:
+                print(f"Found {len(changed_task_ids)} tasks changed since {export_state['watermark']}.")
+            changed_tasks = (
+                task_data
+                for i in range(0, len(changed_task_ids), EXPORT_IDS_CHUNK)
+                for task_data in labelstudio_client.iter_project_export(
+                    project_id, params={"ids": changed_task_ids[i:i + EXPORT_IDS_CHUNK]})
+            )
+            base_snapshot_fn = export_state["snapshot"]
+
+        # Upload the changed tasks.
+        changed_tasks_dict = {}
+        exported_task_ids = []
+
+        def iter_task_blobs():
+            for task_data in changed_tasks:
+                changed_tasks_dict[task_data['id']] = task_data
+                exported_task_ids.append(task_data['id'])
+                yield TASK_NAME_F(task_data['id']), task_data
+
+        stored_md5s = get_stored_task_md5s(flag_container_client)
+        n_uploaded = upload_changed_tasks(flag_container_client, iter_task_blobs(), stored_md5s,
+                                          max_workers=max_workers, debug=debug)
+
+        if export_state is not None and not changed_tasks_dict and not prune_deleted:
+            if debug:
+                print("Nothing changed since the last export.")
+            return []
+
+        # Task ids still in Label Studio, to drop deleted tasks.
+        alive_task_ids = None
+        if prune_deleted:
+            alive_task_ids = {task_data["id"] for task_data in labelstudio_client.iter_tasks(project_id, fields="task_only")}
+
+        # Merge the changed tasks into the snapshot, streaming the previous one.
+        def iter_merged_tasks():
+            if base_snapshot_fn is not None:
+                for task_data in iter_tasks_export_from_azure(base_snapshot_fn, debug=debug):
+                    yield changed_tasks_dict.pop(task_data['id'], task_data)
+            # New tasks, not in the previous snapshot.
+            yield from list(changed_tasks_dict.values())
+
+        export_snapshot_name = f"{EXPORT_SNAPSHOT_NAME}.{snapshot_format}"
+        local_snapshot_fn = f"tmp_{export_snapshot_name}"
+        with TasksSnapshotWriter(local_snapshot_fn) as snapshot_writer:
+            for task_data in iter_merged_tasks():
+                if alive_task_ids is not None and task_data['id'] not in alive_task_ids:
+                    continue
+                snapshot_writer.write(task_data)
+        n_tasks = snapshot_writer.n_tasks
+
+        snapshot_blob_client = flag_container_client.get_blob_client(blob=export_snapshot_name)
+        with open(local_snapshot_fn, "rb") as f:
+            snapshot_blob_client.upload_blob(f, overwrite=True)
+        os.remove(local_snapshot_fn)
+
+        # Save the new watermark only after the snapshot is stored.
+        export_state = {
+            "watermark": watermark,
+            "snapshot": export_snapshot_name,
+            "updated": datetime.now().strftime("%Y%m%d_%H%M%S"),
+        }
+        state_blob_client.upload_blob(json.dumps(export_state, indent=4), overwrite=True)
+
+        if debug:
+            print(f"Incremental export: {n_uploaded} task blobs uploaded, {n_tasks} tasks in the snapshot.")
+
+        return exported_task_ids
+
+    except Exception as e:
+        raise RuntimeError(f"Failed happen during incremental export step: {str(e)}")
+
+
 if __name__ == "__main__":
     parser = ArgumentParser()
     parser.add_argument("-e", "--export",
                         dest="export", default=True,
                         help="Run Export of Tasks and Annotations")
-    
+    parser.add_argument("-i", "--incremental",
+                        dest="incremental", action="store_true",
+                        help="Export only the tasks changed since the last export, and merge them into the snapshot")
+    parser.add_argument("-f", "--format",
+                        dest="snapshot_format", default="json", choices=SNAPSHOT_FORMATS,
+                        help="Format of the export snapshot blob: 'json' or gzip-compressed NDJSON ('ndjson.gz')")
+    parser.add_argument("--prune_deleted",
+                        dest="prune_deleted", action="store_true",
+                        help="On incremental exports, drop the tasks deleted in Label Studio")
+    parser.add_argument("-p", "--project_id",
+                        dest="project_id", default=None, type=int,
+                        help="Id of the Label Studio project (found by title if not set)")
+    args = parser.parse_args()
+
     # Load env vars.
     load_env_vars()
 
     # Recreate labels.
-    export_tasks_and_annotations()
+    if args.incremental:
+        export_tasks_incremental(prune_deleted=args.prune_deleted, snapshot_format=args.snapshot_format,
+                                 project_id=args.project_id)
+    else:
+        export_tasks_and_annotations(snapshot_format=args.snapshot_format, project_id=args.project_id)
@@ -1,35 +1,21 @@
 from argparse import ArgumentParser
-import os
 from datetime import datetime
-import json
-import subprocess
-from config import load_json_file
-from azure.storage.blob import BlobServiceClient
 from config import load_env_vars
-from LS_export_data_manually import get_tasks_export, TASK_NAME_F
+from LS_client import get_labelstudio_client
+from LS_export_data_manually import iter_tasks_export, TASK_NAME_F
+from LS_load_project import find_labelstudio_project
+from blob_layout import get_prefix_format, get_sync_prefix
 
 
-def get_individual_tasks(debug=True):
+def get_individual_tasks(project_id, page_size=100, max_workers=4, debug=True):
     """
-    Get all tasks from Label Studio.
+    Get all tasks from Label Studio, using the paginated task listing.
     """
     task_data_dict = {}
-    labelstudio_token = os.getenv("LABELSTUDIO_TOKEN")
-    for task_id in range(1,10000):
-        task_json_name = TASK_NAME_F(task_id)
-        if task_json_name in os.listdir():
-            os.remove(task_json_name)
-        sp = subprocess.run(f"curl -H 'Authorization: Token {labelstudio_token}' -H 'Content-Type: application/json'  -X GET 'http://localhost:8080/api/tasks/{task_id}/' -o {task_json_name}", shell=True)
-
-        # Load the task data
-        task_data = load_json_file(task_json_name)
-
-        # Stop whenever we reach the last task.
-        # > the json will have a "status_code" key and a value of 404.
-        if "status_code" in task_data and task_data["status_code"] == 404:
-            break
-
-        # If we have a task, add the task to the dict.
+    labelstudio_client = get_labelstudio_client()
+    for task_data in labelstudio_client.iter_tasks(project_id, page_size=page_size, max_workers=max_workers):
+        task_json_name = TASK_NAME_F(task_data['id'])
+        # Add the task to the dict.
         task_data_dict[task_json_name] = task_data
     
     print(f">>> DEBUG <<< Get individual tasks, successfully.")
@@ -37,11 +23,15 @@ def get_individual_tasks(debug=True):
     return task_data_dict
 
 
-def get_new_tasks_and_remove_duplicates(azure_storage_id=1, debug=True):
+def get_new_tasks_and_remove_duplicates(project_id=None, azure_storage_id=None, sync_days=2, debug=True):
     """
     Get new tasks & remove duplicates.
 
     Args:
+        project_id (int): Id of the Label Studio project. Found by title if None.
+        azure_storage_id (int): Id of the import storage of new flags. Found by title if None.
+        sync_days (int): With partitioned flags ('FLAG_BLOB_PREFIX_FORMAT'), only the
+                         partitions of the last 'sync_days' days are synced.
         debug (bool): Flag to print debug info.
 
     Returns:
@@ -49,19 +39,34 @@ def get_new_tasks_and_remove_duplicates(azure_storage_id=1, debug=True):
     """
 
     try:
-        labelstudio_token = os.getenv("LABELSTUDIO_TOKEN")
+        labelstudio_client = get_labelstudio_client()
+
+        # Ids of the project & storage set up by 'load_labelstudio_project'.
+        if project_id is None or azure_storage_id is None:
+            project_ids = find_labelstudio_project(debug)
+            project_id = project_id or project_ids["project"]
+            azure_storage_id = azure_storage_id or project_ids["import_storage"]
+            if project_id is None or azure_storage_id is None:
+                raise RuntimeError(f"Label Studio project not set up (found ids: {project_ids}). Run 'main.py' first.")
+
+        # Scope the sync to the recent partitions, so it does not list the whole archive.
+        if get_prefix_format():
+            sync_prefix = get_sync_prefix(sync_days)
+            labelstudio_client.update_import_storage(azure_storage_id, {"prefix": sync_prefix})
+            if debug:
+                print(f">>> DEBUG <<< Import storage {azure_storage_id} scoped to prefix: '{sync_prefix}'")
 
         # Sync Import Storage. Load new images.
-        sp = subprocess.run(f"curl -H 'Authorization: Token {labelstudio_token}' -H 'Content-Type: application/json' -X POST 'http://localhost:8080/api/storages/azure/{azure_storage_id}/sync' -o sync_import_blob_imgs.json", shell=True)
-        sync_import_blob_dict = load_json_file('sync_import_blob_imgs.json')
+        sync_import_blob_dict = labelstudio_client.sync_import_storage(azure_storage_id)
         if debug:
             print(f">>> DEBUG <<< Successfully synced import storage: {azure_storage_id}")
  
         # Get all tasks.
         current_time = datetime.now().strftime("%Y%m%d_%H%M%S")
         export_tasks_json_name = f"export_tasks_and_annotations_{current_time}.json"
-        task_export_list = get_tasks_export(export_tasks_json_name, debug=debug)
-        #task_data_dict = get_individual_tasks(debug=debug)
+        #task_data_dict = get_individual_tasks(project_id, debug=debug)
+        # Keep only the task ids of the export in memory.
+        task_export_ids = []
         # Create a set to store the task names.
         task_img_set = set()
         latest_task_i = 0
@@ -69,20 +74,21 @@ def get_new_tasks_and_remove_duplicates(azure_storage_id=1, debug=True):
 
         # Iterate over the tasks and overwrite duplicates.
         good_tasks = []
-        for task_dict in task_export_list:
+        # The export lists the tasks by id, which the gap filling below relies on.
+        for task_dict in iter_tasks_export(export_tasks_json_name, debug=debug, project_id=project_id):
         #for task_json_name, task_dict in task_data_dict.items():
             # Get the task metadeta for update.
             task_id = task_dict['id']
+            task_export_ids.append(task_id)
             task_data = task_dict['data']
             task_img = task_data['image']
             task_img_png = task_img.split("?")[0]
-            task_project_id = task_dict['project']
             
             # Check if the task name is already in the set. If so, skip for now.
             if task_img_png in task_img_set:
                 if debug:
                     # Print the task info.
-                    print(f">>> DEBUG <<< SKIPPING DUPLICATE TASK: Task ID: {task_id}, Task Project: {task_project_id}, Task Data: {task_data}.")
+                    print(f">>> DEBUG <<< SKIPPING DUPLICATE TASK: Task ID: {task_id}, Task Project: {project_id}, Task Data: {task_data}.")
                 
                 continue
             
@@ -90,7 +96,7 @@ def get_new_tasks_and_remove_duplicates(azure_storage_id=1, debug=True):
             if latest_task_i+1 < task_id:
                 if debug:
                     # Print the task info.
-                    print(f">>> DEBUG <<< PREPARE UPDATE: Old Task ID: {task_id}, New Task ID: {latest_task_i+1}, Task Project: {task_project_id}, Task Data: {task_data}.")
+                    print(f">>> DEBUG <<< PREPARE UPDATE: Old Task ID: {task_id}, New Task ID: {latest_task_i+1}, Task Project: {project_id}, Task Data: {task_data}.")
                 
                 task_id = latest_task_i+1
                 good_tasks += [{"data": task_data, "meta": {}, "annotations": [], "predictions": []}]
@@ -109,27 +115,25 @@ def get_new_tasks_and_remove_duplicates(azure_storage_id=1, debug=True):
             # Add the task name to the set.
             task_img_set.add(task_img_png)
 
-        # Delete unneeded tasks.
-        for i in range(latest_task_i, len(task_export_list)):
-        #for task_id in range(latest_task_id+1, len(task_data_dict)+1):
-            task_id = task_export_list[i]['id']
+        # Delete unneeded tasks, in bulk.
+        delete_task_ids = task_export_ids[latest_task_i:]
+        if delete_task_ids:
             if debug:
                 # Print the task info.
-                print(f">>> DEBUG <<< PREPARE DELETION Task ID: {task_id}")
+                print(f">>> DEBUG <<< PREPARE DELETION of {len(delete_task_ids)} tasks: {delete_task_ids[0]} - {delete_task_ids[-1]}")
 
-            task_del_json_name = f"task_deletion_{task_id}.json"
-            sp = subprocess.run(f"curl -H 'Authorization: Token {labelstudio_token}' -X DELETE 'http://localhost:8080/api/tasks/{task_id}/'", shell=True)
+            labelstudio_client.delete_tasks(project_id, delete_task_ids)
 
             if debug:
                 # Print the task info.
-                print(f">>> DEBUG <<< DELETED Task ID: {task_id}")
+                print(f">>> DEBUG <<< DELETED {len(delete_task_ids)} tasks.")
         
-        # Manually import good tasks.
-        task_import_json_str = json.dumps(good_tasks)
-        task_import_json_name = f"task_import_{task_id}.json"
-        if task_import_json_name in os.listdir():
-            os.remove(task_import_json_name)
-        sp = subprocess.run(f"curl -H 'Authorization: Token {labelstudio_token}' -H 'Content-Type: application/json' -X POST 'http://localhost:8080/api/projects/{task_project_id}/import' --data '{task_import_json_str}' -o {task_import_json_name}", shell=True)
+        # Manually import good tasks, in chunks. One chunk at a time, so the new ids are
+        # consecutive and follow the order of 'good_tasks'.
+        if good_tasks:
+            n_imported = labelstudio_client.import_tasks_chunked(project_id, good_tasks, max_workers=1, debug=debug)
+            if debug:
+                print(f">>> DEBUG <<< Imported {n_imported} tasks.")
         
         return [task_id for task_id in range(1, latest_task_i+len(good_tasks)+1)]
     
@@ -142,9 +146,16 @@ if __name__ == "__main__":
     parser.add_argument("-e", "--export",
                         dest="export", default=True,
                         help="Run Export of Tasks and Annotations")
-    
+    parser.add_argument("-p", "--project_id",
+                        dest="project_id", default=None, type=int,
+                        help="Id of the Label Studio project (found by title if not set)")
+    parser.add_argument("-s", "--storage_id",
+                        dest="storage_id", default=None, type=int,
+                        help="Id of the import storage of new flags (found by title if not set)")
+    args = parser.parse_args()
+
     # Load env vars.
     load_env_vars()
 
     # Recreate labels.
-    get_new_tasks_and_remove_duplicates()
+    get_new_tasks_and_remove_duplicates(project_id=args.project_id, azure_storage_id=args.storage_id)
@@ -2,7 +2,6 @@ from argparse import ArgumentParser
 import os
 from datetime import datetime
 import json
-import subprocess
 from config import load_json_file
 from azure.storage.blob import BlobServiceClient
 from config import load_env_vars
@@ -1,76 +1,137 @@
 from argparse import ArgumentParser
-import os
-from datetime import datetime
-import json
-import subprocess
-from config import load_json_file
-from azure.storage.blob import BlobServiceClient
-from config import load_env_vars
-from LS_export_data_manually import get_tasks_export
-from LS_load_json_files import load_labelstudio_json_to_str
+from concurrent.futures import ThreadPoolExecutor
+from LS_client import get_labelstudio_client
+from LS_load_json_files import load_labelstudio_json
+from blob_layout import get_prefix_format, get_sync_prefix
 
 
 def load_labelstudio_project(debug=True):
     """
     Create the project, connect to Azure, import tasks, and retrieve latest images.
+    It is idempotent: the project and storages are found by title, and only missing steps are run.
+    The import and export storage setups are independent, so they run concurrently.
+
+    Returns:
+        dict: Ids of the project, import storage & export storage.
     """
-    labelstudio_token = os.getenv("LABELSTUDIO_TOKEN")
+    labelstudio_client = get_labelstudio_client()
 
-    # Create New Project
+    # Get or Create New Project
     json_filename = "LS_jsons/create_new_project.json"
-    out_json_filename = f"{json_filename[:-5]}_response.json"
-    json_str = load_labelstudio_json_to_str(json_filename, debug)
-    sp = subprocess.run(f"curl -H 'Authorization: Token {labelstudio_token}' -H 'Content-Type: application/json' -X POST 'http://localhost:8080/api/projects' -d '{json_str}' -o {out_json_filename}", shell=True)
-    #sp = subprocess.run(f"curl -H 'Authorization: Token {labelstudio_token}' -H 'Content-Type: application/json' -X POST 'http://localhost:8080/api/projects' -d @LS_jsons/create_new_project.json -o new_project_response.json", shell=True)
-    if debug:
-        new_proj_dict = load_json_file(out_json_filename)
-        print(f"******** DEBUG, {out_json_filename} ********", new_proj_dict)
-    
-    # Create New Azure Import Storage
-    json_filename = "LS_jsons/create_new_import_azure_blob_tasks.json"
-    out_json_filename = f"{json_filename[:-5]}_response.json"
-    json_str = load_labelstudio_json_to_str(json_filename, debug)
-    sp = subprocess.run(f"curl -H 'Authorization: Token {labelstudio_token}' -H 'Content-Type: application/json' -X POST 'http://localhost:8080/api/storages/azure' -d '{json_str}' -o {out_json_filename}", shell=True)
-    #sp = subprocess.run(f"curl -H 'Authorization: Token {labelstudio_token}' -H 'Content-Type: application/json' -X POST 'http://localhost:8080/api/storages/azure' -d @LS_jsons/create_new_import_azure_blob_tasks.json -o import_blob_tasks_setup_response.json", shell=True)
-    if debug:
-        import_blob_setup_dict = load_json_file(out_json_filename)
-        print(f"******** DEBUG, {out_json_filename} ********", import_blob_setup_dict)
+    new_proj_dict = load_labelstudio_json(json_filename, debug)
+    project_dict = find_by_title(labelstudio_client.list_projects(), new_proj_dict["title"])
+    if project_dict is None:
+        project_dict = labelstudio_client.create_project(new_proj_dict)
+        if debug:
+            print(f"******** DEBUG, {json_filename} response ********", project_dict)
+    elif debug:
+        print(f"******** DEBUG, found project '{project_dict['title']}': {project_dict['id']} ********")
+    project_id = project_dict["id"]
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        import_future = executor.submit(setup_import_storage, labelstudio_client, project_id, debug)
+        export_future = executor.submit(setup_export_storage, labelstudio_client, project_id, debug)
+        import_storage_id = import_future.result()
+        export_storage_id = export_future.result()
+
+    return {"project": project_id, "import_storage": import_storage_id, "export_storage": export_storage_id}
+
+
+def setup_import_storage(labelstudio_client, project_id, debug=True):
+    """
+    Create the Azure import storage, import the exported tasks, and point it to the new flags.
+    """
+    tasks_dict = load_labelstudio_json("LS_jsons/create_new_import_azure_blob_tasks.json", debug)
+    flags_dict = load_labelstudio_json("LS_jsons/create_new_import_azure_blob.json", debug)
+    tasks_dict["project"] = flags_dict["project"] = project_id
+    # Partitioned flags: sync only the recent partitions.
+    if get_prefix_format():
+        flags_dict["prefix"] = get_sync_prefix()
+    import_storages = labelstudio_client.list_import_storages(project_id)
+
+    # Already set up for new flags: nothing to do.
+    import_storage_dict = find_by_title(import_storages, flags_dict["title"])
+    if import_storage_dict is not None:
+        if debug:
+            print(f"******** DEBUG, found import storage '{flags_dict['title']}': {import_storage_dict['id']} ********")
+        return import_storage_dict["id"]
+
+    # Create New Azure Import Storage (unless a previous run stopped after creating it)
+    import_storage_dict = find_by_title(import_storages, tasks_dict["title"])
+    if import_storage_dict is None:
+        import_storage_dict = labelstudio_client.create_import_storage(tasks_dict)
+        if debug:
+            print(f"******** DEBUG, create import storage response ********", import_storage_dict)
+    import_storage_id = import_storage_dict["id"]
 
     # Sync Import Storage
-    out_json_filename = f"LS_jsons/sync_import_blob_response.json"
-    sp = subprocess.run(f"curl -H 'Authorization: Token {labelstudio_token}' -H 'Content-Type: application/json' -X POST 'http://localhost:8080/api/storages/azure/1/sync' -o {out_json_filename}", shell=True)
-    #sp = subprocess.run(f"curl -H 'Authorization: Token {labelstudio_token}' -H 'Content-Type: application/json' -X POST 'http://localhost:8080/api/storages/azure/1/sync' -o sync_import_blob_json.json", shell=True)
+    sync_import_blob_dict = labelstudio_client.sync_import_storage(import_storage_id)
     if debug:
-        sync_import_blob_dict = load_json_file(out_json_filename)
-        print(f"******** DEBUG, {out_json_filename} ********", sync_import_blob_dict)
-
-    # Create New Azure Export Storge
-    json_filename = "LS_jsons/create_new_export_azure_blob.json"
-    out_json_filename = f"{json_filename[:-5]}_response.json"
-    json_str = load_labelstudio_json_to_str(json_filename, debug)
-    sp = subprocess.run(f"curl -H 'Authorization: Token {labelstudio_token}' -H 'Content-Type: application/json' -X POST 'http://localhost:8080/api/storages/export/azure' -d '{json_str}' -o {out_json_filename}", shell=True)
-    #sp = subprocess.run(f"curl -H 'Authorization: Token {labelstudio_token}' -H 'Content-Type: application/json' -X POST 'http://localhost:8080/api/storages/export/azure' -d @LS_jsons/create_new_export_azure_blob.json -o export_blob_setup_response.json", shell=True)
+        print(f"******** DEBUG, sync import storage response ********", sync_import_blob_dict)
+
+    # Update Import Storage for New Flags
+    update_import_storage_dict = labelstudio_client.update_import_storage(import_storage_id, flags_dict)
     if debug:
-        export_blob_setup_dict = load_json_file(out_json_filename)
-        print(f"******** DEBUG, {out_json_filename} ********", export_blob_setup_dict)
+        print(f"******** DEBUG, update import storage PATCH response ********", update_import_storage_dict)
+
+    return import_storage_id
+
+
+def setup_export_storage(labelstudio_client, project_id, debug=True):
+    """
+    Create the Azure export storage (if missing), and sync it.
+    """
+    export_dict = load_labelstudio_json("LS_jsons/create_new_export_azure_blob.json", debug)
+    export_dict["project"] = project_id
+
+    # Get or Create New Azure Export Storge
+    export_storage_dict = find_by_title(labelstudio_client.list_export_storages(project_id), export_dict["title"])
+    if export_storage_dict is None:
+        export_storage_dict = labelstudio_client.create_export_storage(export_dict)
+        if debug:
+            print(f"******** DEBUG, create export storage response ********", export_storage_dict)
+    export_storage_id = export_storage_dict["id"]
+
     # Sync Export Storage
-    out_json_filename = f"LS_jsons/sync_export_blob_response.json"
-    json_str = load_labelstudio_json_to_str(json_filename, debug)
-    sp = subprocess.run(f"curl -H 'Authorization: Token {labelstudio_token}' -H 'Content-Type: application/json' -X POST 'http://localhost:8080/api/storages/export/azure/2/sync' -o {out_json_filename}", shell=True)
-    #sp = subprocess.run(f"curl -H 'Authorization: Token {labelstudio_token}' -H 'Content-Type: application/json' -X POST 'http://localhost:8080/api/storages/export/azure/2/sync' -o sync_export_blob.json", shell=True)
+    sync_export_blob_dict = labelstudio_client.sync_export_storage(export_storage_id)
     if debug:
-        sync_export_blob_dict = load_json_file(out_json_filename)
-        print(f"******** DEBUG, {out_json_filename} ********", sync_export_blob_dict)
+        print(f"******** DEBUG, sync export storage response ********", sync_export_blob_dict)
 
-    # Update Import Storage for New Flags
-    json_filename = "LS_jsons/create_new_import_azure_blob.json"
-    out_json_filename = f"{json_filename[:-5]}_PATCH_response.json"
-    json_str = load_labelstudio_json_to_str(json_filename, debug)
-    sp = subprocess.run(f"curl -H 'Authorization: Token {labelstudio_token}' -H 'Content-Type: application/json' -X PATCH 'http://localhost:8080/api/storages/azure/1' -d '{json_str}' -o {out_json_filename}", shell=True)
-    #sp = subprocess.run(f"curl -H 'Authorization: Token {labelstudio_token}' -H 'Content-Type: application/json' -X PATCH 'http://localhost:8080/api/storages/azure/1' -d @LS_jsons/create_new_import_azure_blob.json -o import_blob_imgs_setup_response.json", shell=True)
-    if debug:
-        update_import_storage_dict = load_json_file(out_json_filename)
-        print(f"******** DEBUG, {out_json_filename} ********", update_import_storage_dict)   
+    return export_storage_id
+
+
+def find_labelstudio_project(debug=True):
+    """
+    Find the ids of the project & storages created by 'load_labelstudio_project', without
+    creating nor syncing anything. Ids not found are None.
+
+    Returns:
+        dict: Ids of the project, import storage (of new flags) & export storage.
+    """
+    labelstudio_client = get_labelstudio_client()
+    project_ids = {"project": None, "import_storage": None, "export_storage": None}
+    new_proj_dict = load_labelstudio_json("LS_jsons/create_new_project.json", debug)
+    project_dict = find_by_title(labelstudio_client.list_projects(), new_proj_dict["title"])
+    if project_dict is None:
+        return project_ids
+    project_ids["project"] = project_id = project_dict["id"]
+
+    flags_dict = load_labelstudio_json("LS_jsons/create_new_import_azure_blob.json", debug)
+    import_storage_dict = find_by_title(labelstudio_client.list_import_storages(project_id), flags_dict["title"])
+    if import_storage_dict is not None:
+        project_ids["import_storage"] = import_storage_dict["id"]
+    export_dict = load_labelstudio_json("LS_jsons/create_new_export_azure_blob.json", debug)
+    export_storage_dict = find_by_title(labelstudio_client.list_export_storages(project_id), export_dict["title"])
+    if export_storage_dict is not None:
+        project_ids["export_storage"] = export_storage_dict["id"]
+    return project_ids
+
+
+def find_by_title(items, title):
+    """
+    Find a project or storage by its title. Returns None if not found.
+    """
+    return next((item for item in items or [] if item.get("title") == title), None)
 
 
 if __name__ == "__main__":
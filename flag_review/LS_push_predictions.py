@@ -0,0 +1,194 @@
+from argparse import ArgumentParser
+import os
+import sys
+from collections import deque
+from itertools import islice
+from multiprocessing import Pool
+import cv2
+import numpy as np
+from azure.storage.blob import BlobServiceClient
+from config import load_env_vars
+from LS_client import get_labelstudio_client
+from LS_load_project import find_labelstudio_project
+from blob_cache import iter_blobs
+from blob_layout import get_blob_name
+
+# LOAD BORDER DETECTION FROM FLAG FUNCTION APP "../flag-function-app/flag_generation/border_detection.py".
+# Requires opencv (conda environment), it is not part of the Label Studio container.
+flag_generation_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'flag-function-app', 'flag_generation'))
+if flag_generation_dir not in sys.path:
+    sys.path.insert(1, flag_generation_dir)
+from border_detection import detect_borders, DETECTOR_VERSION, BORDER_HIGH_SCORE, BORDER_MIDDLE_SCORE
+
+# Labels of the review project (see "LS_jsons/create_new_project.json").
+LABEL_FROM_NAME = "choice"
+LABEL_TO_NAME = "image"
+LABEL_HAS_BORDERS = "Has borders"
+LABEL_GOOD_FLAG = "Good flag"
+MODEL_VERSION = f"detect_borders-{DETECTOR_VERSION}"
+
+
+def get_prediction_score(img_has_borders, borders_sum, high_score=BORDER_HIGH_SCORE, middle_score=BORDER_MIDDLE_SCORE):
+    """
+    Confidence of a border classification, from the border line sums.
+    The border strength is ~1 at the decision boundary of 'detect_borders', so the score
+    is ~0.5 for ambiguous images and tends to 1 for clear cases.
+    """
+    h_sum, v_sum = borders_sum
+    strength = max(max(h_sum, v_sum) / high_score, min(h_sum, v_sum) / middle_score)
+    if img_has_borders:
+        return strength / (1 + strength)
+    return 1 / (1 + strength)
+
+
+def build_prediction(task_id, img_has_borders, score):
+    """
+    Label Studio prediction for a task, with the border classification as a choice.
+    """
+    choice = LABEL_HAS_BORDERS if img_has_borders else LABEL_GOOD_FLAG
+    return {
+        "task": task_id,
+        "model_version": MODEL_VERSION,
+        "score": round(score, 4),
+        "result": [{
+            "from_name": LABEL_FROM_NAME,
+            "to_name": LABEL_TO_NAME,
+            "type": "choices",
+            "value": {"choices": [choice]},
+        }],
+    }
+
+
+def iter_new_tasks(project_id, debug=True):
+    """
+    Tasks without annotations nor predictions yet.
+    """
+    labelstudio_client = get_labelstudio_client()
+    for task_data in labelstudio_client.iter_tasks(project_id):
+        n_annotations = task_data.get("total_annotations", len(task_data.get("annotations") or []))
+        n_predictions = task_data.get("total_predictions", len(task_data.get("predictions") or []))
+        if n_annotations or n_predictions:
+            continue
+        yield task_data
+
+
+def push_predictions(project_id=None, n_workers=None, max_downloads=8, chunk_size=200,
+                     auto_accept_score=None, debug=True):
+    """
+    Run the border detection over new tasks in parallel, and push the results as
+    Label Studio predictions in chunks. Reviewers see them as pre-annotations.
+    If 'auto_accept_score' is set, clear "Has borders" predictions are also saved as
+    annotations. Good flags are never auto-accepted, as the appeal needs a reviewer.
+
+    Args:
+        project_id (int): Label Studio project id. Found by title if None.
+        n_workers (int): Number of detection processes. Defaults to the number of CPUs.
+        max_downloads (int): Number of concurrent image downloads.
+        chunk_size (int): Number of predictions per import request.
+        auto_accept_score (float): Min score to auto-accept a "Has borders" prediction.
+                                   Defaults to the 'PREDICTION_AUTO_ACCEPT_SCORE' env var (disabled if unset).
+        debug (bool): Flag to print debug info.
+
+    Returns:
+        (int, int): Number of pushed predictions & auto-accepted annotations.
+    """
+
+    try:
+        blob_url = os.getenv("AZURE_STORAGE_CONNECTION_STRING")
+        container_name = os.getenv("CONTAINER_NAME")
+
+        # Create a blob service client
+        blob_service_client = BlobServiceClient.from_connection_string(blob_url)
+        # Create a blob client for the flag container.
+        flag_container_client = blob_service_client.get_container_client(container_name)
+        labelstudio_client = get_labelstudio_client()
+        if project_id is None:
+            project_id = find_labelstudio_project(debug)["project"]
+            if project_id is None:
+                raise RuntimeError("Label Studio project not found. Run 'main.py' first.")
+        auto_accept_score = auto_accept_score or os.getenv("PREDICTION_AUTO_ACCEPT_SCORE")
+        auto_accept_score = float(auto_accept_score) if auto_accept_score else None
+
+        # Download the images of the new tasks, and detect borders in parallel.
+        blob_items = (
+            (get_blob_name(task_data["data"]["image"], container_name), task_data["id"])
+            for task_data in iter_new_tasks(project_id, debug=debug)
+        )
+        prediction_stream = iter_detections(iter_blobs(flag_container_client, blob_items, max_workers=max_downloads),
+                                            n_workers=n_workers)
+
+        n_predictions = 0
+        n_accepted = 0
+        while True:
+            chunk = list(islice(prediction_stream, chunk_size))
+            if not chunk:
+                break
+            predictions = [build_prediction(task_id, img_has_borders, score) for task_id, img_has_borders, score in chunk]
+            labelstudio_client.import_predictions(project_id, predictions)
+            n_predictions += len(predictions)
+
+            # Auto-accept the clear border cases.
+            if auto_accept_score is not None:
+                for prediction, (task_id, img_has_borders, score) in zip(predictions, chunk):
+                    if img_has_borders and score >= auto_accept_score:
+                        labelstudio_client.create_annotation(task_id, prediction["result"])
+                        n_accepted += 1
+
+            if debug:
+                print(f">>> DEBUG <<< Pushed {n_predictions} predictions ({n_accepted} auto-accepted).")
+
+        return n_predictions, n_accepted
+
+    except Exception as e:
+        raise RuntimeError(f"Failed happen during pushing predictions step: {str(e)}")
+
+
+def iter_detections(blob_stream, n_workers=None):
+    """
+    Detect borders of downloaded images with a pool of processes, keeping a bounded
+    number of images in flight.
+
+    Args:
+        blob_stream (iterable): (blob name, task id, image bytes) tuples, e.g. from 'iter_blobs'.
+        n_workers (int): Number of detection processes. Defaults to the number of CPUs.
+
+    Yields:
+        (int, bool, float): Task id, border prediction and score.
+    """
+    with Pool(processes=n_workers) as pool:
+        max_in_flight = 4 * (n_workers or os.cpu_count() or 1)
+        in_flight = deque()
+        for _, task_id, image_data in blob_stream:
+            in_flight.append((task_id, pool.apply_async(_detect_image, (image_data,))))
+            if len(in_flight) >= max_in_flight:
+                task_id, result = in_flight.popleft()
+                yield (task_id, *result.get())
+        while in_flight:
+            task_id, result = in_flight.popleft()
+            yield (task_id, *result.get())
+
+
+def _detect_image(image_data):
+    image = cv2.imdecode(np.frombuffer(image_data, np.uint8), cv2.IMREAD_COLOR)
+    img_has_borders, borders_sum, _ = detect_borders(image)
+    return bool(img_has_borders), get_prediction_score(img_has_borders, borders_sum)
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("-p", "--project",
+                        dest="project", default=None, type=int,
+                        help="Label Studio project id (found by title if not set)")
+    parser.add_argument("-w", "--workers",
+                        dest="workers", default=None, type=int,
+                        help="Number of detection processes")
+    parser.add_argument("-a", "--auto_accept",
+                        dest="auto_accept", default=None,
+                        help="Min score to auto-accept 'Has borders' predictions")
+    args = parser.parse_args()
+
+    # Load env vars.
+    load_env_vars()
+
+    # Push predictions of new tasks.
+    push_predictions(args.project, n_workers=args.workers, auto_accept_score=args.auto_accept)
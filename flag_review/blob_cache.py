@@ -0,0 +1,206 @@
+import os
+import hashlib
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from azure.core.exceptions import ResourceNotFoundError
+from blob_layout import get_partitioned_name
+
+# Local cache folder & max size. Can be overwritten with env vars.
+DEFAULT_CACHE_DIR = os.getenv("BLOB_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "politikea_blobs"))
+DEFAULT_CACHE_MAX_BYTES = int(os.getenv("BLOB_CACHE_MAX_BYTES", 20 * 1024**3))
+# Share of 'max_bytes' left after an eviction, so the cache folder is not scanned on every miss.
+CACHE_EVICT_TO = float(os.getenv("BLOB_CACHE_EVICT_TO", 0.9))
+
+
+class BlobCache:
+    """
+    Local on-disk cache of Azure blobs, keyed by blob name and ETag.
+    The least recently used blobs are evicted when the cache exceeds 'max_bytes'.
+
+    Layout:
+        objects/<sha256(blob name + etag)>: Blob content.
+        refs/<sha256(blob name)>: Latest known ETag of the blob.
+    """
+
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR, max_bytes=DEFAULT_CACHE_MAX_BYTES, validate=True, debug=False):
+        """
+        Args:
+            cache_dir (str): Folder where the blobs are stored.
+            max_bytes (int): Max size of the cache before evicting blobs.
+            validate (bool): Check the blob ETag in Azure before using a cached copy.
+                             If False, a cached blob is used without any network call.
+            debug (bool): Flag to print debug info.
+        """
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.validate = validate
+        self.debug = debug
+        self.objects_dir = os.path.join(cache_dir, "objects")
+        self.refs_dir = os.path.join(cache_dir, "refs")
+        os.makedirs(self.objects_dir, exist_ok=True)
+        os.makedirs(self.refs_dir, exist_ok=True)
+
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._size = sum(size for _, _, size in self._scan_objects())
+
+    def get(self, container_client, blob_name):
+        """
+        Get the blob content from the cache, downloading it on a miss.
+
+        Args:
+            container_client (ContainerClient): Azure container of the blob.
+            blob_name (str): Name of the blob.
+
+        Returns:
+            bytes: The blob content.
+        """
+        blob_client = container_client.get_blob_client(blob=blob_name)
+        etag = self._read_ref(blob_name)
+        if self.validate or etag is None:
+            etag = blob_client.get_blob_properties().etag
+
+        object_path = self._object_path(blob_name, etag)
+        try:
+            with open(object_path, "rb") as f:
+                blob_data = f.read()
+        except FileNotFoundError:
+            blob_data = None
+        if blob_data is not None:
+            # Touch the object, so it is the most recently used (unless evicted meanwhile).
+            try:
+                os.utime(object_path)
+            except FileNotFoundError:
+                pass
+            with self._lock:
+                self.hits += 1
+            return blob_data
+
+        # Download the blob and store it under its current ETag.
+        downloader = blob_client.download_blob()
+        blob_data = downloader.readall()
+        self._write_object(blob_name, downloader.properties.etag, blob_data)
+        with self._lock:
+            self.misses += 1
+        if self.debug:
+            print(f"Blob cache miss: '{blob_name}' ({len(blob_data)} bytes).")
+        return blob_data
+
+    def prefetch(self, container_client, blob_names, max_workers=8):
+        """
+        Download concurrently the blobs missing in the cache.
+        """
+        for _ in iter_blobs(container_client, ((blob_name, None) for blob_name in blob_names),
+                            max_workers=max_workers, blob_cache=self):
+            pass
+
+    def evict(self):
+        """
+        Remove the least recently used blobs once the cache exceeds 'max_bytes', down to
+        'CACHE_EVICT_TO' of it, so the next misses do not scan the cache folder again.
+        """
+        with self._lock:
+            if self._size <= self.max_bytes:
+                return
+            target_bytes = self.max_bytes * CACHE_EVICT_TO
+            for mtime, path, size in sorted(self._scan_objects()):
+                if self._size <= target_bytes:
+                    break
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    # Removed by another process sharing the cache.
+                    pass
+                self._size -= size
+                if self.debug:
+                    print(f"Blob cache evicted: {os.path.basename(path)} ({size} bytes).")
+
+    def _scan_objects(self):
+        # (mtime, path, size) of the stored objects. Temporary files of writes in progress
+        # are skipped, and so are objects removed meanwhile.
+        objects = []
+        for entry in os.scandir(self.objects_dir):
+            if entry.name.endswith(".tmp"):
+                continue
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            objects.append((stat.st_mtime, entry.path, stat.st_size))
+        return objects
+
+    def _object_path(self, blob_name, etag):
+        key = hashlib.sha256(f"{blob_name}\n{etag}".encode()).hexdigest()
+        return os.path.join(self.objects_dir, key)
+
+    def _ref_path(self, blob_name):
+        return os.path.join(self.refs_dir, hashlib.sha256(blob_name.encode()).hexdigest())
+
+    def _read_ref(self, blob_name):
+        ref_path = self._ref_path(blob_name)
+        if not os.path.exists(ref_path):
+            return None
+        with open(ref_path, "r") as f:
+            return f.read()
+
+    def _write_object(self, blob_name, etag, blob_data):
+        object_path = self._object_path(blob_name, etag)
+        is_new = not os.path.exists(object_path)
+        _atomic_write(object_path, blob_data)
+        _atomic_write(self._ref_path(blob_name), etag.encode())
+        if is_new:
+            with self._lock:
+                self._size += len(blob_data)
+            self.evict()
+
+
+def _atomic_write(path, data):
+    # Write to a temporary file first, so readers never see partial files.
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+def iter_blobs(container_client, items, max_workers=8, blob_cache=None):
+    """
+    Download blobs concurrently, keeping at most 2*max_workers blobs in flight,
+    and yield them in the same order as 'items'. Root-level flags not found are
+    looked up under their date partition (see 'migrate_blob_layout.py').
+
+    Args:
+        container_client (ContainerClient): Azure container of the blobs.
+        items (iterable): (blob_name, context) tuples. The context is passed through as-is.
+        max_workers (int): Number of concurrent downloads.
+        blob_cache (BlobCache): Optional local cache used for the downloads.
+
+    Yields:
+        (str, any, bytes): Blob name, context and blob content.
+    """
+    if blob_cache is not None:
+        download_blob = lambda blob_name: blob_cache.get(container_client, blob_name)
+    else:
+        download_blob = lambda blob_name: container_client.get_blob_client(blob=blob_name).download_blob().readall()
+
+    def download_f(blob_name):
+        try:
+            return download_blob(blob_name)
+        except ResourceNotFoundError:
+            # Older exports & task data still point to the root-level names of migrated flags.
+            partitioned_name = get_partitioned_name(blob_name)
+            if not partitioned_name or partitioned_name == blob_name:
+                raise
+            return download_blob(partitioned_name)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        in_flight = deque()
+        for blob_name, context in items:
+            in_flight.append((blob_name, context, executor.submit(download_f, blob_name)))
+            if len(in_flight) >= 2 * max_workers:
+                blob_name, context, future = in_flight.popleft()
+                yield blob_name, context, future.result()
+        while in_flight:
+            blob_name, context, future = in_flight.popleft()
+            yield blob_name, context, future.result()
@@ -0,0 +1,65 @@
+import os
+import datetime
+from urllib.parse import urlparse, unquote
+
+# Timestamp at the start of every flag name (see 'create_img_name' in the function app).
+FLAG_TIMESTAMP_FORMAT = "%Y%m%d-%H%M%S-%f"
+
+
+def get_prefix_format():
+    """
+    Date partition of the flag blobs, as a strftime format (e.g. "flags/%Y/%m/%d/").
+    Same env var as the function app. Empty if flags are stored at the container root.
+    """
+    return os.getenv("FLAG_BLOB_PREFIX_FORMAT", "")
+
+
+def get_blob_name(img_url, container_name):
+    """
+    Get the blob name of a task image, from either an 'azure-blob://<container>/<name>' or an https URL.
+    Partition folders are kept, unlike the last URL segment.
+    """
+    parsed_url = urlparse(img_url.split("?")[0])
+    blob_path = unquote(parsed_url.path).lstrip("/")
+    if parsed_url.scheme == "azure-blob":
+        # The container is the URL netloc.
+        return blob_path
+    if blob_path.startswith(f"{container_name}/"):
+        blob_path = blob_path[len(container_name) + 1:]
+    return blob_path
+
+
+def get_flag_timestamp(blob_name):
+    """
+    Creation time of a flag, from the timestamp at the start of its name. None if it has no timestamp.
+    """
+    img_name = blob_name.split("/")[-1]
+    try:
+        return datetime.datetime.strptime(img_name.split("_")[0], FLAG_TIMESTAMP_FORMAT)
+    except ValueError:
+        return None
+
+
+def get_partitioned_name(blob_name, prefix_format=None):
+    """
+    Name of a root-level flag blob under its date partition. None if it has no timestamp.
+    """
+    prefix_format = get_prefix_format() if prefix_format is None else prefix_format
+    timestamp = get_flag_timestamp(blob_name)
+    if timestamp is None:
+        return None
+    return f"{timestamp.strftime(prefix_format)}{blob_name.split('/')[-1]}"
+
+
+def get_sync_prefix(days=2, prefix_format=None, now=None):
+    """
+    Narrowest blob prefix covering the partitions of the last 'days' days, e.g.
+    "flags/2025/03/" for "flags/%Y/%m/%d/" (or "flags/2025/" across months).
+    Label Studio storages take a single prefix, so syncs list only this part of the archive.
+    """
+    prefix_format = get_prefix_format() if prefix_format is None else prefix_format
+    now = now or datetime.datetime.now()
+    prefixes = [(now - datetime.timedelta(days=day)).strftime(prefix_format) for day in range(days)]
+    sync_prefix = os.path.commonprefix(prefixes)
+    # Cut at the last folder, so partial names (e.g. "2025/0") do not filter out folders.
+    return sync_prefix[:sync_prefix.rfind("/") + 1]
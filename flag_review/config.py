@@ -1,5 +1,7 @@
 import os
 import json
+import zlib
+import codecs
 
 def load_json_file(json_fn):
     json_dict = {}
@@ -7,6 +9,104 @@ def load_json_file(json_fn):
         json_dict = json.load(f)
     return json_dict
 
+def iter_json_array(chunks):
+    """
+    Parse a top-level JSON array incrementally, yielding each item as soon as it is complete.
+    Only the current item is kept in memory.
+
+    Args:
+        chunks (iterable): Pieces of the JSON document, as str or utf-8 bytes.
+
+    Yields:
+        Items of the JSON array.
+    """
+    decoder = json.JSONDecoder()
+    utf8_decoder = codecs.getincrementaldecoder("utf-8")()
+    buffer = ""
+    started = False
+    for chunk in chunks:
+        buffer += utf8_decoder.decode(chunk) if isinstance(chunk, bytes) else chunk
+        pos = 0
+        while True:
+            # Skip whitespace and separators between items.
+            while pos < len(buffer) and buffer[pos] in " \t\r\n,":
+                pos += 1
+            if pos >= len(buffer):
+                break
+            if not started:
+                if buffer[pos] != "[":
+                    raise ValueError("Expected a JSON array.")
+                started = True
+                pos += 1
+                continue
+            if buffer[pos] == "]":
+                return
+            try:
+                item, end = decoder.raw_decode(buffer, pos)
+            except json.JSONDecodeError:
+                # Incomplete item, wait for the next chunk.
+                break
+            if end == len(buffer) and not isinstance(item, (dict, list, str)):
+                # A number or literal could continue in the next chunk.
+                break
+            yield item
+            pos = end
+        buffer = buffer[pos:]
+    raise ValueError("Unexpected end of the JSON array.")
+
+
+def iter_json_array_file(json_fn, chunk_size=64 * 1024):
+    """
+    Iterate over the items of a JSON array file without loading the whole file.
+    """
+    with open(json_fn, 'r') as f:
+        yield from iter_json_array(iter(lambda: f.read(chunk_size), ''))
+
+
+def iter_ndjson_gz(chunks):
+    """
+    Parse a gzip-compressed NDJSON document incrementally, decompressing it chunk by chunk
+    and yielding each line as soon as it is complete.
+
+    Args:
+        chunks (iterable): Pieces of the compressed document, as bytes.
+
+    Yields:
+        Items of the NDJSON document (one per line).
+    """
+    # 16 + MAX_WBITS: expect a gzip header.
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    buffer = b""
+    for chunk in chunks:
+        buffer += decompressor.decompress(chunk)
+        *lines, buffer = buffer.split(b"\n")
+        for line in lines:
+            if line.strip():
+                yield json.loads(line)
+    buffer += decompressor.flush()
+    if not decompressor.eof:
+        raise ValueError("Unexpected end of the gzip NDJSON document.")
+    if buffer.strip():
+        yield json.loads(buffer)
+
+
+def iter_ndjson_gz_file(ndjson_gz_fn, chunk_size=64 * 1024):
+    """
+    Iterate over the items of a gzip-compressed NDJSON file without loading the whole file.
+    """
+    with open(ndjson_gz_fn, 'rb') as f:
+        yield from iter_ndjson_gz(iter(lambda: f.read(chunk_size), b''))
+
+
+def iter_tasks_chunks(chunks, name):
+    """
+    Parse a tasks snapshot given its name: gzip NDJSON ('.ndjson.gz') or a JSON array.
+    """
+    if name.endswith(".ndjson.gz"):
+        return iter_ndjson_gz(chunks)
+    return iter_json_array(chunks)
+
+
 def load_env_vars(config=None):
     if not config:
         config = load_json_file('config.json')
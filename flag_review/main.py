@@ -1,11 +1,10 @@
 from argparse import ArgumentParser
 import subprocess
 import os
-import time
 import json
 from config import load_env_vars
-from LS_export_data_manually import export_tasks_and_annotations
 from LS_load_project import load_labelstudio_project
+from LS_client import get_labelstudio_client
 
 def load_json_file(json_fn):
     json_dict = {}
@@ -34,8 +33,11 @@ if __name__ == "__main__":
 
     # RUN THE APP
     p = subprocess.Popen([f'label-studio start -p {labelstudio_port} --username andres.cardelus@politikea.io --password {labelstudio_key} --user-token {labelstudio_token}'], shell=True)
-    # Wait for 10 secs for the app to start
-    time.sleep(60)
+    # Wait for the app to start, polling its health endpoint.
+    # The shared client points to this port, for the project setup too.
+    labelstudio_client = get_labelstudio_client(f"http://localhost:{labelstudio_port}")
+    startup_time = labelstudio_client.wait_until_ready(timeout=300, process=p)
+    print(f"Label Studio ready after {startup_time:.1f} secs.")
 
     ## Get User Token
     #sp = subprocess.run(f"curl -H 'Authorization: Token {labelstudio_token}' -X GET 'http://localhost:8080/api/current-user/token' -o user_token_response.json", shell=True)
@@ -43,7 +45,9 @@ if __name__ == "__main__":
     #token_dict = load_json_file('user_token_response.json')
     #user_token = token_dict['token']
 
-    load_labelstudio_project(debug)
+    project_ids = load_labelstudio_project(debug)
+    print(f"Label Studio project ready: {project_ids}.")
+    print(f"Import new flags with: python LS_import_new_tasks.py -p {project_ids['project']} -s {project_ids['import_storage']}")
 
     # Loop until the user presses Ctrl-C or the process ends
     try:
@@ -0,0 +1,128 @@
+from argparse import ArgumentParser
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from azure.storage.blob import BlobServiceClient
+from config import load_env_vars
+from LS_client import get_labelstudio_client
+from LS_export_data_manually import get_project_id
+from blob_layout import get_prefix_format, get_partitioned_name, get_blob_name
+
+
+def migrate_blob_layout(prefix_format=None, update_tasks=True, max_workers=8, dry_run=False,
+                        delete_originals=False, project_id=None, debug=True):
+    """
+    Copy the flags stored at the container root to their date partition
+    ('FLAG_BLOB_PREFIX_FORMAT'), with server-side copies. Optionally, point the
+    Label Studio tasks to the new blob names.
+    The root-level originals are kept by default: older export snapshots and task data
+    still point to them ('iter_blobs' falls back to the partitioned names if they are deleted).
+
+    Args:
+        prefix_format (str): strftime format of the partitions. Defaults to 'FLAG_BLOB_PREFIX_FORMAT'.
+        update_tasks (bool): Update the image URLs of the Label Studio tasks.
+        max_workers (int): Number of concurrent copies.
+        dry_run (bool): Only print the planned moves.
+        delete_originals (bool): Delete the root-level blobs once copied.
+        project_id (int): Label Studio project of the tasks. Found by title if None.
+        debug (bool): Flag to print debug info.
+
+    Returns:
+        dict: Old blob name -> new blob name.
+    """
+
+    try:
+        prefix_format = prefix_format or get_prefix_format()
+        if not prefix_format:
+            raise ValueError("No partition format given. Set 'FLAG_BLOB_PREFIX_FORMAT'.")
+        blob_url = os.getenv("AZURE_STORAGE_CONNECTION_STRING")
+        container_name = os.getenv("CONTAINER_NAME")
+
+        # Create a blob service client
+        blob_service_client = BlobServiceClient.from_connection_string(blob_url)
+        # Create a blob client for the flag container.
+        flag_container_client = blob_service_client.get_container_client(container_name)
+
+        # List only the root-level flags (not the already partitioned ones).
+        moves = {}
+        for blob in flag_container_client.walk_blobs(delimiter="/"):
+            if not blob.name.endswith(".png"):
+                continue
+            new_name = get_partitioned_name(blob.name, prefix_format)
+            if new_name is not None and new_name != blob.name:
+                moves[blob.name] = new_name
+        if debug:
+            print(f"Found {len(moves)} flags to move to '{prefix_format}'.")
+        if dry_run:
+            for old_name, new_name in moves.items():
+                print(f"{old_name} -> {new_name}")
+            return moves
+
+        def move_blob(old_name, new_name):
+            old_blob_client = flag_container_client.get_blob_client(blob=old_name)
+            new_blob_client = flag_container_client.get_blob_client(blob=new_name)
+            new_blob_client.start_copy_from_url(old_blob_client.url)
+            # Same account copies are usually done at once. Wait before deleting the source.
+            while new_blob_client.get_blob_properties().copy.status == "pending":
+                time.sleep(0.5)
+            if delete_originals:
+                old_blob_client.delete_blob()
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            for i, _ in enumerate(executor.map(lambda move: move_blob(*move), moves.items())):
+                if debug and (i + 1) % 100 == 0:
+                    print(f"Moved {i + 1}/{len(moves)} flags.")
+
+        if update_tasks and moves:
+            update_task_image_urls(moves, container_name, get_project_id(project_id, debug), debug=debug)
+
+        return moves
+
+    except Exception as e:
+        raise RuntimeError(f"Failed happen during blob layout migration: {str(e)}")
+
+
+def update_task_image_urls(moves, container_name, project_id, debug=True):
+    """
+    Point the Label Studio tasks of moved flags to their new blob names.
+    """
+    labelstudio_client = get_labelstudio_client()
+    n_updated = 0
+    for task_data in labelstudio_client.iter_tasks(project_id, fields="task_only"):
+        img_url = task_data["data"]["image"]
+        old_name = get_blob_name(img_url, container_name)
+        if old_name not in moves:
+            continue
+        # Keep the URL scheme (azure-blob:// or https), only the blob name changes.
+        new_data = dict(task_data["data"], image=img_url.split("?")[0].replace(old_name, moves[old_name]))
+        labelstudio_client.patch(f"/api/tasks/{task_data['id']}/", json={"data": new_data})
+        n_updated += 1
+    if debug:
+        print(f"Updated the image URL of {n_updated} tasks.")
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("-f", "--format",
+                        dest="prefix_format", default=None,
+                        help="strftime format of the partitions, e.g. 'flags/%%Y/%%m/%%d/'. Defaults to 'FLAG_BLOB_PREFIX_FORMAT'")
+    parser.add_argument("--skip_tasks",
+                        dest="skip_tasks", action="store_true",
+                        help="Do not update the image URLs of the Label Studio tasks")
+    parser.add_argument("--dry_run",
+                        dest="dry_run", action="store_true",
+                        help="Only print the planned moves")
+    parser.add_argument("--delete_originals",
+                        dest="delete_originals", action="store_true",
+                        help="Delete the root-level flags once copied (older exports then rely on the partition fallback)")
+    parser.add_argument("-p", "--project_id",
+                        dest="project_id", default=None, type=int,
+                        help="Id of the Label Studio project (found by title if not set)")
+    args = parser.parse_args()
+
+    # Load env vars.
+    load_env_vars()
+
+    # Move root-level flags to their partitions.
+    migrate_blob_layout(args.prefix_format, update_tasks=not args.skip_tasks, dry_run=args.dry_run,
+                        delete_originals=args.delete_originals, project_id=args.project_id)